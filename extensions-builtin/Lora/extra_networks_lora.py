@@ -57,3 +57,10 @@ class ExtraNetworkLora(extra_networks.ExtraNetwork):
 
     def deactivate(self, p):
         pass
+
+    def files(self, params_list):
+        names = [x.positional[0] for x in params_list if x.positional]
+        if shared.opts.sd_lora != "None":
+            names.append(shared.opts.sd_lora)
+
+        return [networks.available_network_aliases[x].filename for x in names if x in networks.available_network_aliases]
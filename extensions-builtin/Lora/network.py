@@ -77,6 +77,12 @@ class NetworkOnDisk:
         if not self.hash:
             self.set_hash(hashes.sha256(self.filename, "lora/" + self.name, use_addnet_hash=self.is_safetensors) or '')
 
+    def request_hash(self):
+        """starts calculating the hash on hashing workers without waiting for it"""
+
+        if not self.hash:
+            hashes.request_in_background(self.filename, "lora/" + self.name, self.set_hash, use_addnet_hash=self.is_safetensors)
+
     def get_alias(self):
         import networks
         if shared.opts.lora_preferred_name == "Filename" or self.alias.lower() in networks.forbidden_network_aliases:
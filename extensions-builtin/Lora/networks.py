@@ -227,7 +227,11 @@ def load_networks(names, te_multipliers=None, unet_multipliers=None, dyn_dims=No
 
             net.mentioned_name = name
 
-            network_on_disk.read_hash()
+            # the hash is only needed right away if it goes into infotext
+            if shared.opts.lora_add_hashes_to_infotext:
+                network_on_disk.read_hash()
+            else:
+                network_on_disk.request_hash()
 
         if net is None:
             failed_to_load_networks.append(name)
@@ -93,85 +93,129 @@ function requestProgress(id_task, progressbarContainer, gallery, atEnd, onProgre
         atEnd();
     };
 
-    var fun = function(id_task, id_live_preview) {
-        request("./internal/progress", {id_task: id_task, id_live_preview: id_live_preview}, function(res) {
-            if (res.completed) {
-                removeProgressBar();
-                return;
-            }
+    var finished = false;
 
-            var rect = progressbarContainer.getBoundingClientRect();
+    // handles a single progress update; returns true if more updates should be requested
+    var onResponse = function(res) {
+        if (finished) return false;
 
-            if (rect.width) {
-                divProgress.style.width = rect.width + "px";
-            }
+        if (res.completed) {
+            finished = true;
+            removeProgressBar();
+            return false;
+        }
 
-            let progressText = "";
+        var rect = progressbarContainer.getBoundingClientRect();
 
-            divInner.style.width = ((res.progress || 0) * 100.0) + '%';
-            divInner.style.background = res.progress ? "" : "transparent";
+        if (rect.width) {
+            divProgress.style.width = rect.width + "px";
+        }
 
-            if (res.progress > 0) {
-                progressText = ((res.progress || 0) * 100.0).toFixed(0) + '%';
-            }
+        let progressText = "";
 
-            if (res.eta) {
-                progressText += " ETA: " + formatTime(res.eta);
-            }
+        divInner.style.width = ((res.progress || 0) * 100.0) + '%';
+        divInner.style.background = res.progress ? "" : "transparent";
 
+        if (res.progress > 0) {
+            progressText = ((res.progress || 0) * 100.0).toFixed(0) + '%';
+        }
 
-            setTitle(progressText);
+        if (res.eta) {
+            progressText += " ETA: " + formatTime(res.eta);
+        }
 
-            if (res.textinfo && res.textinfo.indexOf("\n") == -1) {
-                progressText = res.textinfo + " " + progressText;
-            }
 
-            divInner.textContent = progressText;
+        setTitle(progressText);
 
-            var elapsedFromStart = (new Date() - dateStart) / 1000;
+        if (res.textinfo && res.textinfo.indexOf("\n") == -1) {
+            progressText = res.textinfo + " " + progressText;
+        }
 
-            if (res.active) wasEverActive = true;
+        divInner.textContent = progressText;
 
-            if (!res.active && wasEverActive) {
-                removeProgressBar();
-                return;
-            }
+        var elapsedFromStart = (new Date() - dateStart) / 1000;
+
+        if (res.active) wasEverActive = true;
+
+        if (!res.active && wasEverActive) {
+            finished = true;
+            removeProgressBar();
+            return false;
+        }
+
+        if (elapsedFromStart > inactivityTimeout && !res.queued && !res.active) {
+            finished = true;
+            removeProgressBar();
+            return false;
+        }
 
-            if (elapsedFromStart > inactivityTimeout && !res.queued && !res.active) {
-                removeProgressBar();
-                return;
-            }
 
+        if (res.live_preview && gallery) {
+            rect = gallery.getBoundingClientRect();
+            if (rect.width) {
+                livePreview.style.width = rect.width + "px";
+                livePreview.style.height = rect.height + "px";
+            }
 
-            if (res.live_preview && gallery) {
-                rect = gallery.getBoundingClientRect();
-                if (rect.width) {
-                    livePreview.style.width = rect.width + "px";
-                    livePreview.style.height = rect.height + "px";
+            var img = new Image();
+            img.onload = function() {
+                livePreview.appendChild(img);
+                if (livePreview.childElementCount > 2) {
+                    livePreview.removeChild(livePreview.firstElementChild);
                 }
+            };
+            img.src = res.live_preview;
+        }
+
+
+        if (onProgress) {
+            onProgress(res);
+        }
+
+        return true;
+    };
+
+    var onError = function() {
+        if (finished) return;
 
-                var img = new Image();
-                img.onload = function() {
-                    livePreview.appendChild(img);
-                    if (livePreview.childElementCount > 2) {
-                        livePreview.removeChild(livePreview.firstElementChild);
-                    }
-                };
-                img.src = res.live_preview;
+        finished = true;
+        removeProgressBar();
+    };
+
+    var fun = function(id_task, id_live_preview) {
+        request("./internal/progress", {id_task: id_task, id_live_preview: id_live_preview}, function(res) {
+            if (onResponse(res)) {
+                setTimeout(() => {
+                    fun(id_task, res.id_live_preview);
+                }, opts.live_preview_refresh_period || 500);
             }
+        }, onError);
+    };
 
+    // server pushes updates as they happen; falls back to polling if streaming is not available
+    var stream = function(id_task) {
+        var source = new EventSource("./internal/progress/stream?id_task=" + encodeURIComponent(id_task));
+        var receivedAny = false;
 
-            if (onProgress) {
-                onProgress(res);
+        source.onmessage = function(e) {
+            receivedAny = true;
+            if (!onResponse(JSON.parse(e.data))) {
+                source.close();
             }
+        };
 
-            setTimeout(() => {
-                fun(id_task, res.id_live_preview);
-            }, opts.live_preview_refresh_period || 500);
-        }, function() {
-            removeProgressBar();
-        });
+        source.onerror = function() {
+            source.close();
+
+            if (!finished) {
+                fun(id_task, receivedAny ? -1 : 0);
+            }
+        };
     };
 
-    fun(id_task, 0);
+    if (window.EventSource) {
+        stream(id_task);
+    } else {
+        fun(id_task, 0);
+    }
 }
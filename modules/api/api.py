@@ -3,20 +3,25 @@ import io
 import os
 import time
 import datetime
+import json
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import uvicorn
 import gradio as gr
-from threading import Lock
 from io import BytesIO
 from fastapi import APIRouter, Depends, FastAPI, Request, Response
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi.exceptions import HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.encoders import jsonable_encoder
+from fastapi.concurrency import run_in_threadpool
 from secrets import compare_digest
 
 import modules.shared as shared
-from modules import sd_samplers, deepbooru, sd_hijack, images, scripts, ui, postprocessing, errors, restart
-from modules.api import models
+from modules import sd_samplers, deepbooru, sd_hijack, images, scripts, ui, postprocessing, errors, restart, job_scheduler, progress, metrics, hashes
+from modules.api import models, batching, task_journal
+from modules.result_store import ResultStore
 from modules.shared import opts
 from modules.processing import StableDiffusionProcessingTxt2Img, StableDiffusionProcessingImg2Img, process_images
 from modules.textual_inversion.textual_inversion import create_embedding, train_embedding
@@ -25,13 +30,13 @@ from modules.hypernetworks.hypernetwork import create_hypernetwork, train_hypern
 from PIL import PngImagePlugin,Image
 from modules.sd_models import checkpoints_list, unload_model_weights, reload_model_weights, checkpoint_aliases
 from modules.sd_vae import vae_dict
-from modules.sd_models_config import find_checkpoint_config_near_filename
+from modules.sd_models_config import find_checkpoint_config_near_filename, checkpoint_layout, architecture_name
 from modules.realesrgan_model import get_realesrgan_models
 from modules import devices
 from typing import Dict, List, Any
 import piexif
 import piexif.helper
-from contextlib import closing
+from contextlib import closing, contextmanager
 
 
 def script_name_to_index(name, scripts):
@@ -56,6 +61,94 @@ def setUpscalers(req: dict):
     return reqDict
 
 
+def get_job_client(request: Request):
+    """
+    identifies the submitter of a request for the purposes of fair queueing: the API user if authentication is used, otherwise the remote address;
+    the username from the authorization header is only trusted with --api-auth, where the auth dependency has verified it before the endpoint runs
+    """
+
+    if request is None:
+        return "api"
+
+    authorization = request.headers.get("authorization", "")
+    if shared.cmd_opts.api_auth and authorization.lower().startswith("basic "):
+        try:
+            return "api:" + base64.b64decode(authorization[6:]).decode().split(":", 1)[0]
+        except Exception:
+            pass
+
+    return "api:" + (request.client.host if request.client else "unknown")
+
+
+def check_accepting_jobs():
+    if shared.state.draining:
+        raise HTTPException(status_code=503, detail="Server is about to restart and does not accept new jobs", headers={"Retry-After": "30"})
+
+
+def get_job_priority(name):
+    priority = job_scheduler.priorities.get(name or opts.api_default_priority, None)
+    if priority is None:
+        raise HTTPException(status_code=422, detail=f"Unknown priority: {name}; must be one of: {', '.join(job_scheduler.priorities)}")
+
+    return priority
+
+
+def get_job_checkpoint(req):
+    """returns the checkpoint the request is going to switch to, so that the queue can prefetch it"""
+
+    return (req.override_settings or {}).get("sd_model_checkpoint")
+
+
+def validate_response_format(req):
+    if req.response_format not in ("json", "multipart", "files"):
+        raise HTTPException(status_code=422, detail=f"Unknown response format: {req.response_format}; must be one of: json, multipart, files")
+
+    if req.image_format is not None and req.image_format.lower() not in image_mime_types:
+        raise HTTPException(status_code=422, detail=f"Unknown image format: {req.image_format}; must be one of: {', '.join(image_mime_types)}")
+
+    if req.png_compress_level is not None and not 0 <= req.png_compress_level <= 9:
+        raise HTTPException(status_code=422, detail="PNG compression level must be between 0 and 9")
+
+    if req.response_format == "files" and not req.save_images:
+        raise HTTPException(status_code=422, detail="Response format files requires save_images to be enabled, since images are returned as paths of saved files")
+
+    if req.response_format == "files" and not opts.samples_save:
+        raise HTTPException(status_code=422, detail="Response format files requires the server to have saving of images enabled (samples_save setting)")
+
+
+def get_job_progress():
+    """returns progress of the current job in range 0 to 1, and the estimated number of seconds until it's done"""
+
+    # avoid dividing zero
+    progress = 0.01
+
+    if shared.state.job_count > 0:
+        progress += shared.state.job_no / shared.state.job_count
+    if shared.state.sampling_steps > 0 and shared.state.job_count > 0:
+        progress += 1 / shared.state.job_count * shared.state.sampling_step / shared.state.sampling_steps
+
+    time_since_start = time.time() - shared.state.time_start
+    eta = (time_since_start/progress)
+    eta_relative = eta-time_since_start
+
+    return min(progress, 1), eta_relative
+
+
+@contextmanager
+def monitor_memory():
+    """records peak memory use of the code inside the block to metrics, if memory monitor is enabled"""
+
+    run_memmon = opts.memmon_poll_rate > 0 and not shared.mem_mon.disabled
+    if run_memmon:
+        shared.mem_mon.monitor()
+
+    try:
+        yield
+    finally:
+        if run_memmon:
+            metrics.observe_memory(shared.mem_mon.stop())
+
+
 def decode_base64_to_image(encoding):
     if encoding.startswith("data:image/"):
         encoding = encoding.split(";")[1].split(",")[1]
@@ -66,26 +159,28 @@ def decode_base64_to_image(encoding):
         raise HTTPException(status_code=500, detail="Invalid encoded image") from e
 
 
-def encode_pil_to_base64(image):
+def encode_pil_to_bytes(image, image_format=None, compress_level=None):
+    image_format = (image_format or opts.samples_format).lower()
+
     with io.BytesIO() as output_bytes:
 
-        if opts.samples_format.lower() == 'png':
+        if image_format == 'png':
             use_metadata = False
             metadata = PngImagePlugin.PngInfo()
             for key, value in image.info.items():
                 if isinstance(key, str) and isinstance(value, str):
                     metadata.add_text(key, value)
                     use_metadata = True
-            image.save(output_bytes, format="PNG", pnginfo=(metadata if use_metadata else None), quality=opts.jpeg_quality)
+            image.save(output_bytes, format="PNG", pnginfo=(metadata if use_metadata else None), compress_level=opts.api_png_compress_level if compress_level is None else compress_level)
 
-        elif opts.samples_format.lower() in ("jpg", "jpeg", "webp"):
+        elif image_format in ("jpg", "jpeg", "webp"):
             if image.mode == "RGBA":
                 image = image.convert("RGB")
             parameters = image.info.get('parameters', None)
             exif_bytes = piexif.dump({
                 "Exif": { piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(parameters or "", encoding="unicode") }
             })
-            if opts.samples_format.lower() in ("jpg", "jpeg"):
+            if image_format in ("jpg", "jpeg"):
                 image.save(output_bytes, format="JPEG", exif = exif_bytes, quality=opts.jpeg_quality)
             else:
                 image.save(output_bytes, format="WEBP", exif = exif_bytes, quality=opts.jpeg_quality)
@@ -93,9 +188,82 @@ def encode_pil_to_base64(image):
         else:
             raise HTTPException(status_code=500, detail="Invalid image format")
 
-        bytes_data = output_bytes.getvalue()
+        return output_bytes.getvalue()
+
+
+def encode_pil_to_base64(image, image_format=None, compress_level=None):
+    return base64.b64encode(encode_pil_to_bytes(image, image_format, compress_level))
+
+
+image_encoding_pool = None
+image_encoding_pool_lock = threading.Lock()
+
+
+def encode_images(images, encode=encode_pil_to_base64, **kwargs):
+    """encodes a list of images using a thread pool; PIL releases the GIL while compressing, so this runs in parallel"""
+
+    global image_encoding_pool
+
+    if len(images) < 2 or opts.api_image_encoding_threads <= 1:
+        return [encode(x, **kwargs) for x in images]
+
+    # map() submits all work before returning, so holding the lock for it keeps a concurrent resize from shutting down the pool in between
+    with image_encoding_pool_lock:
+        if image_encoding_pool is None or image_encoding_pool._max_workers != opts.api_image_encoding_threads:
+            if image_encoding_pool is not None:
+                image_encoding_pool.shutdown(wait=False)
+
+            image_encoding_pool = ThreadPoolExecutor(max_workers=opts.api_image_encoding_threads, thread_name_prefix="api-image-encoding")
 
-    return base64.b64encode(bytes_data)
+        results = image_encoding_pool.map(lambda x: encode(x, **kwargs), images)
+
+    return list(results)
+
+
+task_journal_replayed = False
+
+# longest time a request for task result may block waiting for the task to finish
+max_result_wait_time = 60
+
+image_mime_types = {"png": "image/png", "jpg": "image/jpeg", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+
+def multipart_response(metadata, images, image_format):
+    """
+    Creates a multipart/mixed response: first part is JSON with everything except images, followed by one part with
+    raw encoded bytes for each image.
+    """
+
+    image_format = (image_format or opts.samples_format).lower()
+    boundary = uuid.uuid4().hex
+    parts = [b"Content-Type: application/json\r\n\r\n" + json.dumps(jsonable_encoder(metadata)).encode("utf8")]
+
+    for i, data in enumerate(images):
+        headers = f"Content-Type: {image_mime_types.get(image_format, 'application/octet-stream')}\r\nContent-Disposition: attachment; filename=\"{i:05}.{image_format}\"\r\n\r\n"
+        parts.append(headers.encode("utf8") + data)
+
+    body = b"".join(f"--{boundary}\r\n".encode("utf8") + part + b"\r\n" for part in parts) + f"--{boundary}--\r\n".encode("utf8")
+
+    return Response(content=body, media_type=f"multipart/mixed; boundary={boundary}")
+
+
+def generation_response(req, processed, response_class):
+    """creates the response for txt2img/img2img in the format the request asked for in response_format"""
+
+    images = processed.images if req.send_images else []
+    metadata = {"parameters": vars(req), "info": processed.js()}
+
+    if req.response_format == "multipart":
+        return multipart_response(metadata, encode_images(images, encode=encode_pil_to_bytes, image_format=req.image_format, compress_level=req.png_compress_level), req.image_format)
+
+    files = None
+    if req.response_format == "files":
+        files = [x.already_saved_as for x in images if getattr(x, 'already_saved_as', None)]
+        images = [x for x in images if not getattr(x, 'already_saved_as', None)]
+
+    b64images = encode_images(images, image_format=req.image_format, compress_level=req.png_compress_level)
+
+    return response_class(images=b64images, files=files, **metadata)
 
 
 def api_middleware(app: FastAPI):
@@ -163,7 +331,7 @@ def api_middleware(app: FastAPI):
 
 
 class Api:
-    def __init__(self, app: FastAPI, queue_lock: Lock):
+    def __init__(self, app: FastAPI, queue_lock: job_scheduler.JobScheduler):
         if shared.cmd_opts.api_auth:
             self.credentials = {}
             for auth in shared.cmd_opts.api_auth.split(","):
@@ -176,10 +344,16 @@ class Api:
         api_middleware(self.app)
         self.add_api_route("/sdapi/v1/txt2img", self.text2imgapi, methods=["POST"], response_model=models.TextToImageResponse)
         self.add_api_route("/sdapi/v1/img2img", self.img2imgapi, methods=["POST"], response_model=models.ImageToImageResponse)
+        self.add_api_route("/sdapi/v1/txt2img/submit", self.text2img_submitapi, methods=["POST"], response_model=models.TaskSubmitResponse)
+        self.add_api_route("/sdapi/v1/img2img/submit", self.img2img_submitapi, methods=["POST"], response_model=models.TaskSubmitResponse)
+        self.add_api_route("/sdapi/v1/tasks/{id_task}", self.task_statusapi, methods=["GET"], response_model=models.TaskStatusResponse)
+        self.add_api_route("/sdapi/v1/tasks/{id_task}/result", self.task_resultapi, methods=["GET"])
+        self.add_api_route("/sdapi/v1/tasks/{id_task}/cancel", self.task_cancelapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/extra-single-image", self.extras_single_image_api, methods=["POST"], response_model=models.ExtrasSingleImageResponse)
         self.add_api_route("/sdapi/v1/extra-batch-images", self.extras_batch_images_api, methods=["POST"], response_model=models.ExtrasBatchImagesResponse)
         self.add_api_route("/sdapi/v1/png-info", self.pnginfoapi, methods=["POST"], response_model=models.PNGInfoResponse)
         self.add_api_route("/sdapi/v1/progress", self.progressapi, methods=["GET"], response_model=models.ProgressResponse)
+        self.add_api_route("/sdapi/v1/progress/stream", progress.progress_stream_api, methods=["GET"])
         self.add_api_route("/sdapi/v1/interrogate", self.interrogateapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/interrupt", self.interruptapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/skip", self.skip, methods=["POST"])
@@ -207,15 +381,27 @@ class Api:
         self.add_api_route("/sdapi/v1/reload-checkpoint", self.reloadapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/scripts", self.get_scripts_list, methods=["GET"], response_model=models.ScriptsList)
         self.add_api_route("/sdapi/v1/script-info", self.get_script_info, methods=["GET"], response_model=List[models.ScriptInfo])
+        self.add_api_route("/sdapi/v1/queue", self.get_queue, methods=["GET"], response_model=models.QueueStatusResponse)
+        self.add_api_route("/sdapi/v1/queue/cancel", self.cancel_queued_job, methods=["POST"])
+        self.add_api_route("/sdapi/v1/hashing", self.get_hashing_status, methods=["GET"], response_model=List[models.HashingJobItem])
+        self.add_api_route("/sdapi/v1/metrics", self.get_metrics, methods=["GET"], response_class=PlainTextResponse)
 
         if shared.cmd_opts.api_server_stop:
             self.add_api_route("/sdapi/v1/server-kill", self.kill_webui, methods=["POST"])
             self.add_api_route("/sdapi/v1/server-restart", self.restart_webui, methods=["POST"])
             self.add_api_route("/sdapi/v1/server-stop", self.stop_webui, methods=["POST"])
+            self.add_api_route("/sdapi/v1/server-drain", self.drain_webui, methods=["POST"])
 
         self.default_script_arg_txt2img = []
         self.default_script_arg_img2img = []
 
+        self.task_results = ResultStore("api", "api_task_results_limit")
+        self.txt2img_batcher = batching.Txt2ImgBatcher(self.queue_lock, self.process_txt2img)
+
+        metrics.register_collector(self.collect_queue_metrics)
+
+        self.replay_task_journal()
+
     def add_api_route(self, path: str, endpoint, **kwargs):
         if shared.cmd_opts.api_auth:
             return self.app.add_api_route(path, endpoint, dependencies=[Depends(self.auth)], **kwargs)
@@ -300,7 +486,9 @@ class Api:
                         script_args[alwayson_script.args_from + idx] = request.alwayson_scripts[alwayson_script_name]["args"][idx]
         return script_args
 
-    def text2imgapi(self, txt2imgreq: models.StableDiffusionTxt2ImgProcessingAPI):
+    def prepare_txt2img(self, txt2imgreq: models.StableDiffusionTxt2ImgProcessingAPI):
+        """validates the request and converts it into arguments for process_txt2img; does not need the queue lock"""
+
         script_runner = scripts.scripts_txt2img
         if not script_runner.scripts:
             script_runner.initialize_scripts(False)
@@ -308,6 +496,7 @@ class Api:
         if not self.default_script_arg_txt2img:
             self.default_script_arg_txt2img = self.init_default_script_args(script_runner)
         selectable_scripts, selectable_script_idx = self.get_selectable_script(txt2imgreq.script_name, script_runner)
+        validate_response_format(txt2imgreq)
 
         populate = txt2imgreq.copy(update={  # Override __init__ params
             "sampler_name": validate_sampler_name(txt2imgreq.sampler_name or txt2imgreq.sampler_index),
@@ -324,31 +513,75 @@ class Api:
 
         script_args = self.init_script_args(txt2imgreq, self.default_script_arg_txt2img, selectable_scripts, selectable_script_idx, script_runner)
 
-        send_images = args.pop('send_images', True)
+        args.pop('send_images', True)
         args.pop('save_images', None)
+        args.pop('priority', None)
+        args.pop('response_format', None)
+        args.pop('image_format', None)
+        args.pop('png_compress_level', None)
+
+        return args, script_args, selectable_scripts
+
+    def process_txt2img(self, args, script_args, selectable_scripts, use_output_cache=True):
+        """runs txt2img generation; must be called while holding the queue lock"""
+
+        script_runner = scripts.scripts_txt2img
+
+        with monitor_memory(), closing(StableDiffusionProcessingTxt2Img(sd_model=shared.sd_model, **args)) as p:
+            p.scripts = script_runner
+            p.outpath_grids = opts.outdir_txt2img_grids
+            p.outpath_samples = opts.outdir_txt2img_samples
+            p.use_output_cache = use_output_cache
+
+            try:
+                shared.state.begin(job="scripts_txt2img")
+                if selectable_scripts is not None:
+                    p.script_args = script_args
+                    processed = scripts.scripts_txt2img.run(p, *p.script_args) # Need to pass args as list here
+                else:
+                    p.script_args = tuple(script_args) # Need to pass args as tuple here
+                    processed = process_images(p)
+            finally:
+                shared.state.end()
+
+        return processed
+
+    def txt2img_response(self, txt2imgreq: models.StableDiffusionTxt2ImgProcessingAPI, processed):
+        return generation_response(txt2imgreq, processed, models.TextToImageResponse)
+
+    def text2imgapi(self, txt2imgreq: models.StableDiffusionTxt2ImgProcessingAPI, request: Request = None):
+        check_accepting_jobs()
+        priority = get_job_priority(txt2imgreq.priority)
+        prepared = self.prepare_txt2img(txt2imgreq)
+
+        if self.txt2img_batcher.is_batchable(txt2imgreq, prepared[0]):
+            processed = self.txt2img_batcher.add(prepared[0], prepared[1], get_job_client(request), priority).result()
+            return self.txt2img_response(txt2imgreq, processed)
+
+        with self.queue_lock.job(client=get_job_client(request), priority=priority, description="txt2img", checkpoint=get_job_checkpoint(txt2imgreq)):
+            processed = self.process_txt2img(*prepared)
+
+        return self.txt2img_response(txt2imgreq, processed)
+
+    def text2img_submitapi(self, txt2imgreq: models.StableDiffusionTxt2ImgProcessingAPI, request: Request = None):
+        check_accepting_jobs()
+        return self.submit_txt2img(txt2imgreq, get_job_client(request), get_job_priority(txt2imgreq.priority))
+
+    def submit_txt2img(self, txt2imgreq: models.StableDiffusionTxt2ImgProcessingAPI, client, priority, id_task=None):
+        id_task = id_task or f"task({uuid.uuid4().hex})"
+        request_data = txt2imgreq.dict()
+        prepared = self.prepare_txt2img(txt2imgreq)
+
+        task_journal.save(id_task, "txt2img", client, priority, request_data)
+
+        if self.txt2img_batcher.is_batchable(txt2imgreq, prepared[0]):
+            return self.submit_batched_txt2img_task(id_task, txt2imgreq, prepared, client, priority)
+
+        return self.submit_task(id_task, lambda: self.txt2img_response(txt2imgreq, self.process_txt2img(*prepared)), client, priority, "txt2img", checkpoint=get_job_checkpoint(txt2imgreq))
+
+    def prepare_img2img(self, img2imgreq: models.StableDiffusionImg2ImgProcessingAPI):
+        """validates the request and converts it into arguments for process_img2img; does not need the queue lock"""
 
-        with self.queue_lock:
-            with closing(StableDiffusionProcessingTxt2Img(sd_model=shared.sd_model, **args)) as p:
-                p.scripts = script_runner
-                p.outpath_grids = opts.outdir_txt2img_grids
-                p.outpath_samples = opts.outdir_txt2img_samples
-
-                try:
-                    shared.state.begin(job="scripts_txt2img")
-                    if selectable_scripts is not None:
-                        p.script_args = script_args
-                        processed = scripts.scripts_txt2img.run(p, *p.script_args) # Need to pass args as list here
-                    else:
-                        p.script_args = tuple(script_args) # Need to pass args as tuple here
-                        processed = process_images(p)
-                finally:
-                    shared.state.end()
-
-        b64images = list(map(encode_pil_to_base64, processed.images)) if send_images else []
-
-        return models.TextToImageResponse(images=b64images, parameters=vars(txt2imgreq), info=processed.js())
-
-    def img2imgapi(self, img2imgreq: models.StableDiffusionImg2ImgProcessingAPI):
         init_images = img2imgreq.init_images
         if init_images is None:
             raise HTTPException(status_code=404, detail="Init image not found")
@@ -364,6 +597,7 @@ class Api:
         if not self.default_script_arg_img2img:
             self.default_script_arg_img2img = self.init_default_script_args(script_runner)
         selectable_scripts, selectable_script_idx = self.get_selectable_script(img2imgreq.script_name, script_runner)
+        validate_response_format(img2imgreq)
 
         populate = img2imgreq.copy(update={  # Override __init__ params
             "sampler_name": validate_sampler_name(img2imgreq.sampler_name or img2imgreq.sampler_index),
@@ -382,34 +616,185 @@ class Api:
 
         script_args = self.init_script_args(img2imgreq, self.default_script_arg_img2img, selectable_scripts, selectable_script_idx, script_runner)
 
-        send_images = args.pop('send_images', True)
+        args.pop('send_images', True)
         args.pop('save_images', None)
+        args.pop('priority', None)
+        args.pop('response_format', None)
+        args.pop('image_format', None)
+        args.pop('png_compress_level', None)
+        args['init_images'] = [decode_base64_to_image(x) for x in init_images]
 
-        with self.queue_lock:
-            with closing(StableDiffusionProcessingImg2Img(sd_model=shared.sd_model, **args)) as p:
-                p.init_images = [decode_base64_to_image(x) for x in init_images]
-                p.scripts = script_runner
-                p.outpath_grids = opts.outdir_img2img_grids
-                p.outpath_samples = opts.outdir_img2img_samples
-
-                try:
-                    shared.state.begin(job="scripts_img2img")
-                    if selectable_scripts is not None:
-                        p.script_args = script_args
-                        processed = scripts.scripts_img2img.run(p, *p.script_args) # Need to pass args as list here
-                    else:
-                        p.script_args = tuple(script_args) # Need to pass args as tuple here
-                        processed = process_images(p)
-                finally:
-                    shared.state.end()
-
-        b64images = list(map(encode_pil_to_base64, processed.images)) if send_images else []
+        return args, script_args, selectable_scripts
+
+    def process_img2img(self, args, script_args, selectable_scripts):
+        """runs img2img generation; must be called while holding the queue lock"""
+
+        script_runner = scripts.scripts_img2img
+
+        with monitor_memory(), closing(StableDiffusionProcessingImg2Img(sd_model=shared.sd_model, **args)) as p:
+            p.scripts = script_runner
+            p.outpath_grids = opts.outdir_img2img_grids
+            p.outpath_samples = opts.outdir_img2img_samples
+
+            try:
+                shared.state.begin(job="scripts_img2img")
+                if selectable_scripts is not None:
+                    p.script_args = script_args
+                    processed = scripts.scripts_img2img.run(p, *p.script_args) # Need to pass args as list here
+                else:
+                    p.script_args = tuple(script_args) # Need to pass args as tuple here
+                    processed = process_images(p)
+            finally:
+                shared.state.end()
 
+        return processed
+
+    def img2img_response(self, img2imgreq: models.StableDiffusionImg2ImgProcessingAPI, processed):
         if not img2imgreq.include_init_images:
             img2imgreq.init_images = None
             img2imgreq.mask = None
 
-        return models.ImageToImageResponse(images=b64images, parameters=vars(img2imgreq), info=processed.js())
+        return generation_response(img2imgreq, processed, models.ImageToImageResponse)
+
+    def img2imgapi(self, img2imgreq: models.StableDiffusionImg2ImgProcessingAPI, request: Request = None):
+        check_accepting_jobs()
+        priority = get_job_priority(img2imgreq.priority)
+        prepared = self.prepare_img2img(img2imgreq)
+
+        with self.queue_lock.job(client=get_job_client(request), priority=priority, description="img2img", checkpoint=get_job_checkpoint(img2imgreq)):
+            processed = self.process_img2img(*prepared)
+
+        return self.img2img_response(img2imgreq, processed)
+
+    def img2img_submitapi(self, img2imgreq: models.StableDiffusionImg2ImgProcessingAPI, request: Request = None):
+        check_accepting_jobs()
+        return self.submit_img2img(img2imgreq, get_job_client(request), get_job_priority(img2imgreq.priority))
+
+    def submit_img2img(self, img2imgreq: models.StableDiffusionImg2ImgProcessingAPI, client, priority, id_task=None):
+        id_task = id_task or f"task({uuid.uuid4().hex})"
+        request_data = img2imgreq.dict()
+        prepared = self.prepare_img2img(img2imgreq)
+
+        task_journal.save(id_task, "img2img", client, priority, request_data)
+
+        return self.submit_task(id_task, lambda: self.img2img_response(img2imgreq, self.process_img2img(*prepared)), client, priority, "img2img", checkpoint=get_job_checkpoint(img2imgreq))
+
+    def submit_task(self, id_task, func, client, priority, description, checkpoint=None):
+        """queues func to run without blocking the calling thread; its return value is kept in task_results until requested"""
+
+        def run():
+            progress.start_task(id_task)
+            try:
+                self.record_task_result(id_task, "done", response=func())
+            except Exception as e:
+                errors.report(f"API error: {description} task {id_task}", exc_info=True)
+                self.record_task_result(id_task, "failed", error=f"{type(e).__name__}: {e}")
+            finally:
+                progress.finish_task(id_task)
+
+        def on_cancel():
+            progress.remove_task_from_queue(id_task)
+            self.record_task_result(id_task, "cancelled")
+
+        progress.add_task_to_queue(id_task)
+        self.queue_lock.submit(run, id_job=id_task, client=client, priority=priority, description=description, on_cancel=on_cancel, checkpoint=checkpoint)
+
+        return models.TaskSubmitResponse(id_task=id_task)
+
+    def submit_batched_txt2img_task(self, id_task, txt2imgreq, prepared, client, priority):
+        def on_done(future):
+            if future.cancelled():
+                progress.remove_task_from_queue(id_task)
+                self.record_task_result(id_task, "cancelled")
+                return
+
+            try:
+                self.record_task_result(id_task, "done", response=self.txt2img_response(txt2imgreq, future.result()))
+            except Exception as e:
+                errors.report(f"API error: txt2img task {id_task}", exc_info=True)
+                self.record_task_result(id_task, "failed", error=f"{type(e).__name__}: {e}")
+
+        progress.add_task_to_queue(id_task)
+        self.txt2img_batcher.add(prepared[0], prepared[1], client, priority, id_task=id_task).add_done_callback(on_done)
+
+        return models.TaskSubmitResponse(id_task=id_task)
+
+    def record_task_result(self, id_task, status, response=None, error=None):
+        self.task_results.put(id_task, (status, response, error))
+        task_journal.remove(id_task)
+
+    def replay_task_journal(self):
+        """submits again the tasks that were still queued or running when the server last stopped"""
+
+        global task_journal_replayed
+
+        if task_journal_replayed:
+            return
+
+        task_journal_replayed = True
+
+        submitters = {
+            "txt2img": (models.StableDiffusionTxt2ImgProcessingAPI, self.submit_txt2img),
+            "img2img": (models.StableDiffusionImg2ImgProcessingAPI, self.submit_img2img),
+        }
+
+        entries = task_journal.load()
+        for entry in entries:
+            id_task = entry.get("id_task")
+
+            try:
+                request_model, submit = submitters[entry["kind"]]
+                submit(request_model(**entry["request"]), entry["client"], entry["priority"], id_task=id_task)
+            except Exception as e:
+                errors.display(e, f"restoring queued task {id_task}")
+                task_journal.remove(id_task)
+
+        if entries:
+            print(f"Restored {len(entries)} queued API tasks.")
+
+    def task_statusapi(self, id_task: str):
+        result = self.task_results.get(id_task)
+
+        if result is not None:
+            status, _, error = result
+            return models.TaskStatusResponse(id_task=id_task, status=status, error=error)
+
+        if id_task == progress.current_task or id_task in self.txt2img_batcher.running:
+            job_progress, eta_relative = get_job_progress() if shared.state.job_count != 0 else (0, None)
+            return models.TaskStatusResponse(id_task=id_task, status="running", progress=job_progress, eta_relative=eta_relative)
+
+        if id_task in progress.pending_tasks:
+            return models.TaskStatusResponse(id_task=id_task, status="queued", queue_position=self.queue_lock.position(id_task))
+
+        raise HTTPException(status_code=404, detail=f"Task {id_task} not found; its result may have been discarded")
+
+    async def task_resultapi(self, id_task: str, timeout: float = 0):
+        if timeout > 0:
+            await progress.wait_for_task_async(id_task, min(timeout, max_result_wait_time))
+
+        result = await run_in_threadpool(self.task_results.get, id_task)
+
+        if result is None:
+            if id_task == progress.current_task or id_task in progress.pending_tasks or id_task in self.txt2img_batcher.running:
+                raise HTTPException(status_code=409, detail=f"Task {id_task} has not finished yet")
+
+            raise HTTPException(status_code=404, detail=f"Task {id_task} not found; its result may have been discarded")
+
+        status, response, error = result
+        if status != "done":
+            raise HTTPException(status_code=410 if status == "cancelled" else 500, detail=error or f"Task {id_task} was {status}")
+
+        return response
+
+    def task_cancelapi(self, id_task: str):
+        if self.queue_lock.cancel(id_task) or self.txt2img_batcher.cancel(id_task):
+            return {}
+
+        if id_task == progress.current_task or id_task in self.txt2img_batcher.running:
+            shared.state.interrupt()
+            return {}
+
+        raise HTTPException(status_code=404, detail=f"Task {id_task} is neither queued nor running")
 
     def extras_single_image_api(self, req: models.ExtrasSingleImageRequest):
         reqDict = setUpscalers(req)
@@ -430,7 +815,7 @@ class Api:
         with self.queue_lock:
             result = postprocessing.run_extras(extras_mode=1, image_folder=image_folder, image="", input_dir="", output_dir="", save_output=False, **reqDict)
 
-        return models.ExtrasBatchImagesResponse(images=list(map(encode_pil_to_base64, result[0])), html_info=result[1])
+        return models.ExtrasBatchImagesResponse(images=encode_images(result[0]), html_info=result[1])
 
     def pnginfoapi(self, req: models.PNGInfoRequest):
         if(not req.image.strip()):
@@ -454,19 +839,7 @@ class Api:
         if shared.state.job_count == 0:
             return models.ProgressResponse(progress=0, eta_relative=0, state=shared.state.dict(), textinfo=shared.state.textinfo)
 
-        # avoid dividing zero
-        progress = 0.01
-
-        if shared.state.job_count > 0:
-            progress += shared.state.job_no / shared.state.job_count
-        if shared.state.sampling_steps > 0:
-            progress += 1 / shared.state.job_count * shared.state.sampling_step / shared.state.sampling_steps
-
-        time_since_start = time.time() - shared.state.time_start
-        eta = (time_since_start/progress)
-        eta_relative = eta-time_since_start
-
-        progress = min(progress, 1)
+        progress, eta_relative = get_job_progress()
 
         shared.state.set_current_image()
 
@@ -476,6 +849,27 @@ class Api:
 
         return models.ProgressResponse(progress=progress, eta_relative=eta_relative, state=shared.state.dict(), current_image=current_image, textinfo=shared.state.textinfo)
 
+    def get_queue(self):
+        return {**self.queue_lock.snapshot(), "draining": shared.state.draining}
+
+    def get_hashing_status(self):
+        return hashes.status()
+
+    def cancel_queued_job(self, req: models.QueueCancelRequest):
+        if not self.queue_lock.cancel(req.id_job):
+            raise HTTPException(status_code=404, detail=f"Job {req.id_job} is not in queue")
+
+        return {}
+
+    def collect_queue_metrics(self):
+        snapshot = self.queue_lock.snapshot()
+        for name, depth in snapshot["depth"].items():
+            metrics.queue_depth.set(depth, priority=name)
+        metrics.queue_oldest_wait_seconds.set(snapshot["oldest_wait"])
+
+    def get_metrics(self):
+        return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
     def interrogateapi(self, interrogatereq: models.InterrogateRequest):
         image_b64 = interrogatereq.image
         if image_b64 is None:
@@ -562,7 +956,12 @@ class Api:
         ]
 
     def get_sd_models(self):
-        return [{"title": x.title, "model_name": x.model_name, "hash": x.shorthash, "sha256": x.sha256, "filename": x.filename, "config": find_checkpoint_config_near_filename(x)} for x in checkpoints_list.values()]
+        res = []
+        for x in checkpoints_list.values():
+            layout = checkpoint_layout(x)
+            res.append({"title": x.title, "model_name": x.model_name, "hash": x.shorthash, "sha256": x.sha256, "filename": x.filename, "config": find_checkpoint_config_near_filename(x), "architecture": architecture_name(layout)})
+
+        return res
 
     def get_sd_vaes(self):
         return [{"model_name": x, "filename": vae_dict[x]} for x in vae_dict.keys()]
@@ -740,3 +1139,39 @@ class Api:
         shared.state.server_command = "stop"
         return Response("Stopping.")
 
+    def drain_webui(self, req: models.DrainRequest):
+        if req.restart and not restart.is_restartable():
+            return Response(status_code=501)
+
+        shared.state.draining = True
+        threading.Thread(target=self.drain, args=(req.restart, req.timeout), name="drain", daemon=True).start()
+
+        return Response("Draining.")
+
+    def drain(self, restart_afterwards, timeout):
+        """
+        Waits for running and queued jobs to finish, then restarts or stops the server. Tasks that are still queued
+        when timeout expires are kept in task journal and submitted again once the server is back.
+        """
+
+        deadline = time.time() + timeout if timeout is not None else None
+
+        while True:
+            remaining = max(deadline - time.time(), 0) if deadline is not None else None
+            idle = self.queue_lock.wait_until_idle(remaining)
+
+            # batches that are still collecting requests are put into queue a moment later
+            if idle and not self.txt2img_batcher.groups:
+                break
+
+            if deadline is not None and time.time() >= deadline:
+                print("Drain timeout expired; remaining queued tasks will be restored after restart.")
+                break
+
+            time.sleep(0.1)
+
+        if restart_afterwards:
+            restart.restart_program()
+        else:
+            restart.stop_program()
+
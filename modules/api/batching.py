@@ -0,0 +1,218 @@
+import copy
+import json
+import threading
+import uuid
+from concurrent.futures import Future
+
+from modules import progress
+from modules.processing import get_fixed_seed
+from modules.shared import opts
+
+per_image_args = ("prompt", "negative_prompt", "seed", "subseed")
+
+
+class BatchMember:
+    def __init__(self, args, script_args, id_task=None):
+        self.args = args
+        self.script_args = script_args
+        self.id_task = id_task
+        self.future = Future()
+
+
+class BatchGroup:
+    def __init__(self, key, client, priority):
+        self.key = key
+        self.client = client
+        self.priority = priority
+        self.id_job = f"batch({uuid.uuid4().hex})"
+        self.members = []
+        self.submitted = False
+        self.started = False
+        self.timer = None
+
+
+class Txt2ImgBatcher:
+    """
+    Merges compatible single-image txt2img requests that arrive close to each other into one batch, using the per-image
+    all_prompts/all_seeds lists of StableDiffusionProcessing, and splits the result back for each request.
+
+    Requests are compatible if all their generation parameters except prompt, negative prompt and seeds are equal.
+    A group is put into the job queue after opts.api_batching_window milliseconds or once it is full, and it keeps
+    accepting requests while it waits in the queue.
+    """
+
+    def __init__(self, queue_lock, process):
+        self.queue_lock = queue_lock
+        self.process = process
+        self.lock = threading.Lock()
+        self.groups = {}
+        self.pending = {}
+        self.running = set()
+
+    @staticmethod
+    def is_batchable(req, args):
+        if not opts.api_batching_enabled:
+            return False
+
+        if req.script_name or req.alwayson_scripts:
+            return False
+
+        return args.get("batch_size") == 1 and args.get("n_iter") == 1 and isinstance(args.get("prompt"), str)
+
+    @staticmethod
+    def batch_key(args, priority):
+        shared_args = {k: v for k, v in args.items() if k not in per_image_args}
+        return json.dumps([shared_args, priority], sort_keys=True, default=str)
+
+    def add(self, args, script_args, client, priority, id_task=None):
+        """adds a request to a batch; returns a Future that resolves to the request's own Processed object"""
+
+        member = BatchMember(args, script_args, id_task)
+        key = self.batch_key(args, priority)
+
+        with self.lock:
+            group = self.groups.get(key)
+            if group is None:
+                group = BatchGroup(key, client, priority)
+                self.groups[key] = group
+
+            group.members.append(member)
+            if id_task is not None:
+                self.pending[id_task] = group
+
+            full = len(group.members) >= opts.api_batching_max_batch_size
+
+            if full:
+                del self.groups[key]
+
+            if full and not group.submitted:
+                if group.timer is not None:
+                    group.timer.cancel()
+                self.submit_group(group)
+            elif group.timer is None and not group.submitted:
+                group.timer = threading.Timer(opts.api_batching_window / 1000, self.on_window_elapsed, args=(group, ))
+                group.timer.daemon = True
+                group.timer.start()
+
+        return member.future
+
+    def on_window_elapsed(self, group):
+        with self.lock:
+            if not group.submitted:
+                self.submit_group(group)
+
+    def submit_group(self, group):
+        group.submitted = True
+        checkpoint = (group.members[0].args.get("override_settings") or {}).get("sd_model_checkpoint")
+        self.queue_lock.submit(lambda: self.run_group(group), id_job=group.id_job, client=group.client, priority=group.priority, description="txt2img (batched)", on_cancel=lambda: self.on_group_cancelled(group), checkpoint=checkpoint)
+
+    def forget_group(self, group):
+        """must be called with self.lock held"""
+
+        if self.groups.get(group.key) is group:
+            del self.groups[group.key]
+
+        for member in group.members:
+            if member.id_task is not None and self.pending.get(member.id_task) is group:
+                del self.pending[member.id_task]
+
+    def on_group_cancelled(self, group):
+        with self.lock:
+            self.forget_group(group)
+
+        for member in group.members:
+            member.future.cancel()
+
+    def cancel(self, id_task):
+        """removes a task from a batch that has not started yet, including full batches waiting in the queue; returns True if it was found"""
+
+        with self.lock:
+            group = self.pending.pop(id_task, None)
+            if group is None or group.started:
+                return False
+
+            member = next((x for x in group.members if x.id_task == id_task), None)
+            if member is None:
+                return False
+
+            group.members.remove(member)
+            member.future.cancel()
+            return True
+
+    def run_group(self, group):
+        with self.lock:
+            group.started = True
+            self.forget_group(group)
+
+            members = [x for x in group.members if x.future.set_running_or_notify_cancel()]
+
+        if not members:
+            return
+
+        args = dict(members[0].args)
+        args["prompt"] = [x.args["prompt"] for x in members]
+        args["negative_prompt"] = [x.args["negative_prompt"] or "" for x in members]
+        args["seed"] = [int(get_fixed_seed(x.args["seed"])) for x in members]
+        args["subseed"] = [int(get_fixed_seed(x.args["subseed"])) for x in members]
+        args["batch_size"] = len(members)
+        args["do_not_save_grid"] = True
+
+        task_ids = [x.id_task for x in members if x.id_task is not None]
+        for id_task in task_ids:
+            progress.start_task(id_task)
+
+        with self.lock:
+            self.running.update(task_ids)
+
+        try:
+            # a merged batch is never going to be requested again as a whole, so it's not worth keeping in output cache
+            processed = self.process(args, members[0].script_args, None, use_output_cache=False)
+
+            for i, member in enumerate(members):
+                try:
+                    member.future.set_result(split_processed(processed, i, len(members)))
+                except BatchSplitError as e:
+                    member.future.set_exception(e)
+        except Exception as e:
+            for member in members:
+                if not member.future.done():
+                    member.future.set_exception(e)
+        finally:
+            with self.lock:
+                self.running.difference_update(task_ids)
+
+            for id_task in task_ids:
+                progress.finish_task(id_task)
+
+
+class BatchSplitError(RuntimeError):
+    pass
+
+
+def split_processed(processed, index, count):
+    """
+    Returns a copy of Processed object from a merged batch that only contains the results of index-th request.
+    Raises BatchSplitError if the results can't be attributed to requests, rather than giving anyone images of others.
+    """
+
+    images = processed.images[processed.index_of_first_image:]
+    infotexts = processed.infotexts[processed.index_of_first_image:]
+    if len(images) != count or len(processed.all_prompts) != count or len(processed.all_seeds) != count:
+        raise BatchSplitError(f"batched generation produced {len(images)} images for {count} requests")
+
+    res = copy.copy(processed)
+    res.images = [images[index]]
+    res.infotexts = [infotexts[index]] if index < len(infotexts) else []
+    res.info = res.infotexts[0] if res.infotexts else ""
+    res.index_of_first_image = 0
+    res.batch_size = 1
+    res.all_prompts = [processed.all_prompts[index]]
+    res.all_negative_prompts = [processed.all_negative_prompts[index]]
+    res.all_seeds = [processed.all_seeds[index]]
+    res.all_subseeds = [processed.all_subseeds[index]]
+    res.prompt = res.all_prompts[0]
+    res.negative_prompt = res.all_negative_prompts[0]
+    res.seed = res.all_seeds[0]
+    res.subseed = res.all_subseeds[0]
+
+    return res
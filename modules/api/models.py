@@ -108,6 +108,10 @@ StableDiffusionTxt2ImgProcessingAPI = PydanticModelGenerator(
         {"key": "send_images", "type": bool, "default": True},
         {"key": "save_images", "type": bool, "default": False},
         {"key": "alwayson_scripts", "type": dict, "default": {}},
+        {"key": "priority", "type": str, "default": None},
+        {"key": "response_format", "type": str, "default": "json"},
+        {"key": "image_format", "type": str, "default": None},
+        {"key": "png_compress_level", "type": int, "default": None},
     ]
 ).generate_model()
 
@@ -125,16 +129,22 @@ StableDiffusionImg2ImgProcessingAPI = PydanticModelGenerator(
         {"key": "send_images", "type": bool, "default": True},
         {"key": "save_images", "type": bool, "default": False},
         {"key": "alwayson_scripts", "type": dict, "default": {}},
+        {"key": "priority", "type": str, "default": None},
+        {"key": "response_format", "type": str, "default": "json"},
+        {"key": "image_format", "type": str, "default": None},
+        {"key": "png_compress_level", "type": int, "default": None},
     ]
 ).generate_model()
 
 class TextToImageResponse(BaseModel):
     images: List[str] = Field(default=None, title="Image", description="The generated image in base64 format.")
+    files: Optional[List[str]] = Field(default=None, title="Files", description="Paths to generated images that were saved to disk; only with response_format=files, which requires save_images.")
     parameters: dict
     info: str
 
 class ImageToImageResponse(BaseModel):
     images: List[str] = Field(default=None, title="Image", description="The generated image in base64 format.")
+    files: Optional[List[str]] = Field(default=None, title="Files", description="Paths to generated images that were saved to disk; only with response_format=files, which requires save_images.")
     parameters: dict
     info: str
 
@@ -251,6 +261,7 @@ class SDModelItem(BaseModel):
     sha256: Optional[str] = Field(title="sha256 hash")
     filename: str = Field(title="Filename")
     config: Optional[str] = Field(title="Config file")
+    architecture: Optional[str] = Field(title="Architecture", description="sd1, sd2 or sdxl, if it's known without reading the checkpoint's weights")
 
 class SDVaeItem(BaseModel):
     model_name: str = Field(title="Model Name")
@@ -310,3 +321,51 @@ class ScriptInfo(BaseModel):
     is_alwayson: bool = Field(default=None, title="IsAlwayson", description="Flag specifying whether this script is an alwayson script")
     is_img2img: bool = Field(default=None, title="IsImg2img", description="Flag specifying whether this script is an img2img script")
     args: List[ScriptArg] = Field(title="Arguments", description="List of script's arguments")
+
+
+class QueueJobItem(BaseModel):
+    id_job: str = Field(title="Job ID")
+    client: str = Field(title="Client", description="Identifier of the client that submitted the job")
+    priority: int = Field(title="Priority", description="Priority class of the job; lower runs first")
+    description: Optional[str] = Field(default=None, title="Description")
+    waiting: float = Field(title="Waiting", description="Time spent in queue, in seconds")
+    running: Optional[float] = Field(default=None, title="Running", description="Time since the job started, in seconds")
+
+
+class QueueStatusResponse(BaseModel):
+    current: Optional[QueueJobItem] = Field(default=None, title="Current", description="Job that is running right now")
+    waiting: List[QueueJobItem] = Field(title="Waiting", description="Queued jobs, in the order they are going to run")
+    depth: Dict[str, int] = Field(title="Depth", description="Number of queued jobs for each priority class")
+    oldest_wait: float = Field(title="Oldest wait", description="Time the longest waiting job has spent in queue, in seconds")
+    average_wait: float = Field(title="Average wait", description="Average time recently started jobs have spent in queue, in seconds")
+    draining: bool = Field(default=False, title="Draining", description="Whether the server has stopped accepting new jobs because it is going to restart or stop")
+
+
+class HashingJobItem(BaseModel):
+    filename: str = Field(title="Filename")
+    title: str = Field(title="Title", description="Name of the file's entry in hash cache")
+    priority: int = Field(title="Priority", description="Files with lower value are hashed first")
+    running: bool = Field(title="Running", description="Whether the file is being hashed right now")
+    progress: float = Field(title="Progress", description="Part of the file that has been hashed, from 0 to 1")
+
+
+class DrainRequest(BaseModel):
+    restart: bool = Field(default=True, title="Restart", description="Restart the server once all jobs are done; otherwise stop it")
+    timeout: Optional[float] = Field(default=None, title="Timeout", description="Longest time to wait for jobs to finish, in seconds; tasks submitted with /submit endpoints that are still queued are restored after restart")
+
+
+class QueueCancelRequest(BaseModel):
+    id_job: str = Field(title="Job ID", description="ID of the queued job to remove from queue")
+
+
+class TaskSubmitResponse(BaseModel):
+    id_task: str = Field(title="Task ID", description="Use this ID to query status and result of the task")
+
+
+class TaskStatusResponse(BaseModel):
+    id_task: str = Field(title="Task ID")
+    status: Literal["queued", "running", "done", "failed", "cancelled"] = Field(title="Status")
+    queue_position: Optional[int] = Field(default=None, title="Queue position", description="Number of jobs that will run before this one; only for queued tasks")
+    progress: Optional[float] = Field(default=None, title="Progress", description="The progress with a range of 0 to 1; only for running tasks")
+    eta_relative: Optional[float] = Field(default=None, title="ETA in secs", description="Only for running tasks")
+    error: Optional[str] = Field(default=None, title="Error", description="Description of the error for failed tasks")
@@ -0,0 +1,72 @@
+import hashlib
+import json
+import os
+import time
+
+from modules import errors
+from modules.paths import data_path
+from modules.shared import opts
+
+journal_dir = os.path.join(data_path, "cache", "queue")
+
+
+def filename(id_task):
+    return os.path.join(journal_dir, hashlib.sha256(id_task.encode("utf8")).hexdigest() + ".json")
+
+
+def save(id_task, kind, client, priority, request):
+    """writes the request of a submitted task to disk, so that it can be submitted again if the server stops before the task is done"""
+
+    if not opts.api_queue_persist:
+        return
+
+    entry = {
+        "id_task": id_task,
+        "kind": kind,
+        "client": client,
+        "priority": priority,
+        "time": time.time(),
+        "request": request,
+    }
+
+    path = filename(id_task)
+
+    try:
+        os.makedirs(journal_dir, exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf8") as file:
+            json.dump(entry, file, default=str)
+        os.replace(path + ".tmp", path)
+    except Exception as e:
+        errors.display_once(e, "saving queued task to disk")
+
+
+def remove(id_task):
+    try:
+        os.remove(filename(id_task))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        errors.display_once(e, "removing queued task from disk")
+
+
+def load():
+    """returns all saved tasks, oldest first"""
+
+    if not os.path.isdir(journal_dir):
+        return []
+
+    entries = []
+    for name in os.listdir(journal_dir):
+        if not name.endswith(".json"):
+            continue
+
+        path = os.path.join(journal_dir, name)
+
+        try:
+            with open(path, "r", encoding="utf8") as file:
+                entries.append(json.load(file))
+        except Exception as e:
+            errors.display(e, f"reading queued task from {path}")
+            os.remove(path)
+
+    return sorted(entries, key=lambda x: x.get("time", 0))
@@ -1,45 +1,122 @@
+import collections.abc
 import json
 import os.path
+import sqlite3
 import threading
-import time
 
 from modules.paths import data_path, script_path
 
 cache_filename = os.path.join(data_path, "cache.json")
-cache_data = None
+cache_db_filename = os.path.join(data_path, "cache.db")
+cache_db = None
 cache_lock = threading.Lock()
+db_lock = threading.Lock()
+sections = {}
 
-dump_cache_after = None
-dump_cache_thread = None
 
+def import_json_cache(db):
+    """copies entries from cache.json used by previous versions into the database"""
 
-def dump_cache():
+    if not os.path.isfile(cache_filename):
+        return
+
+    try:
+        with open(cache_filename, "r", encoding="utf8") as file:
+            data = json.load(file)
+    except Exception:
+        os.replace(cache_filename, os.path.join(script_path, "tmp", "cache.json"))
+        print('[ERROR] issue occurred while trying to read cache.json, move current cache to tmp/cache.json and create new cache')
+        return
+
+    rows = [(subsection, key, json.dumps(value)) for subsection, entries in data.items() if isinstance(entries, dict) for key, value in entries.items()]
+
+    db.execute("BEGIN")
+    db.executemany("INSERT OR REPLACE INTO cache (subsection, key, value) VALUES (?, ?, ?)", rows)
+    db.execute("COMMIT")
+
+
+def open_cache_db():
+    is_new = not os.path.exists(cache_db_filename)
+
+    db = sqlite3.connect(cache_db_filename, timeout=30, check_same_thread=False, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("CREATE TABLE IF NOT EXISTS cache (subsection TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (subsection, key)) WITHOUT ROWID")
+
+    if is_new:
+        import_json_cache(db)
+
+    return db
+
+
+def get_cache_db():
+    global cache_db
+
+    if cache_db is None:
+        with cache_lock:
+            if cache_db is None:
+                try:
+                    cache_db = open_cache_db()
+                except sqlite3.DatabaseError:
+                    os.replace(cache_db_filename, os.path.join(script_path, "tmp", "cache.db"))
+                    print('[ERROR] issue occurred while trying to read cache.db, move current cache to tmp/cache.db and create new cache')
+                    cache_db = open_cache_db()
+
+    return cache_db
+
+
+def execute(sql, params=()):
+    db = get_cache_db()
+
+    with db_lock:
+        return db.execute(sql, params).fetchall()
+
+
+class CacheSection(collections.abc.MutableMapping):
     """
-    Marks cache for writing to disk. 5 seconds after no one else flags the cache for writing, it is written.
+    Dict-like view of one subsection of the cache. Every read and write goes to the database, so only the entries
+    that are used are ever loaded, and each change is written on its own instead of rewriting the whole cache.
     """
 
-    global dump_cache_after
-    global dump_cache_thread
+    def __init__(self, subsection):
+        self.subsection = subsection
 
-    def thread_func():
-        global dump_cache_after
-        global dump_cache_thread
+    def __getitem__(self, key):
+        rows = execute("SELECT value FROM cache WHERE subsection = ? AND key = ?", (self.subsection, key))
+        if not rows:
+            raise KeyError(key)
 
-        while dump_cache_after is not None and time.time() < dump_cache_after:
-            time.sleep(1)
+        return json.loads(rows[0][0])
 
-        with cache_lock:
-            with open(cache_filename, "w", encoding="utf8") as file:
-                json.dump(cache_data, file, indent=4)
+    def __setitem__(self, key, value):
+        execute("INSERT OR REPLACE INTO cache (subsection, key, value) VALUES (?, ?, ?)", (self.subsection, key, json.dumps(value)))
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+
+        execute("DELETE FROM cache WHERE subsection = ? AND key = ?", (self.subsection, key))
+
+    def __contains__(self, key):
+        return bool(execute("SELECT 1 FROM cache WHERE subsection = ? AND key = ?", (self.subsection, key)))
+
+    def __iter__(self):
+        return iter([key for key, in execute("SELECT key FROM cache WHERE subsection = ?", (self.subsection, ))])
+
+    def __len__(self):
+        return execute("SELECT COUNT(*) FROM cache WHERE subsection = ?", (self.subsection, ))[0][0]
 
-            dump_cache_after = None
-            dump_cache_thread = None
+    def items(self):
+        return [(key, json.loads(value)) for key, value in execute("SELECT key, value FROM cache WHERE subsection = ?", (self.subsection, ))]
 
-    with cache_lock:
-        dump_cache_after = time.time() + 5
-        if dump_cache_thread is None:
-            dump_cache_thread = threading.Thread(name='cache-writer', target=thread_func)
-            dump_cache_thread.start()
+    def values(self):
+        return [value for _, value in self.items()]
+
+
+def dump_cache():
+    """
+    Kept for compatibility: changes to the cache are written to disk as they are made.
+    """
 
 
 def cache(subsection):
@@ -50,27 +127,12 @@ def cache(subsection):
         subsection (str): The subsection identifier for the cache.
 
     Returns:
-        dict: The cache data for the specified subsection.
+        CacheSection: A dict-like object with the cache data for the specified subsection.
     """
 
-    global cache_data
-
-    if cache_data is None:
-        with cache_lock:
-            if cache_data is None:
-                if not os.path.isfile(cache_filename):
-                    cache_data = {}
-                else:
-                    try:
-                        with open(cache_filename, "r", encoding="utf8") as file:
-                            cache_data = json.load(file)
-                    except Exception:
-                        os.replace(cache_filename, os.path.join(script_path, "tmp", "cache.json"))
-                        print('[ERROR] issue occurred while trying to read cache.json, move current cache to tmp/cache.json and create new cache')
-                        cache_data = {}
-
-    s = cache_data.get(subsection, {})
-    cache_data[subsection] = s
+    s = sections.get(subsection)
+    if s is None:
+        s = sections.setdefault(subsection, CacheSection(subsection))
 
     return s
 
@@ -115,6 +177,4 @@ def cached_data_for_file(subsection, title, filename, func):
         entry = {'mtime': ondisk_mtime, 'value': value}
         existing_cache[title] = entry
 
-        dump_cache()
-
     return entry['value']
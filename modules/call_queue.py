@@ -1,11 +1,10 @@
 from functools import wraps
 import html
-import threading
 import time
 
-from modules import shared, progress, errors
+from modules import shared, progress, errors, job_scheduler, metrics
 
-queue_lock = threading.Lock()
+queue_lock = job_scheduler.JobScheduler()
 
 
 def wrap_queued_call(func):
@@ -21,6 +20,8 @@ def wrap_queued_call(func):
 def wrap_gradio_gpu_call(func, extra_outputs=None):
     @wraps(func)
     def f(*args, **kwargs):
+        if shared.state.draining:
+            raise RuntimeError("Server is about to restart and does not accept new jobs")
 
         # if the first argument is a string that says "task(...)", it is treated as a job id
         if args and type(args[0]) == str and args[0].startswith("task(") and args[0].endswith(")"):
@@ -29,17 +30,21 @@ def wrap_gradio_gpu_call(func, extra_outputs=None):
         else:
             id_task = None
 
-        with queue_lock:
-            shared.state.begin(job=id_task)
-            progress.start_task(id_task)
+        try:
+            with queue_lock.job(id_job=id_task, client="ui", priority=job_scheduler.PRIORITY_INTERACTIVE, description=func.__name__):
+                shared.state.begin(job=id_task)
+                progress.start_task(id_task)
 
-            try:
-                res = func(*args, **kwargs)
-                progress.record_results(id_task, res)
-            finally:
-                progress.finish_task(id_task)
+                try:
+                    res = func(*args, **kwargs)
+                    progress.record_results(id_task, res)
+                finally:
+                    progress.finish_task(id_task)
 
-            shared.state.end()
+                shared.state.end()
+        except job_scheduler.JobCancelled:
+            progress.remove_task_from_queue(id_task)
+            raise
 
         return res
 
@@ -90,7 +95,9 @@ def wrap_gradio_call(func, extra_outputs=None, add_stats=False):
             elapsed_text = f"{elapsed_m} min. "+elapsed_text
 
         if run_memmon:
-            mem_stats = {k: -(v//-(1024*1024)) for k, v in shared.mem_mon.stop().items()}
+            mem_stats = shared.mem_mon.stop()
+            metrics.observe_memory(mem_stats)
+            mem_stats = {k: -(v//-(1024*1024)) for k, v in mem_stats.items()}
             active_peak = mem_stats['active_peak']
             reserved_peak = mem_stats['reserved_peak']
             sys_peak = mem_stats['system_peak']
@@ -0,0 +1,148 @@
+import collections
+import threading
+
+import torch
+
+from modules import shared, metrics, extra_networks
+
+lock = threading.Lock()
+entries = collections.OrderedDict()
+total_bytes = 0
+
+hits = metrics.Counter("sd_cond_cache_hits_total", "Number of prompt conditionings served from conditioning cache")
+misses = metrics.Counter("sd_cond_cache_misses_total", "Number of prompt conditionings that had to be calculated")
+size_bytes = metrics.Gauge("sd_cond_cache_bytes", "Memory used by tensors in conditioning cache")
+size_entries = metrics.Gauge("sd_cond_cache_entries", "Number of conditionings in conditioning cache")
+
+
+class Entry:
+    """
+    A cached conditioning, along with what the text encoder added to infotext while calculating it, such as TI hashes.
+    Those are added again each time the entry is used, since the text encoder does not run then.
+    """
+
+    def __init__(self, cond, generation_params, comments):
+        self.cond = cond
+        self.generation_params = generation_params
+        self.comments = comments
+
+    def apply_infotext(self, hijack):
+        hijack.extra_generation_params.update(self.generation_params)
+        hijack.comments.extend(self.comments)
+
+
+def infotext_state(hijack):
+    """remembers infotext additions of the model hijack before calculating a conditioning, for make_entry()"""
+
+    return dict(hijack.extra_generation_params), len(hijack.comments)
+
+
+def make_entry(cond, hijack, state_before):
+    params_before, comments_before = state_before
+    generation_params = {k: v for k, v in hijack.extra_generation_params.items() if k not in params_before or params_before[k] != v}
+
+    return Entry(cond, generation_params, hijack.comments[comments_before:])
+
+
+def make_key(function, prompts, steps, extra_network_data, width, height):
+    """
+    Returns a key describing everything that the result of function(shared.sd_model, prompts, steps) depends on.
+    Prompts are kept as a whole because the length of each prompt's conditioning depends on other prompts in the batch.
+    Extra networks are described by their files too, so that a network replaced on disk under the same name is noticed.
+    """
+
+    model = shared.sd_model
+    checkpoint_info = model.sd_checkpoint_info
+
+    return (
+        function.__module__,
+        function.__name__,
+        tuple(prompts),
+        getattr(prompts, "is_negative_prompt", False),
+        getattr(prompts, "width", None),
+        getattr(prompts, "height", None),
+        steps,
+        checkpoint_info.filename,
+        model.sd_model_hash,
+        extra_networks.params_key(extra_network_data),
+        extra_networks.files_key(extra_network_data),
+        shared.opts.CLIP_stop_at_last_layers,
+        shared.opts.enable_emphasis,
+        shared.opts.use_old_emphasis_implementation,
+        shared.opts.comma_padding_backtrack,
+        shared.opts.sdxl_crop_left,
+        shared.opts.sdxl_crop_top,
+        shared.opts.sdxl_refiner_low_aesthetic_score,
+        shared.opts.sdxl_refiner_high_aesthetic_score,
+        shared.opts.textual_inversion_add_hashes_to_infotext,
+        width,
+        height,
+    )
+
+
+def data_size(value):
+    """bytes used by tensors in a conditioning: nested lists, dicts, namedtuples and objects from prompt_parser"""
+
+    if isinstance(value, torch.Tensor):
+        return value.nelement() * value.element_size()
+
+    if isinstance(value, (list, tuple)):
+        return sum(data_size(x) for x in value)
+
+    if isinstance(value, dict):
+        return sum(data_size(x) for x in value.values())
+
+    if hasattr(value, "__dict__"):
+        return sum(data_size(x) for x in vars(value).values())
+
+    return 0
+
+
+def get(key):
+    """returns cached Entry for the key, or None"""
+
+    if shared.opts.cond_cache_size <= 0:
+        return None
+
+    with lock:
+        res = entries.get(key)
+        if res is not None:
+            entries.move_to_end(key)
+
+    (hits if res is not None else misses).inc()
+
+    return res
+
+
+def put(key, entry):
+    global total_bytes
+
+    budget = shared.opts.cond_cache_size * 1024 * 1024
+    size = data_size(entry.cond)
+    if size > budget:
+        return
+
+    with lock:
+        if key in entries:
+            total_bytes -= data_size(entries.pop(key).cond)
+
+        entries[key] = entry
+        total_bytes += size
+
+        while total_bytes > budget and entries:
+            _, evicted = entries.popitem(last=False)
+            total_bytes -= data_size(evicted.cond)
+
+        size_bytes.set(total_bytes)
+        size_entries.set(len(entries))
+
+
+def clear():
+    global total_bytes
+
+    with lock:
+        entries.clear()
+        total_bytes = 0
+
+        size_bytes.set(0)
+        size_entries.set(0)
@@ -1,3 +1,4 @@
+import os
 import re
 from collections import defaultdict
 
@@ -6,6 +7,9 @@ from modules import errors
 extra_network_registry = {}
 extra_network_aliases = {}
 
+active_params = ()
+"""description of extra networks passed to the last activate() call, as returned by params_key() and files_key(); caches of text encoder outputs use it as a part of their keys"""
+
 
 def initialize():
     extra_network_registry.clear()
@@ -83,12 +87,58 @@ class ExtraNetwork:
 
         raise NotImplementedError
 
+    def files(self, params_list):
+        """
+        Returns filenames of files that activate() is going to read for params_list. Caches of generation results use
+        this to notice when a network was replaced on disk under the same name.
+        """
+
+        return []
+
+
+def file_identity(filename):
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return filename, None, None
+
+    return filename, stat.st_size, stat.st_mtime
+
+
+def files_key(extra_network_data):
+    """returns a hashable description of files extra networks are going to read for extra_network_data: name, size and mtime of each"""
+
+    files = set()
+
+    for name, extra_network in extra_network_registry.items():
+        aliases = [alias for alias, x in extra_network_aliases.items() if x is extra_network]
+        params_list = [params for x in [name, *aliases] for params in (extra_network_data or {}).get(x, [])]
+
+        try:
+            files.update(x for x in extra_network.files(params_list) if x)
+        except Exception as e:
+            errors.display_once(e, f"listing files of extra network {name}")
+
+    return tuple(sorted(file_identity(x) for x in files))
+
+
+def params_key(extra_network_data):
+    """returns a hashable description of extra_network_data"""
+
+    if not extra_network_data:
+        return ()
+
+    return tuple(sorted((name, tuple(tuple(str(x) for x in params.items) for params in params_list)) for name, params_list in extra_network_data.items()))
+
 
 def activate(p, extra_network_data):
     """call activate for extra networks in extra_network_data in specified order, then call
     activate for all remaining registered networks with an empty argument list"""
 
+    global active_params
+
     activated = []
+    active_params = (params_key(extra_network_data), files_key(extra_network_data))
 
     for extra_network_name, extra_network_args in extra_network_data.items():
         extra_network = extra_network_registry.get(extra_network_name, None)
@@ -123,6 +173,10 @@ def deactivate(p, extra_network_data):
     """call deactivate for extra networks in extra_network_data in specified order, then call
     deactivate for all remaining registered networks"""
 
+    global active_params
+
+    active_params = ()
+
     for extra_network_name in extra_network_data:
         extra_network = extra_network_registry.get(extra_network_name, None)
         if extra_network is None:
@@ -26,3 +26,10 @@ class ExtraNetworkHypernet(extra_networks.ExtraNetwork):
 
     def deactivate(self, p):
         pass
+
+    def files(self, params_list):
+        names = [x.items[0] for x in params_list if x.items]
+        if shared.opts.sd_hypernetwork != "None":
+            names.append(shared.opts.sd_hypernetwork)
+
+        return [shared.hypernetworks[x] for x in names if x in shared.hypernetworks]
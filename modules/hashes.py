@@ -1,66 +1,326 @@
+import concurrent.futures
 import hashlib
+import heapq
+import itertools
+import mmap
 import os.path
+import threading
 
-from modules import shared
+from modules import shared, metrics, errors
 import modules.cache
 
 dump_cache = modules.cache.dump_cache
 cache = modules.cache.cache
 
+PRIORITY_NOW = 0  # someone is waiting for the hash
+PRIORITY_SOON = 1  # the model is going to be used soon
+PRIORITY_BACKGROUND = 2
+
+read_size = 64 * 1024 * 1024
+
+hashed_bytes = metrics.Counter("sd_hashed_bytes_total", "Number of bytes of model files read for calculating hashes")
+hashing_queue_depth = metrics.Gauge("sd_hashing_queue_depth", "Number of files waiting for their hash to be calculated or being hashed")
+
+
+def file_fingerprint(filename):
+    """cheap identity of a file's contents: if none of these change, the file is assumed to have the same hash"""
+
+    stat = os.stat(filename)
+    return {"mtime": stat.st_mtime, "size": stat.st_size, "inode": stat.st_ino, "device": stat.st_dev}
+
+
+def is_unchanged(entry, fingerprint):
+    if "size" not in entry:
+        # written by an older version that only recorded mtime
+        return fingerprint["mtime"] <= entry.get("mtime", 0)
+
+    # entries written before device was recorded are compared without it
+    return all(entry.get(k) == v for k, v in fingerprint.items() if k in entry or k != "device")
+
+
+def addnet_data_offset(file):
+    file.seek(0)
+    return int.from_bytes(file.read(8), "little") + 8
+
+
+def hash_file_range(hasher, filename, offset, should_stop=None, on_progress=None):
+    """
+    Feeds contents of the file from offset to its end into hasher, reading it via mmap in large blocks.
+    Returns the offset where it stopped (less than file's size if should_stop() returned True), and file's size.
+    """
+
+    with open(filename, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if offset >= size:
+            return offset, size
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+            while offset < size:
+                end = min(offset + read_size, size)
+
+                block = view[offset:end]
+                hasher.update(block)
+                block.release()
+
+                hashed_bytes.inc(end - offset)
+                offset = end
+
+                if on_progress is not None:
+                    on_progress(offset)
+
+                if offset < size and should_stop is not None and should_stop():
+                    break
+
+    return offset, size
+
 
 def calculate_sha256(filename):
     hash_sha256 = hashlib.sha256()
-    blksize = 1024 * 1024
-
-    with open(filename, "rb") as f:
-        for chunk in iter(lambda: f.read(blksize), b""):
-            hash_sha256.update(chunk)
+    hash_file_range(hash_sha256, filename, 0)
 
     return hash_sha256.hexdigest()
 
 
+fingerprint_index = {}
+
+
+def fingerprint_key(entry):
+    return entry.get("size"), entry.get("device"), entry.get("inode"), entry.get("mtime")
+
+
+def find_by_fingerprint(cache_name, fingerprint):
+    """returns a cache entry of a file with the same fingerprint recorded under another title, e.g. if the file was renamed"""
+
+    index = fingerprint_index.get(cache_name)
+    if index is None:
+        index = {fingerprint_key(x): x for x in cache(cache_name).values() if "size" in x and x.get("sha256")}
+        fingerprint_index[cache_name] = index
+
+    return index.get(fingerprint_key(fingerprint))
+
+
+def store_sha256(cache_name, title, entry):
+    cache(cache_name)[title] = entry
+
+    index = fingerprint_index.get(cache_name)
+    if index is not None:
+        index[fingerprint_key(entry)] = entry
+
+
 def sha256_from_cache(filename, title, use_addnet_hash=False):
-    hashes = cache("hashes-addnet") if use_addnet_hash else cache("hashes")
-    ondisk_mtime = os.path.getmtime(filename)
+    cache_name = "hashes-addnet" if use_addnet_hash else "hashes"
+    fingerprint = file_fingerprint(filename)
 
-    if title not in hashes:
-        return None
+    entry = cache(cache_name).get(title)
+    if entry is None:
+        entry = find_by_fingerprint(cache_name, fingerprint)
+        if entry is None:
+            return None
+
+        store_sha256(cache_name, title, dict(entry))
 
-    cached_sha256 = hashes[title].get("sha256", None)
-    cached_mtime = hashes[title].get("mtime", 0)
+    cached_sha256 = entry.get("sha256", None)
 
-    if ondisk_mtime > cached_mtime or cached_sha256 is None:
+    if cached_sha256 is None or not is_unchanged(entry, fingerprint):
         return None
 
     return cached_sha256
 
 
-def sha256(filename, title, use_addnet_hash=False):
-    hashes = cache("hashes-addnet") if use_addnet_hash else cache("hashes")
+class HashJob:
+    def __init__(self, filename, title, use_addnet_hash, priority):
+        self.filename = filename
+        self.title = title
+        self.use_addnet_hash = use_addnet_hash
+        self.priority = priority
+        self.fingerprint = file_fingerprint(filename)
+        self.future = concurrent.futures.Future()
+        self.running = False
+        self.hasher = None
+        self.offset = 0
+
+    def run(self, should_stop):
+        """hashes the file, continuing from where previous call stopped; returns False if should_stop() interrupted it"""
+
+        if self.hasher is None:
+            self.hasher = hashlib.sha256()
+
+            if self.use_addnet_hash:
+                with open(self.filename, "rb") as file:
+                    self.offset = addnet_data_offset(file)
+
+        self.offset, size = hash_file_range(self.hasher, self.filename, self.offset, should_stop, on_progress=self.set_offset)
+
+        return self.offset >= size
+
+    def set_offset(self, offset):
+        self.offset = offset
+
+    def dict(self):
+        return {
+            "filename": self.filename,
+            "title": self.title,
+            "priority": self.priority,
+            "running": self.running,
+            "progress": self.offset / self.fingerprint["size"] if self.fingerprint["size"] else 1.0,
+        }
+
+
+jobs = {}
+job_queue = []
+job_sequence = itertools.count()
+queue_condition = threading.Condition()
+workers = []
+idle_workers = 0
+
+
+def push_job(job):
+    """must be called with queue_condition held"""
+
+    heapq.heappush(job_queue, (job.priority, next(job_sequence), job))
+    queue_condition.notify()
+
+
+def is_stale(entry):
+    """
+    tells whether a job queue entry no longer stands for waiting work: its job is running, finished, or has been queued
+    again with a different priority; such entries are left in the queue and skipped; must be called with queue_condition held
+    """
+
+    priority, _, job = entry
+    return job.running or job.future.done() or priority != job.priority or jobs.get((job.title, job.use_addnet_hash)) is not job
+
+
+def pop_job():
+    """waits for a job and returns it; must be called with queue_condition held"""
+
+    global idle_workers
+
+    while True:
+        while not job_queue:
+            idle_workers += 1
+            queue_condition.wait()
+            idle_workers -= 1
+
+        entry = heapq.heappop(job_queue)
+        if is_stale(entry):
+            continue
+
+        return entry[2]
+
+
+def has_more_urgent_job(job):
+    with queue_condition:
+        return idle_workers == 0 and any(x[0] < job.priority and not is_stale(x) for x in job_queue)
+
+
+def run_hashing_worker():
+    while True:
+        with queue_condition:
+            job = pop_job()
+            job.running = True
+
+        try:
+            finished = job.run(lambda: has_more_urgent_job(job))
+        except Exception as e:
+            with queue_condition:
+                jobs.pop((job.title, job.use_addnet_hash), None)
+                hashing_queue_depth.set(len(jobs))
+
+            job.future.set_exception(e)
+            continue
+
+        if not finished:
+            # a job with higher priority is waiting; this one continues from the same place later
+            with queue_condition:
+                job.running = False
+                push_job(job)
+
+            continue
+
+        sha256_value = job.hasher.hexdigest()
+        print(f"Calculated sha256 for {job.filename}: {sha256_value}")
+
+        store_sha256("hashes-addnet" if job.use_addnet_hash else "hashes", job.title, {**job.fingerprint, "sha256": sha256_value})
+
+        with queue_condition:
+            jobs.pop((job.title, job.use_addnet_hash), None)
+            hashing_queue_depth.set(len(jobs))
+
+        job.future.set_result(sha256_value)
+
+
+def start_workers():
+    """must be called with queue_condition held"""
+
+    count = max(1, int(shared.opts.hashing_workers))
+
+    while len(workers) < count:
+        worker = threading.Thread(target=run_hashing_worker, name=f"hashing worker {len(workers) + 1}", daemon=True)
+        workers.append(worker)
+        worker.start()
+
+
+def request(filename, title, use_addnet_hash=False, priority=PRIORITY_BACKGROUND):
+    """
+    Queues calculation of sha256 of a file on the hashing worker threads and returns a Future with the result
+    (None if hashing is disabled). Files with lower priority value are hashed first; a file that is being hashed
+    gets paused if a file with higher priority is waiting and all workers are busy.
+    """
 
     sha256_value = sha256_from_cache(filename, title, use_addnet_hash)
-    if sha256_value is not None:
-        return sha256_value
+    if sha256_value is not None or shared.cmd_opts.no_hashing:
+        future = concurrent.futures.Future()
+        future.set_result(sha256_value)
+        return future
 
-    if shared.cmd_opts.no_hashing:
-        return None
+    with queue_condition:
+        key = (title, use_addnet_hash)
+        job = jobs.get(key)
+
+        if job is None:
+            job = HashJob(filename, title, use_addnet_hash, priority)
+            jobs[key] = job
+            hashing_queue_depth.set(len(jobs))
+            push_job(job)
+        elif priority < job.priority:
+            job.priority = priority
+            if not job.running:
+                push_job(job)
 
-    print(f"Calculating sha256 for {filename}: ", end='')
-    if use_addnet_hash:
-        with open(filename, "rb") as file:
-            sha256_value = addnet_hash_safetensors(file)
-    else:
-        sha256_value = calculate_sha256(filename)
-    print(f"{sha256_value}")
+        start_workers()
 
-    hashes[title] = {
-        "mtime": os.path.getmtime(filename),
-        "sha256": sha256_value,
-    }
+    return job.future
 
-    dump_cache()
 
-    return sha256_value
+def request_in_background(filename, title, on_done, use_addnet_hash=False, priority=PRIORITY_BACKGROUND):
+    """
+    Same as request(), but instead of returning a Future, calls on_done(sha256) once the hash is known; that happens
+    right away if it's in cache, otherwise on a hashing worker thread. Errors are reported rather than raised.
+    """
+
+    def done(future):
+        try:
+            sha256_value = future.result()
+        except Exception as e:
+            errors.display(e, f"calculating sha256 for {filename}")
+            return
+
+        if sha256_value is not None:
+            on_done(sha256_value)
+
+    request(filename, title, use_addnet_hash, priority).add_done_callback(done)
+
+
+def status():
+    """returns the list of files waiting to be hashed or being hashed"""
+
+    with queue_condition:
+        return sorted([x.dict() for x in jobs.values()], key=lambda x: (not x["running"], x["priority"]))
+
+
+def sha256(filename, title, use_addnet_hash=False):
+    return request(filename, title, use_addnet_hash, priority=PRIORITY_NOW).result()
 
 
 def addnet_hash_safetensors(b):
@@ -78,4 +338,3 @@ def addnet_hash_safetensors(b):
         hash_sha256.update(chunk)
 
     return hash_sha256.hexdigest()
-
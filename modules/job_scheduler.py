@@ -0,0 +1,355 @@
+import collections
+import itertools
+import queue
+import threading
+import time
+
+from modules import shared, errors, metrics
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BATCH = 2
+
+priorities = {
+    "interactive": PRIORITY_INTERACTIVE,
+    "normal": PRIORITY_NORMAL,
+    "batch": PRIORITY_BATCH,
+}
+
+priority_names = {v: k for k, v in priorities.items()}
+
+max_tracked_clients = 1000
+"""how many clients the scheduler remembers the last service time of, for round-robin ordering"""
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class QueuedJob:
+    def __init__(self, id_job, client, priority, description, sequence, func=None, on_cancel=None, checkpoint=None):
+        self.id_job = id_job
+        self.client = client
+        self.priority = priority
+        self.description = description
+        self.sequence = sequence
+        self.time_queued = time.time()
+        self.time_started = None
+        self.cancelled = False
+        self.granted = threading.Event()
+        self.func = func
+        self.on_cancel = on_cancel
+        self.checkpoint = checkpoint
+
+    def effective_priority(self, now):
+        """priority of the job taking into account how long it has been waiting; lower is better"""
+
+        aging = shared.opts.queue_priority_aging
+        if aging <= 0:
+            return self.priority
+
+        return self.priority - int((now - self.time_queued) // aging)
+
+    def dict(self, now):
+        return {
+            "id_job": self.id_job,
+            "client": self.client,
+            "priority": self.priority,
+            "description": self.description,
+            "waiting": (self.time_started or now) - self.time_queued,
+            "running": now - self.time_started if self.time_started is not None else None,
+        }
+
+
+class JobScheduler:
+    """
+    Replacement for a plain threading.Lock guarding the GPU. Jobs waiting for the lock are served by priority class,
+    and within a class in round-robin order across clients, so a client with many queued jobs can't hold back others.
+
+    Can be used exactly like a Lock (`with queue_lock:`), in which case the job gets normal priority and an anonymous
+    client; use `with queue_lock.job(...)` to supply the details.
+    """
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._client_served = {}
+        self._served_counter = itertools.count()
+        self._recent_waits = collections.deque(maxlen=100)
+        self._dispatch = queue.Queue()
+        self._worker = None
+        self._idle = threading.Event()
+        self._idle.set()
+        self._prefetch_requested = False
+        self.current = None
+
+    def _pick_next(self):
+        now = time.time()
+        return min(self._waiting, key=lambda x: (x.effective_priority(now), self._client_served.get(x.client, -1), x.sequence))
+
+    def _grant(self, job):
+        job.time_started = time.time()
+        self._client_served.pop(job.client, None)
+        self._client_served[job.client] = next(self._served_counter)
+        self._forget_clients()
+        self._recent_waits.append(job.time_started - job.time_queued)
+        metrics.queue_wait_seconds.observe(job.time_started - job.time_queued, priority=priority_names.get(job.priority, job.priority))
+        self.current = job
+        self._idle.clear()
+        job.granted.set()
+
+        if job.func is not None:
+            self._dispatch.put(job)
+
+    def _forget_clients(self):
+        """
+        Keeps _client_served from growing without bound by dropping clients served longest ago that have nothing queued.
+        A forgotten client is treated as never served, which puts it where it would have been anyway: ahead of clients served
+        more recently. _client_served is ordered by service time because _grant re-inserts the client each time.
+        """
+
+        excess = len(self._client_served) - max_tracked_clients
+        if excess <= 0:
+            return
+
+        waiting_clients = {x.client for x in self._waiting}
+        for client in [x for x in self._client_served if x not in waiting_clients][:excess]:
+            del self._client_served[client]
+
+    def _run_submitted_jobs(self):
+        while True:
+            job = self._dispatch.get()
+
+            try:
+                job.func()
+            except Exception as e:
+                errors.display(e, f"running queued job {job.id_job}")
+            finally:
+                self.finish(job)
+
+    def _prefetch_next_checkpoint(self):
+        """lets sd_models start reading the checkpoint the next waiting job is going to switch to"""
+
+        with self._mutex:
+            if not self._waiting:
+                return
+
+            checkpoint = self._pick_next().checkpoint
+
+        if checkpoint is None:
+            return
+
+        from modules import sd_models
+
+        self._prefetch_requested = True
+
+        try:
+            sd_models.prefetch_checkpoint(sd_models.get_closet_checkpoint_match(checkpoint))
+        except Exception as e:
+            errors.display(e, f"prefetching checkpoint {checkpoint}")
+
+    def _discard_prefetched_checkpoint(self, checkpoint=None):
+        """
+        lets sd_models free weights it has read for a job that is not going to run; checkpoint is the name of
+        the checkpoint to forget, or None to forget everything because there are no jobs left
+        """
+
+        with self._mutex:
+            if not self._prefetch_requested:
+                return
+
+            jobs = self._waiting + ([self.current] if self.current is not None else [])
+            if (checkpoint is None and jobs) or any(x.checkpoint == checkpoint for x in jobs):
+                return
+
+            if checkpoint is None:
+                self._prefetch_requested = False
+
+        from modules import sd_models
+
+        try:
+            sd_models.discard_prefetch(sd_models.get_closet_checkpoint_match(checkpoint) if checkpoint is not None else None)
+        except Exception as e:
+            errors.display(e, "discarding prefetched checkpoint")
+
+    def enqueue(self, id_job=None, client=None, priority=PRIORITY_NORMAL, description=None, func=None, on_cancel=None, checkpoint=None):
+        """checkpoint is the name of the checkpoint the job is going to use, if it's different from current one"""
+
+        sequence = next(self._sequence)
+        job = QueuedJob(id_job or f"job({sequence})", client or "", priority, description, sequence, func=func, on_cancel=on_cancel, checkpoint=checkpoint)
+
+        with self._mutex:
+            if func is not None and self._worker is None:
+                self._worker = threading.Thread(target=self._run_submitted_jobs, name="JobScheduler", daemon=True)
+                self._worker.start()
+
+            if self.current is None and not self._waiting:
+                self._grant(job)
+            else:
+                self._waiting.append(job)
+
+        if checkpoint is not None:
+            self._prefetch_next_checkpoint()
+
+        return job
+
+    def submit(self, func, id_job=None, client=None, priority=PRIORITY_NORMAL, description=None, on_cancel=None, checkpoint=None):
+        """
+        Queues func to be called once the job's turn comes, and returns immediately. All submitted jobs are run
+        one after another by a single worker thread, so queued jobs don't hold any threads while they wait.
+        on_cancel is called if the job gets cancelled before it starts.
+        """
+
+        return self.enqueue(id_job, client, priority, description, func=func, on_cancel=on_cancel, checkpoint=checkpoint)
+
+    def wait(self, job, timeout=None):
+        """waits until job is allowed to run; returns False if it timed out or was cancelled before that"""
+
+        if not job.granted.wait(timeout):
+            with self._mutex:
+                if not job.granted.is_set():
+                    if job in self._waiting:
+                        self._waiting.remove(job)
+                    return False
+
+        return not job.cancelled
+
+    def finish(self, job):
+        with self._mutex:
+            if self.current is not job:
+                return
+
+            self.current = None
+            idle = not self._waiting
+            if idle:
+                self._idle.set()
+            else:
+                next_job = self._pick_next()
+                self._waiting.remove(next_job)
+                self._grant(next_job)
+
+        if idle:
+            self._discard_prefetched_checkpoint()
+        else:
+            self._prefetch_next_checkpoint()
+
+    def cancel(self, id_job):
+        """removes a job that is still waiting from the queue; returns True if it was found"""
+
+        with self._mutex:
+            job = next((x for x in self._waiting if x.id_job == id_job), None)
+            if job is None:
+                return False
+
+            self._waiting.remove(job)
+            job.cancelled = True
+            job.granted.set()
+
+        if job.on_cancel is not None:
+            job.on_cancel()
+
+        if job.checkpoint is not None:
+            self._discard_prefetched_checkpoint(job.checkpoint)
+
+        return True
+
+    def wait_until_idle(self, timeout=None):
+        """waits until there is no running job and nothing in queue; returns False if timeout expired before that"""
+
+        return self._idle.wait(timeout)
+
+    def job(self, id_job=None, client=None, priority=PRIORITY_NORMAL, description=None, checkpoint=None):
+        return ScheduledJob(self, id_job, client, priority, description, checkpoint)
+
+    def position(self, id_job):
+        """returns how many jobs will run before the job with specified id, or None if it's not queued"""
+
+        with self._mutex:
+            if not any(x.id_job == id_job for x in self._waiting):
+                return None
+
+            return next(i for i, x in enumerate(self._scheduled_order()) if x.id_job == id_job)
+
+    def _scheduled_order(self):
+        now = time.time()
+        served = dict(self._client_served)
+        order = []
+        pending = list(self._waiting)
+        counter = max(served.values(), default=0)
+
+        while pending:
+            job = min(pending, key=lambda x: (x.effective_priority(now), served.get(x.client, -1), x.sequence))
+            pending.remove(job)
+            counter += 1
+            served[job.client] = counter
+            order.append(job)
+
+        return order
+
+    def snapshot(self):
+        now = time.time()
+        with self._mutex:
+            current = self.current.dict(now) if self.current is not None else None
+            waiting = [x.dict(now) for x in self._scheduled_order()]
+            recent_waits = list(self._recent_waits)
+
+        depth = {name: sum(1 for x in waiting if x["priority"] == value) for name, value in priorities.items()}
+
+        return {
+            "current": current,
+            "waiting": waiting,
+            "depth": depth,
+            "oldest_wait": max((x["waiting"] for x in waiting), default=0),
+            "average_wait": sum(recent_waits) / len(recent_waits) if recent_waits else 0,
+        }
+
+    def acquire(self, blocking=True, timeout=-1):
+        if not blocking:
+            with self._mutex:
+                if self.current is not None or self._waiting:
+                    return False
+
+                sequence = next(self._sequence)
+                self._grant(QueuedJob(f"job({sequence})", "", PRIORITY_NORMAL, None, sequence))
+                return True
+
+        job = self.enqueue()
+        return self.wait(job, timeout if timeout >= 0 else None)
+
+    def release(self):
+        with self._mutex:
+            job = self.current
+
+        if job is None:
+            raise RuntimeError("release unlocked lock")
+
+        self.finish(job)
+
+    def locked(self):
+        return self.current is not None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class ScheduledJob:
+    def __init__(self, scheduler, id_job, client, priority, description, checkpoint=None):
+        self.scheduler = scheduler
+        self.args = (id_job, client, priority, description)
+        self.checkpoint = checkpoint
+        self.job = None
+
+    def __enter__(self):
+        self.job = self.scheduler.enqueue(*self.args, checkpoint=self.checkpoint)
+        if not self.scheduler.wait(self.job):
+            raise JobCancelled(f"job {self.job.id_job} was cancelled")
+
+        return self.job
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.scheduler.finish(self.job)
@@ -2,6 +2,7 @@ import threading
 import time
 from collections import defaultdict
 
+import psutil
 import torch
 
 
@@ -33,6 +34,9 @@ class MemUsageMonitor(threading.Thread):
         index = self.device.index if self.device.index is not None else torch.cuda.current_device()
         return torch.cuda.mem_get_info(index)
 
+    def ram_usage(self):
+        return psutil.Process().memory_info().rss
+
     def run(self):
         if self.disabled:
             return
@@ -48,10 +52,12 @@ class MemUsageMonitor(threading.Thread):
                 continue
 
             self.data["min_free"] = self.cuda_mem_get_info()[0]
+            self.data["ram_peak"] = self.ram_usage()
 
             while self.run_flag.is_set():
                 free, total = self.cuda_mem_get_info()
                 self.data["min_free"] = min(self.data["min_free"], free)
+                self.data["ram_peak"] = max(self.data["ram_peak"], self.ram_usage())
 
                 time.sleep(1 / self.opts.memmon_poll_rate)
 
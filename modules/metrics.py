@@ -0,0 +1,131 @@
+import threading
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+rate_buckets = (0.5, 1.0, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 20.0, 30.0, 50.0, 100.0)
+bytes_buckets = tuple(2 ** x for x in range(28, 38))
+
+registry = []
+collectors = []
+
+
+def format_labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+
+    escaped = [(k, str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for k, v in items]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.lock = threading.Lock()
+        self.values = {}
+
+        registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+        with self.lock:
+            items = sorted(self.values.items())
+
+        for labels, value in items:
+            lines += self.render_value(labels, value)
+
+        return lines
+
+    def render_value(self, labels, value):
+        return [f"{self.name}{format_labels(labels)} {value}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets=default_buckets):
+        super().__init__(name, documentation)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0, 0))
+            counts = [c + (1 if value <= bucket else 0) for c, bucket in zip(counts, self.buckets)]
+            self.values[key] = (counts, total + value, count + 1)
+
+    def render_value(self, labels, value):
+        counts, total, count = value
+        lines = [f"{self.name}_bucket{format_labels(labels, ('le', bucket))} {c}" for bucket, c in zip(self.buckets, counts)]
+        lines.append(f"{self.name}_bucket{format_labels(labels, ('le', '+Inf'))} {count}")
+        lines.append(f"{self.name}_sum{format_labels(labels)} {total}")
+        lines.append(f"{self.name}_count{format_labels(labels)} {count}")
+        return lines
+
+
+def observe_timer(histogram, timer, **labels):
+    """adds time of every top-level category recorded in a modules.timer.Timer to histogram, using category as the stage label"""
+
+    for category, time_taken in timer.records.items():
+        if '/' not in category:
+            histogram.observe(time_taken, stage=category, **labels)
+
+    histogram.observe(timer.total, stage="total", **labels)
+
+
+def observe_memory(mem_stats):
+    """records peak memory usage from stats returned by MemUsageMonitor.stop()"""
+
+    for kind in ("active_peak", "reserved_peak", "system_peak", "ram_peak"):
+        value = mem_stats.get(kind)
+        if value:
+            memory_peak_bytes.observe(value, kind=kind[:-5])
+            memory_last_peak_bytes.set(value, kind=kind[:-5])
+
+
+def register_collector(func):
+    """func is called every time metrics are rendered, and can be used to update gauges that are cheap to compute on demand"""
+
+    collectors.append(func)
+
+
+def render():
+    for func in collectors:
+        func()
+
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+
+    return "\n".join(lines) + "\n"
+
+
+queue_wait_seconds = Histogram("sd_queue_wait_seconds", "Time jobs spent waiting in queue before starting")
+queue_depth = Gauge("sd_queue_depth", "Number of jobs waiting in queue")
+queue_oldest_wait_seconds = Gauge("sd_queue_oldest_wait_seconds", "Time the longest waiting job has spent in queue")
+generation_stage_seconds = Histogram("sd_generation_stage_seconds", "Time spent in each stage of image generation, per process_images call")
+sampling_iterations_per_second = Histogram("sd_sampling_iterations_per_second", "Sampling speed, in sampling steps per second for the whole batch", buckets=rate_buckets)
+model_load_seconds = Histogram("sd_model_load_seconds", "Time spent in each stage of loading or switching a checkpoint")
+memory_peak_bytes = Histogram("sd_memory_peak_bytes", "Peak memory usage during a job", buckets=bytes_buckets)
+memory_last_peak_bytes = Gauge("sd_memory_last_peak_bytes", "Peak memory usage during the last job")
+images_generated = Counter("sd_images_generated_total", "Number of images produced by process_images")
@@ -0,0 +1,206 @@
+import collections
+import copy
+import hashlib
+import json
+import os
+import threading
+
+from PIL import Image
+
+from modules import shared, sd_vae, metrics, scripts, extra_networks
+
+# attributes of StableDiffusionProcessing that are either not parameters of generation or are covered by other parts of the key
+ignored_attributes = {
+    "sd_model", "scripts", "sampler", "outpath_samples", "outpath_grids", "do_not_save_samples", "do_not_save_grid",
+    "cached_c", "cached_uc", "cached_hr_c", "cached_hr_uc", "c", "uc", "hr_c", "hr_uc",
+    "extra_network_data", "hr_extra_network_data", "iteration", "batch_index", "user", "override_settings_restore_afterwards",
+    "do_not_reload_embeddings", "use_output_cache",
+}
+
+# script hooks that run while generating, which does not happen for cached results
+generation_hooks = ("before_process_batch", "after_extra_networks_activate", "process_batch", "postprocess_batch", "postprocess_batch_list", "postprocess_image", "before_hr")
+
+lock = threading.Lock()
+entries = collections.OrderedDict()
+total_bytes = 0
+
+hits = metrics.Counter("sd_output_cache_hits_total", "Number of generations served from output cache")
+misses = metrics.Counter("sd_output_cache_misses_total", "Number of cacheable generations that were not in output cache")
+size_bytes = metrics.Gauge("sd_output_cache_bytes", "Approximate memory used by images in output cache")
+size_entries = metrics.Gauge("sd_output_cache_entries", "Number of results in output cache")
+
+
+class Unkeyable(Exception):
+    pass
+
+
+def image_hash(image):
+    return f"{image.mode}:{image.width}x{image.height}:{hashlib.sha256(image.tobytes()).hexdigest()}"
+
+
+def key_value(value):
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+
+    if isinstance(value, (list, tuple)):
+        return [key_value(x) for x in value]
+
+    if isinstance(value, dict):
+        return {str(k): key_value(v) for k, v in value.items()}
+
+    if isinstance(value, Image.Image):
+        return image_hash(value)
+
+    raise Unkeyable(type(value).__name__)
+
+
+def file_identity(filename):
+    if not filename or not os.path.exists(filename):
+        return filename
+
+    stat = os.stat(filename)
+    return f"{filename}:{stat.st_size}:{stat.st_mtime}"
+
+
+def is_deterministic(p):
+    seeds = p.seed if isinstance(p.seed, list) else [p.seed]
+    if any(x is None or x == -1 for x in seeds):
+        return False
+
+    subseeds = p.subseed if isinstance(p.subseed, list) else [p.subseed]
+    if p.subseed_strength != 0 and any(x is None or x == -1 for x in subseeds):
+        return False
+
+    return True
+
+
+def uses_generation_hooks(script_runner):
+    """whether any always-on script implements hooks that would be skipped if the result came from cache"""
+
+    return any(getattr(type(script), name) is not getattr(scripts.Script, name) for script in script_runner.alwayson_scripts for name in generation_hooks)
+
+
+def networks_key(p):
+    """identity of files of extra networks mentioned in any of the prompts"""
+
+    extra_network_data = collections.defaultdict(list)
+    for prompt in set(p.all_prompts + (getattr(p, "all_hr_prompts", None) or [])):
+        for name, params_list in extra_networks.parse_prompt(prompt)[1].items():
+            extra_network_data[name] += params_list
+
+    return extra_networks.files_key(extra_network_data)
+
+
+def loaded_embeddings():
+    from modules.sd_hijack import model_hijack
+
+    return model_hijack.embedding_db.word_embeddings
+
+
+def embeddings_key(p):
+    """identity of textual inversion embeddings whose names appear in any of the prompts"""
+
+    texts = set(p.all_prompts + p.all_negative_prompts + (getattr(p, "all_hr_prompts", None) or []) + (getattr(p, "all_hr_negative_prompts", None) or []))
+
+    return [
+        [name, file_identity(embedding.filename) if embedding.filename else embedding.checksum()]
+        for name, embedding in sorted(loaded_embeddings().items())
+        if any(name in text for text in texts)
+    ]
+
+
+def make_key(p):
+    """
+    Returns a hash of everything that determines the output of processing p, or None if p can't be cached.
+    Must be called after prompts and seeds are resolved.
+    """
+
+    if not p.use_output_cache or not shared.opts.output_cache_enabled or shared.opts.output_cache_size <= 0 or not is_deterministic(p):
+        return None
+
+    if p.scripts is not None and uses_generation_hooks(p.scripts):
+        return None
+
+    try:
+        params = {k: key_value(v) for k, v in vars(p).items() if k not in ignored_attributes}
+        data = {
+            "type": type(p).__name__,
+            "params": params,
+            "model": [p.sd_model.sd_model_hash, p.sd_model.sd_checkpoint_info.filename],
+            "vae": file_identity(sd_vae.loaded_vae_file),
+            "networks": networks_key(p),
+            "embeddings": embeddings_key(p),
+            "opts": key_value(shared.opts.data),
+        }
+    except Unkeyable:
+        return None
+
+    text = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode("utf8")).hexdigest()
+
+
+def processed_size(processed):
+    return sum(x.width * x.height * len(x.getbands()) for x in processed.images if isinstance(x, Image.Image))
+
+
+def get(key):
+    """returns a copy of cached Processed object for the key, or None"""
+
+    if key is None:
+        return None
+
+    with lock:
+        processed = entries.get(key)
+        if processed is not None:
+            entries.move_to_end(key)
+
+    (hits if processed is not None else misses).inc()
+
+    if processed is None:
+        return None
+
+    res = copy.copy(processed)
+    res.images = list(processed.images)
+    res.infotexts = list(processed.infotexts)
+    return res
+
+
+def put(key, processed):
+    global total_bytes
+
+    if key is None:
+        return
+
+    budget = shared.opts.output_cache_size * 1024 * 1024
+    size = processed_size(processed)
+    if size > budget:
+        return
+
+    stored = copy.copy(processed)
+    stored.images = list(processed.images)
+    stored.infotexts = list(processed.infotexts)
+
+    with lock:
+        if key in entries:
+            total_bytes -= processed_size(entries.pop(key))
+
+        entries[key] = stored
+        total_bytes += size
+
+        while total_bytes > budget and entries:
+            _, evicted = entries.popitem(last=False)
+            total_bytes -= processed_size(evicted)
+
+        size_bytes.set(total_bytes)
+        size_entries.set(len(entries))
+
+
+def clear():
+    global total_bytes
+
+    with lock:
+        entries.clear()
+        total_bytes = 0
+
+        size_bytes.set(0)
+        size_entries.set(0)
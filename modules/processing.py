@@ -14,7 +14,7 @@ from skimage import exposure
 from typing import Any, Dict, List
 
 import modules.sd_hijack
-from modules import devices, prompt_parser, masking, sd_samplers, lowvram, generation_parameters_copypaste, extra_networks, sd_vae_approx, scripts, sd_samplers_common, sd_unet, errors
+from modules import devices, prompt_parser, masking, sd_samplers, lowvram, generation_parameters_copypaste, extra_networks, sd_vae_approx, scripts, sd_samplers_common, sd_unet, errors, metrics, output_cache, cond_cache
 from modules.sd_hijack import model_hijack
 from modules.shared import opts, cmd_opts, state
 import modules.shared as shared
@@ -24,6 +24,7 @@ import modules.images as images
 import modules.styles
 import modules.sd_models as sd_models
 import modules.sd_vae as sd_vae
+from modules.timer import Timer
 from ldm.data.util import AddMiDaS
 from ldm.models.diffusion.ddpm import LatentDepth2ImageDiffusion
 
@@ -185,6 +186,7 @@ class StableDiffusionProcessing:
         self.c = None
 
         self.user = None
+        self.use_output_cache = True
 
     @property
     def sd_model(self):
@@ -290,6 +292,11 @@ class StableDiffusionProcessing:
     def sample(self, conditioning, unconditional_conditioning, seeds, subseeds, subseed_strength, prompts):
         raise NotImplementedError()
 
+    def sampled_steps(self):
+        """number of sampling steps one call to sample() does, for reporting sampling speed"""
+
+        return self.steps
+
     def close(self):
         self.sampler = None
         self.c = None
@@ -329,6 +336,8 @@ class StableDiffusionProcessing:
         computed result is stored.
 
         caches is a list with items described above.
+
+        Results are also kept in cond_cache, which is shared by all jobs in the process.
         """
 
         cached_params = (
@@ -349,9 +358,21 @@ class StableDiffusionProcessing:
 
         cache = caches[0]
 
-        with devices.autocast():
-            cache[1] = function(shared.sd_model, required_prompts, steps)
+        cond_cache_key = cond_cache.make_key(function, required_prompts, steps, extra_network_data, self.width, self.height)
+        entry = cond_cache.get(cond_cache_key)
+
+        if entry is not None:
+            cond = entry.cond
+            entry.apply_infotext(model_hijack)
+        else:
+            infotext_state = cond_cache.infotext_state(model_hijack)
+
+            with devices.autocast():
+                cond = function(shared.sd_model, required_prompts, steps)
 
+            cond_cache.put(cond_cache_key, cond_cache.make_entry(cond, model_hijack, infotext_state))
+
+        cache[1] = cond
         cache[0] = cached_params
         return cache[1]
 
@@ -698,6 +719,8 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
     else:
         assert p.prompt is not None
 
+    timer = Timer()
+
     devices.torch_gc()
 
     seed = get_fixed_seed(p.seed)
@@ -726,6 +749,19 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
     if p.scripts is not None:
         p.scripts.process(p)
 
+    timer.record("prompt setup")
+
+    cache_key = output_cache.make_key(p)
+    res = output_cache.get(cache_key)
+    if res is not None:
+        timer.record("output cache")
+        metrics.observe_timer(metrics.generation_stage_seconds, timer)
+
+        if p.scripts is not None:
+            p.scripts.postprocess(p, res)
+
+        return res
+
     infotexts = []
     output_images = []
 
@@ -739,6 +775,8 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
 
             sd_unet.apply_unet()
 
+        timer.record("init")
+
         if state.job_count == -1:
             state.job_count = p.n_iter
 
@@ -780,8 +818,12 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
                     processed = Processed(p, [], p.seed, "")
                     file.write(processed.infotext(p, 0))
 
+            timer.record("extra networks")
+
             p.setup_conds()
 
+            timer.record("conditioning")
+
             for comment in model_hijack.comments:
                 comments[comment] = 1
 
@@ -793,6 +835,10 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
             with devices.without_autocast() if devices.unet_needs_upcast else devices.autocast():
                 samples_ddim = p.sample(conditioning=p.c, unconditional_conditioning=p.uc, seeds=p.seeds, subseeds=p.subseeds, subseed_strength=p.subseed_strength, prompts=p.prompts)
 
+            sampling_time = timer.elapsed()
+            timer.record("sampling", extra_time=sampling_time)
+            metrics.sampling_iterations_per_second.observe(p.sampled_steps() / max(sampling_time, 1e-6), sampler=p.sampler_name)
+
             x_samples_ddim = decode_latent_batch(p.sd_model, samples_ddim, target_device=devices.cpu, check_for_nans=True)
             x_samples_ddim = torch.stack(x_samples_ddim).float()
             x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
@@ -804,6 +850,8 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
 
             devices.torch_gc()
 
+            timer.record("VAE decode")
+
             if p.scripts is not None:
                 p.scripts.postprocess_batch(p, x_samples_ddim, batch_number=n)
 
@@ -847,9 +895,13 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
 
                 image = apply_overlay(image, p.paste_to, i, p.overlay_images)
 
+                timer.record("postprocess")
+
                 if opts.samples_save and not p.do_not_save_samples:
                     images.save_image(image, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(i), p=p)
 
+                timer.record("save")
+
                 text = infotext(i)
                 infotexts.append(text)
                 if opts.enable_pnginfo:
@@ -872,6 +924,8 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
                     if opts.return_mask_composite:
                         output_images.append(image_mask_composite)
 
+                    timer.record("save")
+
             del x_samples_ddim
 
             devices.torch_gc()
@@ -896,11 +950,17 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
             if opts.grid_save:
                 images.save_image(grid, p.outpath_grids, "grid", p.all_seeds[0], p.all_prompts[0], opts.grid_format, info=infotext(use_main_prompt=True), short_filename=not opts.grid_extended_filename, p=p, grid=True)
 
+        timer.record("save")
+
     if not p.disable_extra_networks and p.extra_network_data:
         extra_networks.deactivate(p, p.extra_network_data)
 
     devices.torch_gc()
 
+    timer.record("extra networks")
+    metrics.observe_timer(metrics.generation_stage_seconds, timer)
+    metrics.images_generated.inc(len(output_images) - index_of_first_image)
+
     res = Processed(
         p,
         images_list=output_images,
@@ -912,6 +972,9 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
         infotexts=infotexts,
     )
 
+    if not state.interrupted and not state.skipped:
+        output_cache.put(cache_key, res)
+
     if p.scripts is not None:
         p.scripts.postprocess(p, res)
 
@@ -1042,6 +1105,12 @@ class StableDiffusionProcessingTxt2Img(StableDiffusionProcessing):
             if self.hr_upscaler is not None:
                 self.extra_generation_params["Hires upscaler"] = self.hr_upscaler
 
+    def sampled_steps(self):
+        if not self.enable_hr:
+            return self.steps
+
+        return self.steps + (self.hr_second_pass_steps or self.steps)
+
     def sample(self, conditioning, unconditional_conditioning, seeds, subseeds, subseed_strength, prompts):
         self.sampler = sd_samplers.create_sampler(self.sampler_name, self.sd_model)
 
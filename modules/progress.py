@@ -1,11 +1,16 @@
+import asyncio
 import base64
 import io
+import threading
 import time
 
 import gradio as gr
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 
+from modules import errors
 from modules.shared import opts
+from modules.result_store import ResultStore
 
 import modules.shared as shared
 
@@ -13,38 +18,98 @@ import modules.shared as shared
 current_task = None
 pending_tasks = {}
 finished_tasks = []
-recorded_results = []
-recorded_results_limit = 2
+recorded_results = ResultStore("ui", "result_store_limit")
+task_state_changed = threading.Condition()
+task_state_waiters = set()
+"""(event loop, asyncio.Event) pairs of coroutines in wait_for_task_async; the events are set along with notifying task_state_changed"""
 
 
 def start_task(id_task):
     global current_task
 
-    current_task = id_task
-    pending_tasks.pop(id_task, None)
+    with task_state_changed:
+        current_task = id_task
+        pending_tasks.pop(id_task, None)
 
 
 def finish_task(id_task):
     global current_task
 
-    if current_task == id_task:
-        current_task = None
+    with task_state_changed:
+        if current_task == id_task:
+            current_task = None
 
-    finished_tasks.append(id_task)
-    if len(finished_tasks) > 16:
-        finished_tasks.pop(0)
+        finished_tasks.append(id_task)
+        if len(finished_tasks) > 16:
+            finished_tasks.pop(0)
+
+        notify_task_state_changed()
 
 
 def record_results(id_task, res):
-    recorded_results.append((id_task, res))
-    if len(recorded_results) > recorded_results_limit:
-        recorded_results.pop(0)
+    recorded_results.put(id_task, res)
 
 
 def add_task_to_queue(id_job):
     pending_tasks[id_job] = time.time()
 
 
+def remove_task_from_queue(id_job):
+    """called for tasks that leave the queue without being started, for example because they were cancelled"""
+
+    with task_state_changed:
+        pending_tasks.pop(id_job, None)
+        notify_task_state_changed()
+
+
+def notify_task_state_changed():
+    """must be called with task_state_changed held"""
+
+    task_state_changed.notify_all()
+
+    for loop, event in task_state_waiters:
+        loop.call_soon_threadsafe(event.set)
+
+
+def wait_for_task(id_task, timeout=None):
+    """waits until the task is neither queued nor running; returns False if timeout expired before that"""
+
+    with task_state_changed:
+        return task_state_changed.wait_for(lambda: is_task_done(id_task), timeout)
+
+
+async def wait_for_task_async(id_task, timeout=None):
+    """same as wait_for_task, but for coroutines: doesn't hold a thread while waiting"""
+
+    waiter = (asyncio.get_running_loop(), asyncio.Event())
+    deadline = time.monotonic() + timeout if timeout is not None else None
+
+    with task_state_changed:
+        task_state_waiters.add(waiter)
+
+    try:
+        while True:
+            waiter[1].clear()
+            if is_task_done(id_task):
+                return True
+
+            remaining = deadline - time.monotonic() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                return False
+
+            try:
+                await asyncio.wait_for(waiter[1].wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                return is_task_done(id_task)
+    finally:
+        with task_state_changed:
+            task_state_waiters.discard(waiter)
+
+
+def is_task_done(id_task):
+    return id_task != current_task and id_task not in pending_tasks
+
+
 class ProgressRequest(BaseModel):
     id_task: str = Field(default=None, title="Task ID", description="id of the task to get progress for")
     id_live_preview: int = Field(default=-1, title="Live preview image ID", description="id of last received last preview image")
@@ -62,16 +127,68 @@ class ProgressResponse(BaseModel):
 
 
 def setup_progress_api(app):
+    app.add_api_route("/internal/progress/stream", progress_stream_api, methods=["GET"])
     return app.add_api_route("/internal/progress", progressapi, methods=["POST"], response_model=ProgressResponse)
 
 
+live_preview_lock = threading.Lock()
+live_preview_cache = (None, None)
+
+
+def encode_live_preview():
+    """
+    Returns the current live preview image as a data: uri, or None if there isn't one. The image is only encoded once
+    no matter how many clients ask for it.
+    """
+
+    global live_preview_cache
+
+    image = shared.state.current_image
+    if image is None:
+        return None
+
+    key = (shared.state.time_start, shared.state.id_live_preview, opts.live_previews_image_format)
+
+    with live_preview_lock:
+        cached_key, cached_preview = live_preview_cache
+        if cached_key == key:
+            return cached_preview
+
+        buffered = io.BytesIO()
+
+        if opts.live_previews_image_format == "png":
+            # using optimize for large images takes an enormous amount of time
+            if max(*image.size) <= 256:
+                save_kwargs = {"optimize": True}
+            else:
+                save_kwargs = {"optimize": False, "compress_level": 1}
+
+        else:
+            save_kwargs = {}
+
+        image.save(buffered, format=opts.live_previews_image_format, **save_kwargs)
+        base64_image = base64.b64encode(buffered.getvalue()).decode('ascii')
+        live_preview = f"data:image/{opts.live_previews_image_format};base64,{base64_image}"
+
+        live_preview_cache = (key, live_preview)
+
+    return live_preview
+
+
 def progressapi(req: ProgressRequest):
     active = req.id_task == current_task
     queued = req.id_task in pending_tasks
     completed = req.id_task in finished_tasks
 
     if not active:
-        return ProgressResponse(active=active, queued=queued, completed=completed, id_live_preview=-1, textinfo="In queue..." if queued else "Waiting...")
+        textinfo = "Waiting..."
+        if queued:
+            from modules.call_queue import queue_lock
+
+            position = queue_lock.position(req.id_task)
+            textinfo = "In queue..." if not position else f"In queue ({position} ahead)..."
+
+        return ProgressResponse(active=active, queued=queued, completed=completed, id_live_preview=-1, textinfo=textinfo)
 
     progress = 0
 
@@ -92,37 +209,141 @@ def progressapi(req: ProgressRequest):
     id_live_preview = req.id_live_preview
     shared.state.set_current_image()
     if opts.live_previews_enable and shared.state.id_live_preview != req.id_live_preview:
-        image = shared.state.current_image
-        if image is not None:
-            buffered = io.BytesIO()
-
-            if opts.live_previews_image_format == "png":
-                # using optimize for large images takes an enormous amount of time
-                if max(*image.size) <= 256:
-                    save_kwargs = {"optimize": True}
-                else:
-                    save_kwargs = {"optimize": False, "compress_level": 1}
-
-            else:
-                save_kwargs = {}
-
-            image.save(buffered, format=opts.live_previews_image_format, **save_kwargs)
-            base64_image = base64.b64encode(buffered.getvalue()).decode('ascii')
-            live_preview = f"data:image/{opts.live_previews_image_format};base64,{base64_image}"
+        live_preview = encode_live_preview()
+        if live_preview is not None:
             id_live_preview = shared.state.id_live_preview
-        else:
-            live_preview = None
     else:
         live_preview = None
 
     return ProgressResponse(active=active, queued=queued, completed=completed, progress=progress, eta=eta, live_preview=live_preview, id_live_preview=id_live_preview, textinfo=shared.state.textinfo)
 
 
+class ProgressSubscriber:
+    def __init__(self, id_task, id_live_preview, loop):
+        self.id_task = id_task
+        self.id_live_preview = id_live_preview
+        self.loop = loop
+        self.updated = asyncio.Event()
+        self.latest = None
+        self.latest_key = None
+
+    def publish(self, res):
+        """called from broadcaster thread; only the latest update is kept, older ones that were not sent yet are dropped"""
+
+        key = (res.active, res.queued, res.completed, res.progress, res.textinfo, res.live_preview is not None, res.id_live_preview)
+        if key == self.latest_key:
+            return
+
+        self.latest_key = key
+        self.latest = res
+        self.loop.call_soon_threadsafe(self.updated.set)
+
+
+class ProgressBroadcaster:
+    """
+    Watches the state of the running job on a single thread and pushes changes to all streaming subscribers, so that
+    the cost of progress reporting doesn't grow with the number of watchers.
+    """
+
+    tick = 0.1
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.thread = None
+
+    def subscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.add(subscriber)
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="ProgressBroadcaster", daemon=True)
+                self.thread.start()
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def run(self):
+        try:
+            while True:
+                with self.lock:
+                    subscribers = list(self.subscribers)
+                    if not subscribers:
+                        self.thread = None
+                        return
+
+                for subscriber in subscribers:
+                    try:
+                        subscriber.publish(progressapi(ProgressRequest(id_task=subscriber.id_task, id_live_preview=subscriber.id_live_preview)))
+                    except Exception as e:
+                        errors.display_once(e, "broadcasting progress")
+
+                time.sleep(self.tick)
+        finally:
+            # if the thread dies from an error, let the next subscriber start a new one
+            with self.lock:
+                if self.thread is threading.current_thread():
+                    self.thread = None
+
+
+broadcaster = ProgressBroadcaster()
+
+# how long a progress stream waits for a task it doesn't know about to show up in queue; the browser requests
+# progress as soon as it submits, before the task is queued; same as default inactivityTimeout in progressbar.js
+unknown_task_wait_time = 40
+
+
+def progress_stream_api(id_task: str, id_live_preview: int = -1):
+    """
+    Server-sent events stream of progress for the task. Each event carries a ProgressResponse object as JSON, and is
+    only sent when something changes. The stream ends once the task is finished or leaves the queue without running,
+    or if the task doesn't show up in queue within unknown_task_wait_time seconds.
+    """
+
+    async def events():
+        subscriber = ProgressSubscriber(id_task, id_live_preview, asyncio.get_running_loop())
+        broadcaster.subscribe(subscriber)
+
+        time_start = time.time()
+        seen = False
+        res = None
+
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(subscriber.updated.wait(), timeout=5)
+                    subscriber.updated.clear()
+                    res = subscriber.latest
+
+                    if res.live_preview is not None:
+                        subscriber.id_live_preview = res.id_live_preview
+                except asyncio.TimeoutError:
+                    # repeat last state without the preview so that the client knows we are still alive
+                    if res is not None:
+                        res = res.copy(update={"live_preview": None})
+
+                if res is None:
+                    continue
+
+                yield f"data: {res.json()}\n\n"
+
+                seen = seen or res.active or res.queued or res.completed
+                if not seen:
+                    if time.time() - time_start > unknown_task_wait_time:
+                        break
+                elif res.completed or not (res.active or res.queued):
+                    break
+        finally:
+            broadcaster.unsubscribe(subscriber)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 def restore_progress(id_task):
-    while id_task == current_task or id_task in pending_tasks:
-        time.sleep(0.1)
+    wait_for_task(id_task)
 
-    res = next(iter([x[1] for x in recorded_results if id_task == x[0]]), None)
+    res = recorded_results.get(id_task)
     if res is not None:
         return res
 
@@ -1,7 +1,9 @@
 from __future__ import annotations
 
+import bisect
 import re
 from collections import namedtuple
+from functools import lru_cache
 from typing import List
 import lark
 
@@ -55,59 +57,65 @@ def get_learned_conditioning_prompt_schedules(prompts, steps):
     [[1, 'a'], [2, '(b:1.1)'], [3, 'a'], [4, '(b:1.1)'], [5, 'a'], [6, '(b:1.1)'], [7, 'a'], [8, '(b:1.1)'], [9, 'a'], [10, '(b:1.1)']]
     """
 
-    def collect_steps(steps, tree):
-        res = [steps]
-
-        class CollectSteps(lark.Visitor):
-            def scheduled(self, tree):
-                tree.children[-1] = float(tree.children[-1])
-                if tree.children[-1] < 1:
-                    tree.children[-1] *= steps
-                tree.children[-1] = min(steps, int(tree.children[-1]))
-                res.append(tree.children[-1])
-
-            def alternate(self, tree):
-                res.extend(range(1, steps+1))
-
-        CollectSteps().visit(tree)
-        return sorted(set(res))
-
-    def at_step(step, tree):
-        class AtStep(lark.Transformer):
-            def scheduled(self, args):
-                before, after, _, when = args
-                yield before or () if step <= when else after
-            def alternate(self, args):
-                yield next(args[(step - 1)%len(args)])
-            def start(self, args):
-                def flatten(x):
-                    if type(x) == str:
-                        yield x
-                    else:
-                        for gen in x:
-                            yield from flatten(gen)
-                return ''.join(flatten(args))
-            def plain(self, args):
-                yield args[0].value
-            def __default__(self, data, children, meta):
-                for child in children:
-                    yield child
-        return AtStep().transform(tree)
-
-    def get_schedule(prompt):
-        try:
-            tree = schedule_parser.parse(prompt)
-        except lark.exceptions.LarkError:
-            if 0:
-                import traceback
-                traceback.print_exc()
-            return [[steps, prompt]]
-        return [[t, at_step(t, tree)] for t in collect_steps(steps, tree)]
-
-    promptdict = {prompt: get_schedule(prompt) for prompt in set(prompts)}
+    promptdict = {prompt: [[t, text] for t, text in get_schedule(prompt, steps)] for prompt in set(prompts)}
     return [promptdict[prompt] for prompt in prompts]
 
 
+def collect_steps(steps, tree):
+    res = [steps]
+
+    class CollectSteps(lark.Visitor):
+        def scheduled(self, tree):
+            tree.children[-1] = float(tree.children[-1])
+            if tree.children[-1] < 1:
+                tree.children[-1] *= steps
+            tree.children[-1] = min(steps, int(tree.children[-1]))
+            res.append(tree.children[-1])
+
+        def alternate(self, tree):
+            res.extend(range(1, steps+1))
+
+    CollectSteps().visit(tree)
+    return sorted(set(res))
+
+
+def at_step(step, tree):
+    class AtStep(lark.Transformer):
+        def scheduled(self, args):
+            before, after, _, when = args
+            yield before or () if step <= when else after
+        def alternate(self, args):
+            yield next(args[(step - 1)%len(args)])
+        def start(self, args):
+            def flatten(x):
+                if type(x) == str:
+                    yield x
+                else:
+                    for gen in x:
+                        yield from flatten(gen)
+            return ''.join(flatten(args))
+        def plain(self, args):
+            yield args[0].value
+        def __default__(self, data, children, meta):
+            for child in children:
+                yield child
+    return AtStep().transform(tree)
+
+
+@lru_cache(maxsize=4096)
+def get_schedule(prompt, steps):
+    """returns the schedule for a single prompt as a tuple of (end_at_step, text); results are remembered, so the same prompt is only parsed once"""
+
+    try:
+        tree = schedule_parser.parse(prompt)
+    except lark.exceptions.LarkError:
+        if 0:
+            import traceback
+            traceback.print_exc()
+        return ((steps, prompt),)
+    return tuple((t, at_step(t, tree)) for t in collect_steps(steps, tree))
+
+
 ScheduledPromptConditioning = namedtuple("ScheduledPromptConditioning", ["end_at_step", "cond"])
 
 
@@ -147,32 +155,38 @@ def get_learned_conditioning(model, prompts: SdConditioning | list[str], steps):
         ]
     ]
     """
+    from modules import sd_hijack_clip
+
     res = []
 
     prompt_schedules = get_learned_conditioning_prompt_schedules(prompts, steps)
     cache = {}
 
-    for prompt, prompt_schedule in zip(prompts, prompt_schedules):
+    # text encoders run once for all chunks of all schedules of all prompts instead of once per prompt
+    all_texts = list(dict.fromkeys(text for prompt_schedule in prompt_schedules for _, text in prompt_schedule))
 
-        cached = cache.get(prompt, None)
-        if cached is not None:
-            res.append(cached)
-            continue
+    with sd_hijack_clip.encoded_in_advance(model, all_texts):
+        for prompt, prompt_schedule in zip(prompts, prompt_schedules):
 
-        texts = SdConditioning([x[1] for x in prompt_schedule], copy_from=prompts)
-        conds = model.get_learned_conditioning(texts)
+            cached = cache.get(prompt, None)
+            if cached is not None:
+                res.append(cached)
+                continue
 
-        cond_schedule = []
-        for i, (end_at_step, _) in enumerate(prompt_schedule):
-            if isinstance(conds, dict):
-                cond = {k: v[i] for k, v in conds.items()}
-            else:
-                cond = conds[i]
+            texts = SdConditioning([x[1] for x in prompt_schedule], copy_from=prompts)
+            conds = model.get_learned_conditioning(texts)
 
-            cond_schedule.append(ScheduledPromptConditioning(end_at_step, cond))
+            cond_schedule = []
+            for i, (end_at_step, _) in enumerate(prompt_schedule):
+                if isinstance(conds, dict):
+                    cond = {k: v[i] for k, v in conds.items()}
+                else:
+                    cond = conds[i]
 
-        cache[prompt] = cond_schedule
-        res.append(cond_schedule)
+                cond_schedule.append(ScheduledPromptConditioning(end_at_step, cond))
+
+            cache[prompt] = cond_schedule
+            res.append(cond_schedule)
 
     return res
 
@@ -181,6 +195,23 @@ re_AND = re.compile(r"\bAND\b")
 re_weight = re.compile(r"^((?:\s|.)*?)(?:\s*:\s*([-+]?(?:\d+\.?|\d*\.\d+)))?\s*$")
 
 
+@lru_cache(maxsize=4096)
+def split_multicond_prompt(prompt):
+    """splits the prompt using the AND separator and returns a tuple of (text, weight) for its parts"""
+
+    res = []
+    for subprompt in re_AND.split(prompt):
+        match = re_weight.search(subprompt)
+
+        text, weight = match.groups() if match is not None else (subprompt, 1.0)
+
+        weight = float(weight) if weight is not None else 1.0
+
+        res.append((text, weight))
+
+    return tuple(res)
+
+
 def get_multicond_prompt_list(prompts: SdConditioning | list[str]):
     res_indexes = []
 
@@ -189,16 +220,8 @@ def get_multicond_prompt_list(prompts: SdConditioning | list[str]):
     prompt_flat_list.clear()
 
     for prompt in prompts:
-        subprompts = re_AND.split(prompt)
-
         indexes = []
-        for subprompt in subprompts:
-            match = re_weight.search(subprompt)
-
-            text, weight = match.groups() if match is not None else (subprompt, 1.0)
-
-            weight = float(weight) if weight is not None else 1.0
-
+        for text, weight in split_multicond_prompt(prompt):
             index = prompt_indexes.get(text, None)
             if index is None:
                 index = len(prompt_flat_list)
@@ -252,7 +275,15 @@ class DictWithShape(dict):
         return self["crossattn"].shape
 
 
-def reconstruct_cond_batch(c: List[List[ScheduledPromptConditioning]], current_step):
+def reconstruct_cond_batch(c: List[List[ScheduledPromptConditioning]], current_step, tables=None):
+    """
+    Returns conds for all schedules in c for the step, stacked into one tensor. If tables dict is given,
+    the work is done once per range of steps using ScheduleTable kept in it.
+    """
+
+    if tables is not None:
+        return get_schedule_table(tables, c, c).cond_batch(current_step)
+
     param = c[0][0].cond
     is_dict = isinstance(param, dict)
 
@@ -293,7 +324,11 @@ def stack_conds(tensors):
 
 
 
-def reconstruct_multicond_batch(c: MulticondLearnedConditioning, current_step):
+def reconstruct_multicond_batch(c: MulticondLearnedConditioning, current_step, tables=None):
+    if tables is not None:
+        schedules = [composable_prompt.schedules for composable_prompts in c.batch for composable_prompt in composable_prompts]
+        return get_schedule_table(tables, c, schedules).multicond_batch(c, current_step)
+
     param = c.batch[0][0].schedules[0].cond
 
     tensors = []
@@ -324,6 +359,128 @@ def reconstruct_multicond_batch(c: MulticondLearnedConditioning, current_step):
     return conds_list, stacked
 
 
+def cond_shape(cond):
+    return cond['crossattn'].shape if isinstance(cond, dict) else cond.shape
+
+
+class ScheduleTable:
+    """
+    Conds of a batch of prompt schedules, prepared once per sampling run: unique conds stacked into one tensor, and for each
+    range of steps between two end_at_step values, indexes of conds that batch items use. Reconstructing the batch for a step
+    is then a lookup of the result for the current range, or a single index_select when sampling enters the next range.
+    Results are shared between steps and must not be modified in place.
+    """
+
+    def __init__(self, schedules):
+        self.schedules = schedules
+        self.boundaries = sorted({entry.end_at_step for schedule in schedules for entry in schedule})
+        self.conds = []
+        self.indexes = []
+
+        cond_indexes = {}
+        for boundary in self.boundaries + [None]:
+            row = []
+            for schedule in schedules:
+                # same as in reconstruct_cond_batch: the first entry ending at or after the step, or the first entry if there is none
+                entry = next((x for x in schedule if boundary is not None and x.end_at_step >= boundary), schedule[0])
+
+                index = cond_indexes.get(id(entry.cond))
+                if index is None:
+                    index = len(self.conds)
+                    self.conds.append(entry.cond)
+                    cond_indexes[id(entry.cond)] = index
+
+                row.append(index)
+
+            self.indexes.append(row)
+
+        self.stacked = None
+        if len({cond_shape(x) for x in self.conds}) == 1:
+            if isinstance(self.conds[0], dict):
+                self.stacked = {k: torch.stack([x[k] for x in self.conds]) for k in self.conds[0].keys()}
+            else:
+                self.stacked = torch.stack(self.conds)
+
+        self.index_tensors = {}
+        self.conds_list = None
+        self.current_range = None
+        self.current = None
+
+    def range_for_step(self, step):
+        return bisect.bisect_left(self.boundaries, step)
+
+    def select(self, range_index):
+        """returns conds that batch items use in the range of steps, as a single tensor or a dict of them"""
+
+        index_tensor = self.index_tensors.get(range_index)
+        if index_tensor is None:
+            device = next(iter(self.stacked.values())).device if isinstance(self.stacked, dict) else self.stacked.device
+            index_tensor = torch.tensor(self.indexes[range_index], device=device)
+            self.index_tensors[range_index] = index_tensor
+
+        if isinstance(self.stacked, dict):
+            return {k: v.index_select(0, index_tensor) for k, v in self.stacked.items()}
+
+        return self.stacked.index_select(0, index_tensor)
+
+    def cond_batch(self, current_step):
+        range_index = self.range_for_step(current_step)
+
+        if range_index != self.current_range:
+            param = self.schedules[0][0].cond
+
+            if self.stacked is None:
+                self.current = reconstruct_cond_batch([[ScheduledPromptConditioning(0, self.conds[i])] for i in self.indexes[range_index]], 0)
+            elif isinstance(param, dict):
+                res = self.select(range_index)
+                self.current = DictWithShape(res, None)
+            else:
+                self.current = self.select(range_index).to(device=param.device, dtype=param.dtype)
+
+            self.current_range = range_index
+
+        return DictWithShape(self.current, None) if isinstance(self.current, dict) else self.current
+
+    def multicond_batch(self, c: MulticondLearnedConditioning, current_step):
+        if self.conds_list is None:
+            self.conds_list = []
+            position = 0
+            for composable_prompts in c.batch:
+                self.conds_list.append([(position + i, composable_prompt.weight) for i, composable_prompt in enumerate(composable_prompts)])
+                position += len(composable_prompts)
+
+        range_index = self.range_for_step(current_step)
+
+        if range_index != self.current_range:
+            param = self.schedules[0][0].cond
+            tensors = [self.conds[i] for i in self.indexes[range_index]]
+
+            if isinstance(param, dict):
+                stacked = self.select(range_index) if self.stacked is not None else {k: stack_conds([x[k] for x in tensors]) for k in param.keys()}
+                self.current = DictWithShape(stacked, None)
+            else:
+                stacked = self.select(range_index) if self.stacked is not None else stack_conds(tensors)
+                self.current = stacked.to(device=param.device, dtype=param.dtype)
+
+            self.current_range = range_index
+
+        conds_list = [list(x) for x in self.conds_list]
+        return conds_list, DictWithShape(self.current, None) if isinstance(self.current, dict) else self.current
+
+
+def get_schedule_table(tables, c, schedules):
+    """returns ScheduleTable for conditioning c from tables (a dict kept by the sampler for the sampling run), creating it if needed"""
+
+    entry = tables.get(id(c))
+
+    # the entry keeps a reference to c, so its id can't be reused by another object while it's in tables
+    if entry is None or entry[0] is not c:
+        entry = (c, ScheduleTable(schedules))
+        tables[id(c)] = entry
+
+    return entry[1]
+
+
 re_attention = re.compile(r"""
 \\\(|
 \\\)|
@@ -378,6 +535,13 @@ def parse_prompt_attention(text):
      ['.', 1.1]]
     """
 
+    return [[part, weight] for part, weight in parse_prompt_attention_cached(text)]
+
+
+@lru_cache(maxsize=4096)
+def parse_prompt_attention_cached(text):
+    """same as parse_prompt_attention, but remembers results and returns them as a tuple of (text, weight) tuples"""
+
     res = []
     round_brackets = []
     square_brackets = []
@@ -430,7 +594,7 @@ def parse_prompt_attention(text):
         else:
             i += 1
 
-    return res
+    return tuple((part, weight) for part, weight in res)
 
 if __name__ == "__main__":
     import doctest
@@ -0,0 +1,120 @@
+import collections
+import hashlib
+import os
+import pickle
+import threading
+import time
+
+from modules import errors, shared
+from modules.paths import data_path
+
+results_dir = os.path.join(data_path, "cache", "results")
+
+
+class ResultStore:
+    """
+    Keeps results of finished tasks by task id, at most as many as the option named limit_option says, and for at
+    most opts.result_store_ttl seconds. Results pushed out of memory are written to disk if
+    opts.result_store_spill_to_disk is enabled, and can still be looked up from there, including after a restart.
+    """
+
+    def __init__(self, name, limit_option):
+        self.name = name
+        self.limit_option = limit_option
+        self.lock = threading.Lock()
+        self.results = collections.OrderedDict()
+        self.spilled = None
+
+    @property
+    def dirname(self):
+        return os.path.join(results_dir, self.name)
+
+    def filename(self, id_task):
+        return os.path.join(self.dirname, hashlib.sha256(id_task.encode("utf8")).hexdigest() + ".pickle")
+
+    @staticmethod
+    def expired(time_added, now):
+        ttl = shared.opts.result_store_ttl
+        return ttl > 0 and now - time_added > ttl
+
+    def put(self, id_task, value):
+        now = time.time()
+
+        with self.lock:
+            self.results[id_task] = (now, value)
+            self.results.move_to_end(id_task)
+
+            evicted = []
+            while self.results and (len(self.results) > max(getattr(shared.opts, self.limit_option), 1) or self.expired(next(iter(self.results.values()))[0], now)):
+                evicted.append(self.results.popitem(last=False))
+
+        if shared.opts.result_store_spill_to_disk:
+            for evicted_id, (time_added, evicted_value) in evicted:
+                if not self.expired(time_added, now):
+                    self.spill(evicted_id, time_added, evicted_value)
+
+    def get(self, id_task, default=None):
+        now = time.time()
+
+        with self.lock:
+            entry = self.results.get(id_task)
+
+        if entry is None:
+            entry = self.load(id_task)
+
+        if entry is None or self.expired(entry[0], now):
+            return default
+
+        return entry[1]
+
+    def __contains__(self, id_task):
+        sentinel = object()
+        return self.get(id_task, sentinel) is not sentinel
+
+    def spill(self, id_task, time_added, value):
+        filename = self.filename(id_task)
+
+        try:
+            os.makedirs(self.dirname, exist_ok=True)
+            with open(filename + ".tmp", "wb") as file:
+                pickle.dump((id_task, time_added, value), file)
+            os.replace(filename + ".tmp", filename)
+        except Exception as e:
+            errors.display_once(e, f"saving result of {self.name} task to disk")
+            return
+
+        with self.lock:
+            if self.spilled is None:
+                self.spilled = collections.deque(sorted((os.path.join(self.dirname, x) for x in os.listdir(self.dirname) if x.endswith(".pickle")), key=os.path.getmtime))
+            else:
+                self.spilled.append(filename)
+
+            removed = []
+            while len(self.spilled) > max(shared.opts.result_store_disk_limit, 0):
+                removed.append(self.spilled.popleft())
+
+        for x in removed:
+            try:
+                os.remove(x)
+            except OSError:
+                pass
+
+    def load(self, id_task):
+        if not shared.opts.result_store_spill_to_disk:
+            return None
+
+        filename = self.filename(id_task)
+        if not os.path.isfile(filename):
+            return None
+
+        try:
+            with open(filename, "rb") as file:
+                stored_id, time_added, value = pickle.load(file)
+        except Exception as e:
+            errors.display_once(e, f"loading result of {self.name} task from disk")
+            return None
+
+        if stored_id != id_task:
+            return None
+
+        return time_added, value
@@ -1,7 +1,9 @@
 # this code is adapted from the script contributed by anon from /h/
 
+import os
 import pickle
 import collections
+import types
 
 import torch
 import numpy
@@ -20,6 +22,11 @@ def encode(*args):
     return out
 
 
+class ForbiddenContentError(Exception):
+    """raised when a pickled file contains something that is not allowed to be loaded"""
+    pass
+
+
 class RestrictedUnpickler(pickle.Unpickler):
     extra_handler = None
 
@@ -32,36 +39,42 @@ class RestrictedUnpickler(pickle.Unpickler):
             return TypedStorage()  # PyTorch before 2.0 does not have the _internal argument
 
     def find_class(self, module, name):
-        if self.extra_handler is not None:
-            res = self.extra_handler(module, name)
-            if res is not None:
-                return res
+        return find_allowed_class(module, name, self.extra_handler)
 
-        if module == 'collections' and name == 'OrderedDict':
-            return getattr(collections, name)
-        if module == 'torch._utils' and name in ['_rebuild_tensor_v2', '_rebuild_parameter', '_rebuild_device_tensor_from_numpy']:
-            return getattr(torch._utils, name)
-        if module == 'torch' and name in ['FloatStorage', 'HalfStorage', 'IntStorage', 'LongStorage', 'DoubleStorage', 'ByteStorage', 'float32', 'BFloat16Storage']:
-            return getattr(torch, name)
-        if module == 'torch.nn.modules.container' and name in ['ParameterDict']:
-            return getattr(torch.nn.modules.container, name)
-        if module == 'numpy.core.multiarray' and name in ['scalar', '_reconstruct']:
-            return getattr(numpy.core.multiarray, name)
-        if module == 'numpy' and name in ['dtype', 'ndarray']:
-            return getattr(numpy, name)
-        if module == '_codecs' and name == 'encode':
-            return encode
-        if module == "pytorch_lightning.callbacks" and name == 'model_checkpoint':
-            import pytorch_lightning.callbacks
-            return pytorch_lightning.callbacks.model_checkpoint
-        if module == "pytorch_lightning.callbacks.model_checkpoint" and name == 'ModelCheckpoint':
-            import pytorch_lightning.callbacks.model_checkpoint
-            return pytorch_lightning.callbacks.model_checkpoint.ModelCheckpoint
-        if module == "__builtin__" and name == 'set':
-            return set
-
-        # Forbid everything else.
-        raise Exception(f"global '{module}/{name}' is forbidden")
+
+def find_allowed_class(module, name, extra_handler=None):
+    """returns the global that a pickled file refers to, if it's one of those allowed to be loaded"""
+
+    if extra_handler is not None:
+        res = extra_handler(module, name)
+        if res is not None:
+            return res
+
+    if module == 'collections' and name == 'OrderedDict':
+        return getattr(collections, name)
+    if module == 'torch._utils' and name in ['_rebuild_tensor_v2', '_rebuild_parameter', '_rebuild_device_tensor_from_numpy']:
+        return getattr(torch._utils, name)
+    if module == 'torch' and name in ['FloatStorage', 'HalfStorage', 'IntStorage', 'LongStorage', 'DoubleStorage', 'ByteStorage', 'float32', 'BFloat16Storage']:
+        return getattr(torch, name)
+    if module == 'torch.nn.modules.container' and name in ['ParameterDict']:
+        return getattr(torch.nn.modules.container, name)
+    if module == 'numpy.core.multiarray' and name in ['scalar', '_reconstruct']:
+        return getattr(numpy.core.multiarray, name)
+    if module == 'numpy' and name in ['dtype', 'ndarray']:
+        return getattr(numpy, name)
+    if module == '_codecs' and name == 'encode':
+        return encode
+    if module == "pytorch_lightning.callbacks" and name == 'model_checkpoint':
+        import pytorch_lightning.callbacks
+        return pytorch_lightning.callbacks.model_checkpoint
+    if module == "pytorch_lightning.callbacks.model_checkpoint" and name == 'ModelCheckpoint':
+        import pytorch_lightning.callbacks.model_checkpoint
+        return pytorch_lightning.callbacks.model_checkpoint.ModelCheckpoint
+    if module == "__builtin__" and name == 'set':
+        return set
+
+    # Forbid everything else.
+    raise ForbiddenContentError(f"global '{module}/{name}' is forbidden")
 
 
 # Regular expression that accepts 'dirname/version', 'dirname/data.pkl', and 'dirname/data/<number>'
@@ -73,7 +86,7 @@ def check_zip_filenames(filename, names):
         if allowed_zip_names_re.match(name):
             continue
 
-        raise Exception(f"bad file inside {filename}: {name}")
+        raise ForbiddenContentError(f"bad file inside {filename}: {name}")
 
 
 def check_pt(filename, extra_handler):
@@ -104,6 +117,37 @@ def check_pt(filename, extra_handler):
                 unpickler.load()
 
 
+def check_zip_contents(filename):
+    """checks names of files inside a zip-format checkpoint; only reads the zip directory"""
+
+    try:
+        with zipfile.ZipFile(filename) as z:
+            check_zip_filenames(filename, z.namelist())
+    except zipfile.BadZipfile:
+        pass  # old pytorch format; there is only pickled data, which is checked while it's loaded
+
+
+def restricted_pickle_module(extra_handler):
+    """
+    Returns an object that can be passed to torch.load as pickle_module, so that torch.load itself unpickles with
+    the same restrictions as RestrictedUnpickler. This checks the file and loads it in one pass instead of unpickling
+    it twice, and tensor data is only read by torch as the unpickler reaches it.
+
+    The unpickler must not define persistent_load as a method: torch sets its own persistent_load on the instance,
+    and the C unpickler only uses that if the class doesn't have one, so with RestrictedUnpickler's version all
+    storages would come out empty.
+    """
+
+    class Unpickler(pickle.Unpickler):
+        def find_class(self, module, name):
+            return find_allowed_class(module, name, extra_handler)
+
+    def load_pickle(file, **kwargs):
+        return Unpickler(file, **kwargs).load()
+
+    return types.SimpleNamespace(__name__=__name__, Unpickler=Unpickler, load=load_pickle)
+
+
 def load(filename, *args, **kwargs):
     return load_with_extra(filename, *args, extra_handler=global_extra_handler, **kwargs)
 
@@ -132,30 +176,55 @@ def load_with_extra(filename, extra_handler=None, *args, **kwargs):
 
     from modules import shared
 
+    if shared.cmd_opts.disable_safe_unpickle:
+        return unsafe_torch_load(filename, *args, **kwargs)
+
+    single_pass = "pickle_module" not in kwargs and len(args) <= 1 and isinstance(filename, (str, os.PathLike))
+
+    if single_pass:
+        # only errors of the check itself are reported here; other errors of torch.load, such as a missing file
+        # or running out of memory, are raised to the caller the same way as when loading without the check
+        try:
+            check_zip_contents(filename)
+            return unsafe_torch_load(filename, *args, pickle_module=restricted_pickle_module(extra_handler), **kwargs)
+        except pickle.UnpicklingError:
+            report_corrupted(filename)
+            return None
+        except ForbiddenContentError:
+            report_malicious(filename)
+            return None
+
     try:
-        if not shared.cmd_opts.disable_safe_unpickle:
-            check_pt(filename, extra_handler)
+        check_pt(filename, extra_handler)
 
     except pickle.UnpicklingError:
-        errors.report(
-            f"Error verifying pickled file from {filename}\n"
-            "-----> !!!! The file is most likely corrupted !!!! <-----\n"
-            "You can skip this check with --disable-safe-unpickle commandline argument, but that is not going to help you.\n\n",
-            exc_info=True,
-        )
+        report_corrupted(filename)
         return None
     except Exception:
-        errors.report(
-            f"Error verifying pickled file from {filename}\n"
-            f"The file may be malicious, so the program is not going to read it.\n"
-            f"You can skip this check with --disable-safe-unpickle commandline argument.\n\n",
-            exc_info=True,
-        )
+        report_malicious(filename)
         return None
 
     return unsafe_torch_load(filename, *args, **kwargs)
 
 
+def report_corrupted(filename):
+    errors.report(
+        f"Error verifying pickled file from {filename}\n"
+        "-----> !!!! The file is most likely corrupted !!!! <-----\n"
+        "You can skip this check with --disable-safe-unpickle commandline argument, but that is not going to help you.\n\n",
+        exc_info=True,
+    )
+
+
+def report_malicious(filename):
+    errors.report(
+        f"Error verifying pickled file from {filename}\n"
+        f"The file may be malicious, so the program is not going to read it.\n"
+        f"You can skip this check with --disable-safe-unpickle commandline argument.\n\n",
+        exc_info=True,
+    )
+
+
 class Extra:
     """
     A class for temporarily setting the global handler for when you can't explicitly call load_with_extra
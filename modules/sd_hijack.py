@@ -279,12 +279,13 @@ class StableDiffusionModelHijack:
         self.extra_generation_params = {}
 
     def get_prompt_lengths(self, text):
-        if self.clip is None:
+        clip = self.clip  # can be replaced by another thread loading a model
+        if clip is None:
             return "-", "-"
 
-        _, token_count = self.clip.process_texts([text])
+        _, token_count = clip.process_texts([text])
 
-        return token_count, self.clip.get_target_prompt_token_count(token_count)
+        return token_count, clip.get_target_prompt_token_count(token_count)
 
     def redo_hijack(self, m):
         self.undo_hijack(m)
@@ -1,11 +1,16 @@
+import contextlib
 import math
-from collections import namedtuple
+import threading
+from collections import namedtuple, OrderedDict
 
 import torch
 
-from modules import prompt_parser, devices, sd_hijack
+from modules import prompt_parser, devices, sd_hijack, extra_networks, metrics, lowvram
 from modules.shared import opts
 
+chunk_cache_hits = metrics.Counter("sd_cond_chunk_cache_hits_total", "Number of prompt chunks whose text encoder output was taken from cache")
+chunk_cache_misses = metrics.Counter("sd_cond_chunk_cache_misses_total", "Number of prompt chunks that went through text encoder")
+
 
 class PromptChunk:
     """
@@ -46,6 +51,16 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
         self.input_key = getattr(wrapped, 'input_key', 'txt')
         self.legacy_ucg_val = None
 
+        self.token_cache = OrderedDict()
+        self.token_cache_lock = threading.Lock()
+        self.token_cache_size = 1024
+
+        self.chunk_cache = OrderedDict()
+        self.chunk_cache_lock = threading.Lock()
+
+        self.prefetched_rows = {}
+        self.max_encode_batch = 64
+
     def empty_chunk(self):
         """creates an empty PromptChunk and returns it"""
 
@@ -64,6 +79,31 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
 
         raise NotImplementedError
 
+    def tokenize_cached(self, texts):
+        """
+        Same as tokenize(), but remembers token ids for recently seen texts, so that prompt fragments that stay the same
+        between calls - for example while the user is typing - do not need to go through the tokenizer again.
+        Returned lists are shared between calls and must not be modified.
+        """
+
+        with self.token_cache_lock:
+            missing = list(dict.fromkeys(x for x in texts if x not in self.token_cache))
+
+        tokenized = dict(zip(missing, self.tokenize(missing))) if missing else {}
+
+        with self.token_cache_lock:
+            for text in texts:
+                if text not in tokenized:
+                    tokenized[text] = self.token_cache[text] if text in self.token_cache else self.tokenize([text])[0]
+
+                self.token_cache[text] = tokenized[text]
+                self.token_cache.move_to_end(text)
+
+            while len(self.token_cache) > self.token_cache_size:
+                self.token_cache.popitem(last=False)
+
+        return [tokenized[x] for x in texts]
+
     def encode_with_transformers(self, tokens):
         """
         converts a batch of token ids (in python lists) into a single tensor with numeric respresentation of those tokens;
@@ -93,7 +133,7 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
         else:
             parsed = [[line, 1.0]]
 
-        tokenized = self.tokenize([text for text, _ in parsed])
+        tokenized = self.tokenize_cached([text for text, _ in parsed])
 
         chunks = []
         chunk = PromptChunk()
@@ -218,25 +258,29 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
 
         used_embeddings = {}
         chunk_count = max([len(x) for x in batch_chunks])
+        batch_chunks = [chunks + [self.empty_chunk()] * (chunk_count - len(chunks)) for chunks in batch_chunks]
 
-        zs = []
-        for i in range(chunk_count):
-            batch_chunk = [chunks[i] if i < len(chunks) else self.empty_chunk() for chunks in batch_chunks]
+        for chunks in batch_chunks:
+            for chunk in chunks:
+                for _position, embedding in chunk.fixes:
+                    used_embeddings[embedding.name] = embedding
 
-            tokens = [x.tokens for x in batch_chunk]
-            multipliers = [x.multipliers for x in batch_chunk]
-            self.hijack.fixes = [x.fixes for x in batch_chunk]
+        # all chunks go through transformers together rather than one chunk index at a time
+        all_chunks = [chunk for chunks in batch_chunks for chunk in chunks]
+        rows = self.encode_rows([x.tokens for x in all_chunks], [x.fixes for x in all_chunks])
 
-            for fixes in self.hijack.fixes:
-                for _position, embedding in fixes:
-                    used_embeddings[embedding.name] = embedding
+        zs = []
+        for i in range(chunk_count):
+            batch_chunk = [chunks[i] for chunks in batch_chunks]
 
-            z = self.process_tokens(tokens, multipliers)
+            z = self.stack_rows([rows[self.chunk_cache_key(x.tokens, x.fixes)] for x in batch_chunk])
+            z = self.apply_multipliers(z, [x.multipliers for x in batch_chunk])
             zs.append(z)
 
         if opts.textual_inversion_add_hashes_to_infotext and used_embeddings:
             hashes = []
             for name, embedding in used_embeddings.items():
+                embedding.read_hash()
                 shorthash = embedding.shorthash
                 if not shorthash:
                     continue
@@ -260,16 +304,16 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
         Multipliers are used to give more or less weight to the outputs of transformers network. Each multiplier
         corresponds to one token.
         """
-        tokens = torch.asarray(remade_batch_tokens).to(devices.device)
 
-        # this is for SD2: SD1 uses the same token for padding and end of text, while SD2 uses different ones.
-        if self.id_end != self.id_pad:
-            for batch_pos in range(len(remade_batch_tokens)):
-                index = remade_batch_tokens[batch_pos].index(self.id_end)
-                tokens[batch_pos, index+1:tokens.shape[1]] = self.id_pad
+        batch_fixes = self.hijack.fixes or [[] for _ in remade_batch_tokens]
+        self.hijack.fixes = None
 
-        z = self.encode_with_transformers(tokens)
+        rows = self.encode_rows(remade_batch_tokens, batch_fixes)
+        z = self.stack_rows([rows[self.chunk_cache_key(tokens, fixes)] for tokens, fixes in zip(remade_batch_tokens, batch_fixes)])
 
+        return self.apply_multipliers(z, batch_multipliers)
+
+    def apply_multipliers(self, z, batch_multipliers):
         pooled = getattr(z, 'pooled', None)
 
         # restoring original mean is likely not correct, but it seems to work well to prevent artifacts that happen otherwise
@@ -284,6 +328,149 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
 
         return z
 
+    def encode_tokens(self, remade_batch_tokens):
+        """runs a batch of token ids through transformers, applying embedding fixes from self.hijack.fixes; multipliers are not applied"""
+
+        tokens = torch.asarray(remade_batch_tokens).to(devices.device)
+
+        # this is for SD2: SD1 uses the same token for padding and end of text, while SD2 uses different ones.
+        if self.id_end != self.id_pad:
+            for batch_pos in range(len(remade_batch_tokens)):
+                index = remade_batch_tokens[batch_pos].index(self.id_end)
+                tokens[batch_pos, index+1:tokens.shape[1]] = self.id_pad
+
+        return self.encode_with_transformers(tokens)
+
+    def chunk_cache_key(self, tokens, fixes):
+        # embedding objects are part of the key so that a reloaded embedding with the same name is a different key; vec._version
+        # changes when the embedding is modified in place, e.g. by training
+        return (
+            tuple(tokens),
+            tuple((offset, embedding, embedding.vec._version) for offset, embedding in fixes or []),
+            opts.CLIP_stop_at_last_layers,
+            extra_networks.active_params,
+        )
+
+    def stack_rows(self, rows):
+        """makes a batch tensor out of (z, pooled) tuples returned by encode_rows()"""
+
+        z = torch.stack([x[0] for x in rows])
+
+        if rows[0][1] is not None:
+            z.pooled = torch.stack([x[1] for x in rows])
+
+        return z
+
+    def encode_rows(self, batch_tokens, batch_fixes):
+        """
+        Returns text encoder outputs, before multipliers, for rows of token ids, as a dict of chunk_cache_key() -> (z, pooled).
+        Rows prepared by encode_in_advance() and rows found in chunk cache are not encoded again; all others go through
+        transformers together, in batches of up to self.max_encode_batch rows. Outputs are cached before multipliers are applied,
+        because apply_multipliers() normalizes them using the mean of the whole batch.
+        """
+
+        keys = [self.chunk_cache_key(tokens, fixes) for tokens, fixes in zip(batch_tokens, batch_fixes)]
+
+        if torch.is_grad_enabled():
+            self.hijack.fixes = batch_fixes
+            z = self.encode_tokens(batch_tokens)
+            pooled = getattr(z, 'pooled', None)
+
+            return {key: (z[i], None if pooled is None else pooled[i]) for i, key in enumerate(keys)}
+
+        cache_size = int(opts.cond_chunk_cache_size)
+        first_index = {}
+        for i, key in enumerate(keys):
+            first_index.setdefault(key, i)
+
+        rows = {key: self.prefetched_rows[key] for key in first_index if key in self.prefetched_rows}
+        lookup = [key for key in first_index if key not in rows]
+
+        if cache_size > 0 and lookup:
+            with self.chunk_cache_lock:
+                found = {key: self.chunk_cache[key] for key in lookup if key in self.chunk_cache}
+
+            chunk_cache_hits.inc(len(found))
+            chunk_cache_misses.inc(len(lookup) - len(found))
+            rows.update(found)
+
+        missing = [key for key in lookup if key not in rows]
+
+        for start in range(0, len(missing), self.max_encode_batch):
+            part = missing[start:start + self.max_encode_batch]
+
+            self.hijack.fixes = [batch_fixes[first_index[key]] for key in part]
+            z = self.encode_tokens([batch_tokens[first_index[key]] for key in part])
+            pooled = getattr(z, 'pooled', None)
+
+            for row, key in enumerate(part):
+                rows[key] = (z[row].clone(), None if pooled is None else pooled[row].clone())
+
+        self.hijack.fixes = None
+
+        if cache_size > 0:
+            with self.chunk_cache_lock:
+                for key in first_index:
+                    self.chunk_cache[key] = rows[key]
+                    self.chunk_cache.move_to_end(key)
+
+                while len(self.chunk_cache) > cache_size:
+                    self.chunk_cache.popitem(last=False)
+
+        return rows
+
+    def encode_in_advance(self, texts):
+        """
+        Encodes all chunks of all texts, putting the results into self.prefetched_rows, so that following forward() calls for
+        any of those texts do not need to run transformers. Used to encode many prompts in a single transformers call rather
+        than one call per prompt.
+        """
+
+        if opts.use_old_emphasis_implementation or torch.is_grad_enabled():
+            return
+
+        batch_chunks, _ = self.process_texts(texts)
+        all_chunks = [chunk for chunks in batch_chunks for chunk in chunks]
+
+        # texts that get encoded together with longer ones in forward() are padded with empty chunks
+        if len({len(x) for x in batch_chunks}) > 1:
+            all_chunks.append(self.empty_chunk())
+
+        self.prefetched_rows.update(self.encode_rows([x.tokens for x in all_chunks], [x.fixes for x in all_chunks]))
+
+
+def text_encoders(sd_model):
+    """returns all hijacked text encoders of the model; SDXL has two"""
+
+    conditioner = getattr(sd_model, 'conditioner', None)
+    embedders = conditioner.embedders if conditioner is not None else [getattr(sd_model, 'cond_stage_model', None)]
+
+    return [x for x in embedders if isinstance(x, FrozenCLIPEmbedderWithCustomWordsBase)]
+
+
+@contextlib.contextmanager
+def encoded_in_advance(sd_model, texts):
+    """
+    Encodes all chunks of texts with all text encoders of the model in as few transformers calls as possible;
+    inside the with block, model's get_learned_conditioning() for any of those texts uses the results.
+    """
+
+    # with lowvram, SDXL text encoders are moved to GPU by a hook on conditioner's forward, which this would bypass
+    if lowvram.is_enabled(sd_model) and hasattr(sd_model, 'conditioner'):
+        yield
+        return
+
+    encoders = text_encoders(sd_model)
+
+    try:
+        for encoder in encoders:
+            encoder.encode_in_advance(texts)
+
+        yield
+    finally:
+        for encoder in encoders:
+            encoder.prefetched_rows = {}
+
 
 class FrozenCLIPEmbedderWithCustomWords(FrozenCLIPEmbedderWithCustomWordsBase):
     def __init__(self, wrapped, hijack):
@@ -14,7 +14,7 @@ import ldm.modules.midas as midas
 
 from ldm.util import instantiate_from_config
 
-from modules import paths, shared, modelloader, devices, script_callbacks, sd_vae, sd_disable_initialization, errors, hashes, sd_models_config, sd_unet, sd_models_xl
+from modules import paths, shared, modelloader, devices, script_callbacks, sd_vae, sd_disable_initialization, errors, hashes, sd_models_config, sd_unet, sd_models_xl, sd_models_stream, sd_models_converted, sd_models_delta, metrics
 from modules.sd_hijack_inpainting import do_inpainting_hijack
 from modules.timer import Timer
 import tomesd
@@ -135,6 +135,11 @@ def list_models():
         checkpoint_info = CheckpointInfo(filename)
         checkpoint_info.register()
 
+    if shared.opts.hash_models_in_background and not shared.cmd_opts.no_hashing:
+        for checkpoint_info in list(checkpoints_list.values()):
+            if checkpoint_info.sha256 is None:
+                hashes.request(checkpoint_info.filename, f"checkpoint/{checkpoint_info.name}", priority=hashes.PRIORITY_BACKGROUND)
+
 
 def get_closet_checkpoint_match(search_string):
     checkpoint_info = checkpoint_aliases.get(search_string, None)
@@ -264,6 +269,129 @@ def read_state_dict(checkpoint_file, print_global_state=False, map_location=None
     return sd
 
 
+class CheckpointPrefetch:
+    """reads weights of a checkpoint into (pinned, if using CUDA) CPU memory on a background thread"""
+
+    def __init__(self, checkpoint_info):
+        self.checkpoint_info = checkpoint_info
+        self.state_dict = None
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=f"prefetch {checkpoint_info.name}", daemon=True)
+
+    def run(self):
+        try:
+            state_dict = read_state_dict(checkpoint_file(self.checkpoint_info), map_location="cpu")
+
+            if torch.cuda.is_available() and devices.device.type == "cuda":
+                state_dict = {k: v.pin_memory() if isinstance(v, torch.Tensor) else v for k, v in state_dict.items()}
+
+            self.state_dict = state_dict
+        except Exception as e:
+            errors.display(e, f"prefetching checkpoint {self.checkpoint_info.filename}")
+        finally:
+            self.done.set()
+
+
+prefetch = None
+prefetch_next = None
+prefetch_lock = threading.Lock()
+
+
+def is_prefetch_needed(checkpoint_info):
+    return checkpoint_info not in checkpoints_loaded and find_loaded_model(checkpoint_info) is None
+
+
+def start_prefetch(checkpoint_info):
+    """must be called with prefetch_lock held"""
+
+    global prefetch
+
+    prefetch = CheckpointPrefetch(checkpoint_info)
+    prefetch.thread.start()
+
+
+def start_next_prefetch():
+    """must be called with prefetch_lock held, after the prefetch slot has been emptied"""
+
+    global prefetch_next
+
+    checkpoint_info = prefetch_next
+    prefetch_next = None
+
+    if checkpoint_info is not None and is_prefetch_needed(checkpoint_info):
+        start_prefetch(checkpoint_info)
+
+
+def prefetch_checkpoint(checkpoint_info):
+    """
+    Starts reading weights of a checkpoint that is going to be needed soon, so that switching to it does not have to wait for disk.
+    Only one checkpoint is kept prefetched; if another one is already there, this one is read after that one gets used.
+    """
+
+    global prefetch_next
+
+    if checkpoint_info is not None and checkpoint_info.sha256 is None and not shared.cmd_opts.no_hashing:
+        hashes.request(checkpoint_info.filename, f"checkpoint/{checkpoint_info.name}", priority=hashes.PRIORITY_SOON)
+
+    if not shared.opts.sd_checkpoint_prefetch or checkpoint_info is None or not is_prefetch_needed(checkpoint_info):
+        return
+
+    with prefetch_lock:
+        if prefetch is None:
+            start_prefetch(checkpoint_info)
+        elif prefetch.checkpoint_info != checkpoint_info:
+            prefetch_next = checkpoint_info
+
+
+def discard_prefetch(checkpoint_info=None):
+    """
+    Forgets prefetched weights of the checkpoint, or of all checkpoints if it's None, so that they don't stay in memory
+    after the job that was going to use them got cancelled. A prefetch that is still reading finishes in background and is thrown away.
+    """
+
+    global prefetch, prefetch_next
+
+    with prefetch_lock:
+        if prefetch_next is not None and (checkpoint_info is None or prefetch_next == checkpoint_info):
+            prefetch_next = None
+
+        if prefetch is not None and (checkpoint_info is None or prefetch.checkpoint_info == checkpoint_info):
+            prefetch = None
+            start_next_prefetch()
+
+
+def has_prefetched_state_dict(checkpoint_info):
+    with prefetch_lock:
+        return prefetch is not None and prefetch.checkpoint_info == checkpoint_info
+
+
+def take_prefetched_state_dict(checkpoint_info):
+    """returns prefetched weights of the checkpoint, waiting for prefetch to finish if it's still running, or None if it's not being prefetched"""
+
+    global prefetch, prefetch_next
+
+    with prefetch_lock:
+        current = prefetch
+        if current is None:
+            return None
+
+        if current.checkpoint_info != checkpoint_info:
+            # the prefetched checkpoint is for a later switch, such as the next job in queue or the next cell of
+            # X/Y/Z plot, so it stays; this one is going to be read now, so it doesn't need to be prefetched after it
+            if prefetch_next == checkpoint_info:
+                prefetch_next = None
+            return None
+
+    current.done.wait()
+
+    with prefetch_lock:
+        if prefetch is current:
+            prefetch = None
+            start_next_prefetch()
+
+    return current.state_dict
+
+
 def get_checkpoint_state_dict(checkpoint_info: CheckpointInfo, timer):
     sd_model_hash = checkpoint_info.calculate_shorthash()
     timer.record("calculate hash")
@@ -273,13 +401,49 @@ def get_checkpoint_state_dict(checkpoint_info: CheckpointInfo, timer):
         print(f"Loading weights [{sd_model_hash}] from cache")
         return checkpoints_loaded[checkpoint_info]
 
-    print(f"Loading weights [{sd_model_hash}] from {checkpoint_info.filename}")
-    res = read_state_dict(checkpoint_info.filename)
+    res = take_prefetched_state_dict(checkpoint_info)
+    if res is not None:
+        print(f"Loading weights [{sd_model_hash}] from prefetched data")
+        timer.record("wait for prefetch")
+        return res
+
+    filename = checkpoint_file(checkpoint_info)
+
+    if is_streamed_load(checkpoint_info):
+        print(f"Loading weights [{sd_model_hash}] from {filename} (streamed)")
+        res = sd_models_stream.SafetensorsStateDict(filename, transform_checkpoint_dict_key)
+        timer.record("open file")
+
+        return res
+
+    print(f"Loading weights [{sd_model_hash}] from {filename}")
+    res = read_state_dict(filename)
     timer.record("load weights from disk")
 
+    if filename == checkpoint_info.filename:
+        sd_models_converted.save(checkpoint_info, res)
+
     return res
 
 
+def checkpoint_file(checkpoint_info):
+    """returns the file to read weights of the checkpoint from: its converted copy if there is one, or the checkpoint itself"""
+
+    return sd_models_converted.find(checkpoint_info) or checkpoint_info.filename
+
+
+def is_streamed_load(checkpoint_info):
+    """tells whether get_checkpoint_state_dict is going to return a state dict that reads weights from disk as they are copied into the model"""
+
+    if not shared.opts.sd_checkpoint_streamed_load or shared.opts.disable_mmap_load_safetensors or shared.opts.sd_checkpoint_cache > 0:
+        return False
+
+    if checkpoint_info in checkpoints_loaded or has_prefetched_state_dict(checkpoint_info):
+        return False
+
+    return os.path.splitext(checkpoint_file(checkpoint_info))[1].lower() == ".safetensors"
+
+
 def load_model_weights(model, checkpoint_info: CheckpointInfo, state_dict, timer):
     sd_model_hash = checkpoint_info.calculate_shorthash()
     timer.record("calculate hash")
@@ -296,9 +460,29 @@ def load_model_weights(model, checkpoint_info: CheckpointInfo, state_dict, timer
     if model.is_sdxl:
         sd_models_xl.extend_sdxl(model)
 
-    model.load_state_dict(state_dict, strict=False)
-    del state_dict
-    timer.record("apply weights to model")
+    fingerprints = sd_models_delta.get_fingerprints(checkpoint_info, state_dict)
+    unchanged = sd_models_delta.unchanged_keys(model, fingerprints)
+    if unchanged:
+        # the model already has these weights from the previous checkpoint
+        print(f"Reusing {len(unchanged)} of {len(fingerprints)} tensors of previous checkpoint")
+        state_dict = state_dict.without(unchanged) if isinstance(state_dict, sd_models_stream.SafetensorsStateDict) else {k: v for k, v in state_dict.items() if k not in unchanged}
+
+    timer.record("compare weights")
+
+    # until loading is complete, it's not known which weights the model has
+    model.tensor_fingerprints = None
+
+    if isinstance(state_dict, sd_models_stream.SafetensorsStateDict):
+        # convert the model first, so that weights are converted to the final dtype as they are read
+        apply_half(model, timer)
+
+        sd_models_stream.load_into_model(model, state_dict)
+        del state_dict
+        timer.record("apply weights to model (streamed)")
+    else:
+        model.load_state_dict(state_dict, strict=False)
+        del state_dict
+        timer.record("apply weights to model")
 
     if shared.opts.sd_checkpoint_cache > 0:
         # cache newly loaded model
@@ -308,30 +492,15 @@ def load_model_weights(model, checkpoint_info: CheckpointInfo, state_dict, timer
         model.to(memory_format=torch.channels_last)
         timer.record("apply channels_last")
 
-    if not shared.cmd_opts.no_half:
-        vae = model.first_stage_model
-        depth_model = getattr(model, 'depth_model', None)
+    apply_half(model, timer)
 
-        # with --no-half-vae, remove VAE from model when doing half() to prevent its weights from being converted to float16
-        if shared.cmd_opts.no_half_vae:
-            model.first_stage_model = None
-        # with --upcast-sampling, don't convert the depth model weights to float16
-        if shared.cmd_opts.upcast_sampling and depth_model:
-            model.depth_model = None
-
-        model.half()
-        model.first_stage_model = vae
-        if depth_model:
-            model.depth_model = depth_model
-
-        timer.record("apply half()")
-
-    devices.dtype_unet = torch.float16 if model.is_sdxl and not shared.cmd_opts.no_half else model.model.diffusion_model.dtype
-    devices.unet_needs_upcast = shared.cmd_opts.upcast_sampling and devices.dtype == torch.float16 and devices.dtype_unet == torch.float16
+    update_unet_dtype(model)
 
     model.first_stage_model.to(devices.dtype_vae)
     timer.record("apply dtype to VAE")
 
+    model.tensor_fingerprints = fingerprints
+
     # clean up cache if limit is reached
     while len(checkpoints_loaded) > shared.opts.sd_checkpoint_cache:
         checkpoints_loaded.popitem(last=False)
@@ -351,6 +520,33 @@ def load_model_weights(model, checkpoint_info: CheckpointInfo, state_dict, timer
     timer.record("load VAE")
 
 
+def apply_half(model, timer):
+    if shared.cmd_opts.no_half:
+        return
+
+    vae = model.first_stage_model
+    depth_model = getattr(model, 'depth_model', None)
+
+    # with --no-half-vae, remove VAE from model when doing half() to prevent its weights from being converted to float16
+    if shared.cmd_opts.no_half_vae:
+        model.first_stage_model = None
+    # with --upcast-sampling, don't convert the depth model weights to float16
+    if shared.cmd_opts.upcast_sampling and depth_model:
+        model.depth_model = None
+
+    model.half()
+    model.first_stage_model = vae
+    if depth_model:
+        model.depth_model = depth_model
+
+    timer.record("apply half()")
+
+
+def update_unet_dtype(model):
+    devices.dtype_unet = torch.float16 if model.is_sdxl and not shared.cmd_opts.no_half else model.model.diffusion_model.dtype
+    devices.unet_needs_upcast = shared.cmd_opts.upcast_sampling and devices.dtype == torch.float16 and devices.dtype_unet == torch.float16
+
+
 def enable_midas_autodownload():
     """
     Gives the ldm.modules.midas.api.load_model function automatic downloading.
@@ -423,6 +619,8 @@ sdxl_refiner_clip_weight = 'conditioner.embedders.0.model.ln_final.weight'
 class SdModelData:
     def __init__(self):
         self.sd_model = None
+        self.loaded_sd_models = []
+        """all models that are kept loaded, including sd_model, most recently used first"""
         self.was_loaded_at_least_once = False
         self.lock = threading.Lock()
 
@@ -448,10 +646,112 @@ class SdModelData:
     def set_sd_model(self, v):
         self.sd_model = v
 
+        if v is not None:
+            if v in self.loaded_sd_models:
+                self.loaded_sd_models.remove(v)
+
+            self.loaded_sd_models.insert(0, v)
+
 
 model_data = SdModelData()
 
 
+def model_pool_size():
+    """how many models can be kept loaded at the same time; lowvram/medvram modes only support one"""
+
+    if shared.cmd_opts.lowvram or shared.cmd_opts.medvram:
+        return 1
+
+    return max(int(shared.opts.sd_checkpoints_limit), 1)
+
+
+def find_loaded_model(checkpoint_info):
+    return next((x for x in model_data.loaded_sd_models if x.sd_checkpoint_info.filename == checkpoint_info.filename), None)
+
+
+def is_model_on_cpu(m):
+    return m.device.type == "cpu"
+
+
+def deactivate_model(sd_model):
+    """prepares the current model to be kept in the pool while another model is in use"""
+
+    from modules import sd_hijack
+
+    sd_unet.apply_unet("None")
+    sd_hijack.model_hijack.undo_hijack(sd_model)
+
+    # sd_vae keeps track of the VAE of the current model only
+    sd_model.base_vae = sd_vae.base_vae
+    sd_model.loaded_vae_file = sd_vae.loaded_vae_file
+    sd_model.vae_checkpoint_info = sd_vae.checkpoint_info
+
+
+def trim_model_pool(reserve=0):
+    """
+    Moves least recently used models from VRAM to RAM, and unloads those that don't fit in RAM.
+    reserve is the number of places to free for models that are about to be loaded.
+    """
+
+    vram_limit = max(int(shared.opts.sd_checkpoints_vram_limit), 1)
+    pool_size = model_pool_size()
+
+    for i, m in reversed(list(enumerate(model_data.loaded_sd_models, start=reserve))):
+        if m is model_data.sd_model:
+            continue
+
+        if i >= pool_size:
+            print(f"Unloading checkpoint from memory: {m.sd_checkpoint_info.title}")
+            model_data.loaded_sd_models.remove(m)
+        elif i >= vram_limit and not is_model_on_cpu(m):
+            m.to(devices.cpu)
+
+    gc.collect()
+    devices.torch_gc()
+
+
+def switch_to_loaded_model(sd_model, loaded_model, timer):
+    """makes a model from the pool the current model, without reading its weights again"""
+
+    from modules import sd_hijack
+
+    if sd_model is not None:
+        deactivate_model(sd_model)
+
+    model_data.set_sd_model(loaded_model)
+    trim_model_pool()
+    timer.record("move previous model")
+
+    loaded_model.to(devices.device)
+    timer.record("move model to device")
+
+    sd_vae.base_vae = loaded_model.base_vae
+    sd_vae.loaded_vae_file = loaded_model.loaded_vae_file
+    sd_vae.checkpoint_info = loaded_model.vae_checkpoint_info
+    update_unet_dtype(loaded_model)
+
+    shared.opts.data["sd_model_checkpoint"] = loaded_model.sd_checkpoint_info.title
+    shared.opts.data["sd_checkpoint_hash"] = loaded_model.sd_checkpoint_info.sha256
+
+    sd_hijack.model_hijack.hijack(loaded_model)
+    timer.record("hijack")
+
+    if sd_model is None or sd_model.used_config != loaded_model.used_config:
+        sd_hijack.model_hijack.embedding_db.load_textual_inversion_embeddings(force_reload=True)
+        timer.record("load textual inversion embeddings")
+
+    script_callbacks.model_loaded_callback(loaded_model)
+    timer.record("script callbacks")
+
+    sd_vae.reload_vae_weights(loaded_model)
+    timer.record("load VAE")
+
+    print(f"Switched to loaded model {loaded_model.sd_checkpoint_info.title} in {timer.summary()}.")
+    metrics.observe_timer(metrics.model_load_seconds, timer, operation="pool switch")
+
+    return loaded_model
+
+
 def get_empty_cond(sd_model):
     if hasattr(sd_model, 'conditioner'):
         d = sd_model.get_learned_conditioning([""])
@@ -467,6 +767,8 @@ def load_model(checkpoint_info=None, already_loaded_state_dict=None):
 
     if model_data.sd_model:
         sd_hijack.model_hijack.undo_hijack(model_data.sd_model)
+        if model_data.sd_model in model_data.loaded_sd_models:
+            model_data.loaded_sd_models.remove(model_data.sd_model)
         model_data.sd_model = None
         gc.collect()
         devices.torch_gc()
@@ -480,8 +782,9 @@ def load_model(checkpoint_info=None, already_loaded_state_dict=None):
     else:
         state_dict = get_checkpoint_state_dict(checkpoint_info, timer)
 
-    checkpoint_config = sd_models_config.find_checkpoint_config(state_dict, checkpoint_info)
-    clip_is_included_into_sd = any(x for x in [sd1_clip_weight, sd2_clip_weight, sdxl_clip_weight, sdxl_refiner_clip_weight] if x in state_dict)
+    layout = sd_models_config.checkpoint_layout(checkpoint_info, state_dict)
+    checkpoint_config = layout["config"]
+    clip_is_included_into_sd = layout["clip_included"]
 
     timer.record("find config")
 
@@ -521,7 +824,7 @@ def load_model(checkpoint_info=None, already_loaded_state_dict=None):
     timer.record("hijack")
 
     sd_model.eval()
-    model_data.sd_model = sd_model
+    model_data.set_sd_model(sd_model)
     model_data.was_loaded_at_least_once = True
 
     sd_hijack.model_hijack.embedding_db.load_textual_inversion_embeddings(force_reload=True)  # Reload embeddings after model load as they may or may not fit the model
@@ -538,6 +841,7 @@ def load_model(checkpoint_info=None, already_loaded_state_dict=None):
     timer.record("calculate empty prompt")
 
     print(f"Model loaded in {timer.summary()}.")
+    metrics.observe_timer(metrics.model_load_seconds, timer, operation="load")
 
     return sd_model
 
@@ -549,31 +853,71 @@ def reload_model_weights(sd_model=None, info=None):
     if not sd_model:
         sd_model = model_data.sd_model
 
+    if sd_model is not None and sd_model.sd_model_checkpoint == checkpoint_info.filename:
+        return
+
+    loaded_model = find_loaded_model(checkpoint_info)
+    if loaded_model is not None:
+        return switch_to_loaded_model(sd_model, loaded_model, Timer())
+
+    if sd_model is not None and len(model_data.loaded_sd_models) < model_pool_size():
+        # there is room in the pool: keep the current model and create a new one
+        deactivate_model(sd_model)
+        model_data.sd_model = None
+        trim_model_pool(reserve=1)
+
+        try:
+            load_model(checkpoint_info)
+        except Exception:
+            print("Failed to load checkpoint, restoring previous")
+            if sd_model in model_data.loaded_sd_models:
+                switch_to_loaded_model(None, sd_model, Timer())
+            raise
+
+        return model_data.sd_model
+
+    if sd_model is not None and model_pool_size() > 1 and model_data.loaded_sd_models[-1] is not sd_model:
+        # the pool is full: load new weights into the least recently used model instead of the current one
+        deactivate_model(sd_model)
+        sd_model = model_data.loaded_sd_models[-1]
+        model_data.set_sd_model(sd_model)
+        trim_model_pool()
+
     if sd_model is None:  # previous model load failed
         current_checkpoint_info = None
     else:
         current_checkpoint_info = sd_model.sd_checkpoint_info
-        if sd_model.sd_model_checkpoint == checkpoint_info.filename:
-            return
 
         sd_unet.apply_unet("None")
 
         if shared.cmd_opts.lowvram or shared.cmd_opts.medvram:
             lowvram.send_everything_to_cpu()
-        else:
+        elif not has_prefetched_state_dict(checkpoint_info) and not is_streamed_load(checkpoint_info):
+            # with prefetched weights in pinned memory or weights streamed from disk, it's faster to copy them straight into the model on GPU
             sd_model.to(devices.cpu)
 
         sd_hijack.model_hijack.undo_hijack(sd_model)
 
     timer = Timer()
 
-    state_dict = get_checkpoint_state_dict(checkpoint_info, timer)
+    # in most cases, the config is known without reading weights, so they are not read if a new model has to be created anyway
+    state_dict = None
+    layout = sd_models_config.checkpoint_layout(checkpoint_info)
+    if layout is None:
+        state_dict = get_checkpoint_state_dict(checkpoint_info, timer)
+        layout = sd_models_config.checkpoint_layout(checkpoint_info, state_dict)
 
-    checkpoint_config = sd_models_config.find_checkpoint_config(state_dict, checkpoint_info)
+    checkpoint_config = layout["config"]
 
     timer.record("find config")
 
     if sd_model is None or checkpoint_config != sd_model.used_config:
+        if sd_model is not None:
+            sd_model.to(devices.cpu)
+
+        if sd_model in model_data.loaded_sd_models:
+            model_data.loaded_sd_models.remove(sd_model)
+
         del sd_model
         load_model(checkpoint_info, already_loaded_state_dict=state_dict)
         return model_data.sd_model
@@ -596,6 +940,7 @@ def reload_model_weights(sd_model=None, info=None):
             timer.record("move model to device")
 
     print(f"Weights loaded in {timer.summary()}.")
+    metrics.observe_timer(metrics.model_load_seconds, timer, operation="switch")
 
     return sd_model
 
@@ -608,6 +953,7 @@ def unload_model_weights(sd_model=None, info=None):
         model_data.sd_model.to(devices.cpu)
         sd_hijack.model_hijack.undo_hijack(model_data.sd_model)
         model_data.sd_model = None
+        model_data.loaded_sd_models.clear()
         sd_model = None
         gc.collect()
         devices.torch_gc()
@@ -1,8 +1,10 @@
+import hashlib
+import json
 import os
 
 import torch
 
-from modules import shared, paths, sd_disable_initialization
+from modules import shared, paths, sd_disable_initialization, cache
 
 sd_configs_path = shared.sd_configs_path
 sd_repo_configs_path = os.path.join(paths.paths['Stable Diffusion'], "configs", "stable-diffusion")
@@ -22,6 +24,49 @@ config_inpainting = os.path.join(sd_configs_path, "v1-inpainting-inference.yaml"
 config_instruct_pix2pix = os.path.join(sd_configs_path, "instruct-pix2pix.yaml")
 config_alt_diffusion = os.path.join(sd_configs_path, "alt-diffusion-inference.yaml")
 
+# increase when detection changes, to discard results cached by previous versions
+layout_version = 1
+
+clip_weights = [
+    'cond_stage_model.transformer.text_model.embeddings.token_embedding.weight',
+    'cond_stage_model.model.transformer.resblocks.0.attn.in_proj_weight',
+    'conditioner.embedders.1.model.ln_final.weight',
+    'conditioner.embedders.0.model.ln_final.weight',
+]
+
+
+class TensorHeader:
+    """stands in for a tensor when only the safetensors header has been read"""
+
+    def __init__(self, dtype, shape):
+        self.dtype = dtype
+        self.shape = torch.Size(shape)
+
+
+class SafetensorsHeader(dict):
+    """state dict with TensorHeader objects instead of tensors"""
+
+    has_weights = False
+
+
+def read_safetensors_header(filename):
+    from modules import sd_models
+
+    with open(filename, "rb") as file:
+        header_len = int.from_bytes(file.read(8), "little")
+        header = json.loads(file.read(header_len))
+
+    res = SafetensorsHeader()
+    for name, value in header.items():
+        if name == "__metadata__":
+            continue
+
+        key = sd_models.transform_checkpoint_dict_key(name)
+        if key is not None:
+            res[key] = TensorHeader(value["dtype"], value["shape"])
+
+    return res
+
 
 def is_using_v_parameterization_for_sd2(state_dict):
     """
@@ -85,6 +130,8 @@ def guess_model_config_from_state_dict(sd, filename):
     if sd2_cond_proj_weight is not None and sd2_cond_proj_weight.shape[1] == 1024:
         if diffusion_model_input.shape[1] == 9:
             return config_sd2_inpainting
+        elif not getattr(sd, "has_weights", True):
+            return None  # can't tell from shapes alone
         elif is_using_v_parameterization_for_sd2(sd):
             return config_sd2v
         else:
@@ -113,6 +160,75 @@ def find_checkpoint_config(state_dict, info):
     return guess_model_config_from_state_dict(state_dict, info.filename)
 
 
+def describe_layout(state_dict, info):
+    """returns config and other properties of a checkpoint that can be told from its state dict, or None if state_dict does not have enough information"""
+
+    config = guess_model_config_from_state_dict(state_dict, info.filename if info else "")
+    if config is None:
+        return None
+
+    keys = sorted(state_dict.keys())
+    is_sdxl = any(x.startswith("conditioner.") for x in keys)
+
+    return {
+        "version": layout_version,
+        "config": config,
+        "is_sdxl": is_sdxl,
+        "is_sd2": not is_sdxl and any(x.startswith("cond_stage_model.model.") for x in keys),
+        "clip_included": any(x in state_dict for x in clip_weights),
+        "keys": len(keys),
+        "layout": hashlib.sha256("\n".join(keys).encode("utf8")).hexdigest(),
+    }
+
+
+def checkpoint_layout(info, state_dict=None):
+    """
+    Returns the dict from describe_layout for the checkpoint. Results are cached by the checkpoint's sha256, and for
+    .safetensors files are worked out from the header when possible, so in most cases this does not need the weights.
+    Returns None if state_dict is not given and the weights are needed. A config file next to the checkpoint always
+    takes precedence over the detected one.
+    """
+
+    layouts = cache.cache("checkpoint-layout")
+
+    layout = getattr(info, "layout", None)
+    if layout is None and info.sha256 is not None:
+        layout = layouts.get(info.sha256)
+
+    if layout is not None and (layout.get("version") != layout_version or not os.path.exists(layout["config"])):
+        layout = None
+
+    if layout is None and state_dict is None and os.path.splitext(info.filename)[1].lower() == ".safetensors":
+        try:
+            layout = describe_layout(read_safetensors_header(info.filename), info)
+        except Exception as e:
+            from modules import errors
+            errors.display(e, f"reading header of {info.filename}")
+
+    if layout is None and state_dict is not None:
+        layout = describe_layout(state_dict, info)
+
+    if layout is None:
+        return None
+
+    info.layout = layout
+    if info.sha256 is not None and info.sha256 not in layouts:
+        layouts[info.sha256] = layout
+
+    config = find_checkpoint_config_near_filename(info)
+    if config is not None:
+        layout = {**layout, "config": config}
+
+    return layout
+
+
+def architecture_name(layout):
+    if layout is None:
+        return None
+
+    return "sdxl" if layout["is_sdxl"] else "sd2" if layout["is_sd2"] else "sd1"
+
+
 def find_checkpoint_config_near_filename(info):
     if info is None:
         return None
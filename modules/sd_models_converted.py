@@ -0,0 +1,143 @@
+import os
+import threading
+
+import safetensors.torch
+import torch
+
+from modules import shared, errors
+from modules.paths import data_path
+
+converted_dir = os.path.join(data_path, "cache", "checkpoints")
+save_lock = threading.Lock()
+
+
+def conversion_name():
+    """describes dtypes of a converted checkpoint; converted files made with different settings are kept apart"""
+
+    if shared.cmd_opts.no_half:
+        return "fp32"
+
+    name = "fp16"
+    if shared.cmd_opts.no_half_vae:
+        name += "-vae32"
+    if shared.cmd_opts.upcast_sampling:
+        name += "-depth32"
+
+    return name
+
+
+def converted_filename(checkpoint_info):
+    return os.path.join(converted_dir, f"{checkpoint_info.sha256}.{conversion_name()}.safetensors")
+
+
+def is_convertible(checkpoint_info):
+    if not shared.opts.sd_checkpoint_convert_ckpt or shared.opts.sd_checkpoint_convert_ckpt_size <= 0:
+        return False
+
+    return checkpoint_info.sha256 is not None and os.path.splitext(checkpoint_info.filename)[1].lower() == ".ckpt"
+
+
+def find(checkpoint_info):
+    """returns the filename of converted copy of the checkpoint, or None if there isn't one"""
+
+    if not is_convertible(checkpoint_info):
+        return None
+
+    filename = converted_filename(checkpoint_info)
+    if not os.path.exists(filename):
+        return None
+
+    # mtime records last use, for eviction
+    os.utime(filename)
+
+    return filename
+
+
+def target_dtype(key):
+    if shared.cmd_opts.no_half:
+        return torch.float32
+
+    if shared.cmd_opts.no_half_vae and key.startswith("first_stage_model."):
+        return None
+
+    if shared.cmd_opts.upcast_sampling and key.startswith("depth_model."):
+        return None
+
+    return torch.float16
+
+
+def save(checkpoint_info, state_dict):
+    """
+    Writes a .safetensors copy of the checkpoint with weights converted to the dtype the model is going to use,
+    so that next time it can be loaded via mmap without unpickling or converting. Converting and writing are done on
+    a background thread; the loaded tensors are only read, never modified, and the thread lets go of each one as soon as
+    it's converted. Until then it keeps them alive even if the model no longer needs them, so on top of the model RAM use
+    peaks at about the size of the checkpoint's weights, in their original dtype.
+    """
+
+    if not is_convertible(checkpoint_info):
+        return
+
+    filename = converted_filename(checkpoint_info)
+    if os.path.exists(filename):
+        return
+
+    tensors = {k: v for k, v in state_dict.items() if isinstance(v, torch.Tensor)}
+
+    threading.Thread(target=write, args=(checkpoint_info, filename, tensors), name="checkpoint conversion", daemon=True).start()
+
+
+def convert(tensors):
+    """converts tensors for saving; empties the tensors dict as it goes so that each source tensor can be freed once converted"""
+
+    converted = {}
+    while tensors:
+        key, value = tensors.popitem()
+        dtype = target_dtype(key) if value.is_floating_point() else None
+
+        # safetensors can't save tensors that share memory, so each one gets its own copy
+        converted[key] = value.detach().to(device="cpu", dtype=dtype or value.dtype, copy=True).contiguous()
+
+    return converted
+
+
+def write(checkpoint_info, filename, tensors):
+    with save_lock:
+        try:
+            converted = convert(tensors)
+            os.makedirs(converted_dir, exist_ok=True)
+            safetensors.torch.save_file(converted, filename + ".tmp", metadata={"source": checkpoint_info.filename, "sha256": checkpoint_info.sha256})
+            os.replace(filename + ".tmp", filename)
+            print(f"Saved converted copy of {checkpoint_info.filename} to {filename}")
+        except Exception as e:
+            errors.display(e, f"saving converted copy of {checkpoint_info.filename}")
+
+            if os.path.exists(filename + ".tmp"):
+                os.remove(filename + ".tmp")
+
+            return
+
+        trim(keep=filename)
+
+
+def trim(keep=None):
+    """removes least recently used converted checkpoints until their total size is within the limit"""
+
+    if not os.path.isdir(converted_dir):
+        return
+
+    limit = shared.opts.sd_checkpoint_convert_ckpt_size * 1024 ** 3
+
+    files = [os.path.join(converted_dir, x) for x in os.listdir(converted_dir) if x.endswith(".safetensors")]
+    files = sorted(files, key=os.path.getmtime)
+    total = sum(os.path.getsize(x) for x in files)
+
+    for filename in files:
+        if total <= limit:
+            break
+
+        if filename == keep:
+            continue
+
+        total -= os.path.getsize(filename)
+        os.remove(filename)
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import mmap
+import os
+
+import torch
+
+from modules import shared, cache
+
+safetensors_dtype_names = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+
+
+def digest(dtype_name, shape, data):
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{dtype_name}{list(shape)}".encode("utf8"))
+    h.update(data)
+    return h.hexdigest()
+
+
+def tensor_digest(tensor):
+    data = tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy()
+    return digest(safetensors_dtype_names.get(tensor.dtype, str(tensor.dtype)), tensor.shape, data)
+
+
+def safetensors_fingerprints(filename, key_transform):
+    """digests of all tensors in a .safetensors file, hashing their bytes directly from the file without creating tensors"""
+
+    res = {}
+
+    with open(filename, "rb") as file:
+        header_len = int.from_bytes(file.read(8), "little")
+        header = json.loads(file.read(header_len))
+        data_start = 8 + header_len
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+            for name, info in header.items():
+                if name == "__metadata__":
+                    continue
+
+                key = key_transform(name)
+                if key is None:
+                    continue
+
+                start, end = info["data_offsets"]
+                data = view[data_start + start:data_start + end]
+                res[key] = digest(info["dtype"], info["shape"], data)
+                data.release()
+
+    return res
+
+
+def state_dict_fingerprints(state_dict):
+    return {k: tensor_digest(v) for k, v in state_dict.items() if isinstance(v, torch.Tensor)}
+
+
+def get_fingerprints(checkpoint_info, state_dict=None):
+    """
+    Returns digests of all tensors in the checkpoint by key, or None if delta-aware switching is disabled.
+    They are computed once for each checkpoint and kept in cache by the checkpoint's sha256.
+    """
+
+    if not shared.opts.sd_checkpoint_delta_switch:
+        return None
+
+    fingerprints = getattr(checkpoint_info, "tensor_fingerprints", None)
+    if fingerprints is not None:
+        return fingerprints
+
+    fingerprints_cache = cache.cache("checkpoint-tensors")
+    if checkpoint_info.sha256 is not None:
+        fingerprints = fingerprints_cache.get(checkpoint_info.sha256)
+
+    if fingerprints is None:
+        from modules import sd_models
+
+        if os.path.splitext(checkpoint_info.filename)[1].lower() == ".safetensors":
+            fingerprints = safetensors_fingerprints(checkpoint_info.filename, sd_models.transform_checkpoint_dict_key)
+        elif state_dict is not None:
+            fingerprints = state_dict_fingerprints(state_dict)
+        else:
+            return None
+
+        if checkpoint_info.sha256 is not None:
+            fingerprints_cache[checkpoint_info.sha256] = fingerprints
+
+    checkpoint_info.tensor_fingerprints = fingerprints
+    return fingerprints
+
+
+def forget_modified_by_networks(model):
+    """
+    Marks weights of layers that extra networks have changed in place as unknown. Lora with lora_functional off merges its
+    weights into layers and keeps originals in network_weights_backup; loading a state dict into the model discards that backup,
+    so such layers must get their weights from the checkpoint again.
+    """
+
+    current = getattr(model, "tensor_fingerprints", None)
+    if not current:
+        return
+
+    prefixes = tuple(
+        f"{name}."
+        for name, module in model.named_modules()
+        if getattr(module, "network_weights_backup", None) is not None or getattr(module, "network_current_names", ())
+    )
+
+    if prefixes:
+        model.tensor_fingerprints = {k: v for k, v in current.items() if not k.startswith(prefixes)}
+
+
+def unchanged_keys(model, fingerprints):
+    """returns keys of tensors that model already has with the same contents as the checkpoint described by fingerprints"""
+
+    forget_modified_by_networks(model)
+
+    current = getattr(model, "tensor_fingerprints", None)
+    if not current or not fingerprints:
+        return set()
+
+    return {k for k, v in fingerprints.items() if current.get(k) == v}
+
+
+def forget(model, prefix=""):
+    """marks weights whose names start with prefix as unknown, after they've been changed by something other than loading a checkpoint"""
+
+    current = getattr(model, "tensor_fingerprints", None)
+    if not current:
+        return
+
+    model.tensor_fingerprints = {k: v for k, v in current.items() if not k.startswith(prefix)} if prefix else None
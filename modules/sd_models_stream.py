@@ -0,0 +1,115 @@
+import collections.abc
+import copy
+import queue
+import threading
+
+import torch
+from safetensors import safe_open
+
+
+class SafetensorsStateDict(collections.abc.Mapping):
+    """
+    Read-only state dict backed by a safetensors file; tensors are read from the memory-mapped file only when accessed.
+    key_transform converts names of tensors in file into names used by the model; if it returns None, the tensor is skipped.
+    """
+
+    def __init__(self, filename, key_transform=None):
+        self.filename = filename
+        self.file = safe_open(filename, framework="pt", device="cpu")
+        self.names = {}
+
+        for name in self.file.keys():
+            key = key_transform(name) if key_transform is not None else name
+            if key is not None:
+                self.names[key] = name
+
+    def __getitem__(self, key):
+        return self.file.get_tensor(self.names[key])
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, key):
+        return key in self.names
+
+    def without(self, keys):
+        """returns a state dict for the same file that skips the specified keys"""
+
+        res = copy.copy(self)
+        res.names = {k: v for k, v in self.names.items() if k not in keys}
+        return res
+
+
+def read_chunks(state_dict, targets, chunk_size, output, stop):
+    chunk = {}
+    size = 0
+
+    try:
+        for key in state_dict:
+            if stop.is_set():
+                return
+
+            tensor = state_dict[key]
+
+            target = targets.get(key)
+            if target is not None and target.dtype != tensor.dtype and tensor.is_floating_point() and target.is_floating_point():
+                tensor = tensor.to(target.dtype)
+
+            chunk[key] = tensor
+            size += tensor.numel() * tensor.element_size()
+
+            if size >= chunk_size:
+                output.put(chunk)
+                chunk = {}
+                size = 0
+
+        if chunk:
+            output.put(chunk)
+    except Exception as e:
+        output.put(e)
+    finally:
+        output.put(None)
+
+
+def load_into_model(model, state_dict: SafetensorsStateDict, chunk_size=64 * 1024 * 1024, chunks_ahead=2):
+    """
+    Loads weights from state_dict into model without reading the whole file into memory: a background thread reads
+    tensors from disk a chunk at a time and converts them to dtype of model's parameters, while this thread copies
+    previous chunk into the model (to GPU, if the model is there). Uses model.load_state_dict for each chunk, so hooks
+    on modules' _load_from_state_dict still run. Works like model.load_state_dict(state_dict, strict=False).
+    """
+
+    targets = model.state_dict(keep_vars=True)
+    chunks = queue.Queue(maxsize=chunks_ahead)
+    stop = threading.Event()
+
+    reader = threading.Thread(target=read_chunks, args=(state_dict, targets, chunk_size, chunks, stop), name="safetensors reader", daemon=True)
+    reader.start()
+
+    del targets
+
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+
+            if isinstance(chunk, Exception):
+                raise chunk
+
+            with torch.no_grad():
+                model.load_state_dict(chunk, strict=False)
+
+            del chunk
+    finally:
+        stop.set()
+
+        # let the reader finish if it's blocked on a full queue
+        while reader.is_alive():
+            try:
+                chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
@@ -35,6 +35,7 @@ class VanillaStableDiffusionSampler:
         self.step = 0
         self.stop_at = None
         self.eta = None
+        self.cond_tables = {}
         self.config = None
         self.last_latent = None
 
@@ -80,8 +81,8 @@ class VanillaStableDiffusionSampler:
             cond = cond["c_crossattn"][0]
             unconditional_conditioning = unconditional_conditioning["c_crossattn"][0]
 
-        conds_list, tensor = prompt_parser.reconstruct_multicond_batch(cond, self.step)
-        unconditional_conditioning = prompt_parser.reconstruct_cond_batch(unconditional_conditioning, self.step)
+        conds_list, tensor = prompt_parser.reconstruct_multicond_batch(cond, self.step, self.cond_tables)
+        unconditional_conditioning = prompt_parser.reconstruct_cond_batch(unconditional_conditioning, self.step, self.cond_tables)
 
         assert all(len(conds) == 1 for conds in conds_list), 'composition via AND is not supported for DDIM/PLMS samplers'
         cond = tensor
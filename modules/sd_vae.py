@@ -1,6 +1,6 @@
 import os
 import collections
-from modules import paths, shared, devices, script_callbacks, sd_models
+from modules import paths, shared, devices, script_callbacks, sd_models, sd_models_delta
 import glob
 from copy import deepcopy
 
@@ -14,7 +14,8 @@ base_vae = None
 loaded_vae_file = None
 checkpoint_info = None
 
-checkpoints_loaded = collections.OrderedDict()
+vae_cache = collections.OrderedDict()  # filename -> (mtime, state dict in VAE dtype), least recently used first
+vae_near_checkpoint = {}  # checkpoint filename -> VAE filename or None; rebuilt when the list of VAEs changes
 
 def get_base_vae(model):
     if base_vae is not None and checkpoint_info == model.sd_checkpoint_info and model:
@@ -50,8 +51,6 @@ def get_filename(filepath):
 
 
 def refresh_vae_list():
-    vae_dict.clear()
-
     paths = [
         os.path.join(sd_models.model_path, '**/*.vae.ckpt'),
         os.path.join(sd_models.model_path, '**/*.vae.pt'),
@@ -79,18 +78,38 @@ def refresh_vae_list():
     for path in paths:
         candidates += glob.iglob(path, recursive=True)
 
+    previous_vae_files = list(vae_dict.values())
+    vae_dict.clear()
+
     for filepath in candidates:
         name = get_filename(filepath)
         vae_dict[name] = filepath
 
+    if list(vae_dict.values()) != previous_vae_files:
+        build_vae_near_checkpoint_map()
+
+
+def build_vae_near_checkpoint_map():
+    vae_near_checkpoint.clear()
+
+    for info in list(sd_models.checkpoints_list.values()):
+        find_vae_near_checkpoint(info.filename)
+
 
 def find_vae_near_checkpoint(checkpoint_file):
+    if checkpoint_file in vae_near_checkpoint:
+        return vae_near_checkpoint[checkpoint_file]
+
+    res = None
+
     checkpoint_path = os.path.basename(checkpoint_file).rsplit('.', 1)[0]
     for vae_file in vae_dict.values():
         if os.path.basename(vae_file).startswith(checkpoint_path):
-            return vae_file
+            res = vae_file
+            break
 
-    return None
+    vae_near_checkpoint[checkpoint_file] = res
+    return res
 
 
 def resolve_vae(checkpoint_file):
@@ -122,6 +141,30 @@ def load_vae_dict(filename, map_location):
     return vae_dict_1
 
 
+def get_cached_vae(vae_file):
+    entry = vae_cache.get(vae_file)
+    if entry is None:
+        return None
+
+    mtime, state_dict = entry
+    if not os.path.exists(vae_file) or os.path.getmtime(vae_file) != mtime:
+        del vae_cache[vae_file]
+        return None
+
+    vae_cache.move_to_end(vae_file)
+    return state_dict
+
+
+def cache_vae(vae_file, state_dict):
+    """keeps a copy of VAE weights in RAM, already converted to the dtype used for VAE, separately from cached checkpoints"""
+
+    vae_cache[vae_file] = (os.path.getmtime(vae_file), {k: v.to(devices.cpu, devices.dtype_vae) if v.is_floating_point() else v.to(devices.cpu) for k, v in state_dict.items()})
+    vae_cache.move_to_end(vae_file)
+
+    while len(vae_cache) > shared.opts.sd_vae_checkpoint_cache:
+        vae_cache.popitem(last=False)
+
+
 def load_vae(model, vae_file=None, vae_source="from unknown source"):
     global vae_dict, loaded_vae_file
     # save_settings = False
@@ -129,11 +172,13 @@ def load_vae(model, vae_file=None, vae_source="from unknown source"):
     cache_enabled = shared.opts.sd_vae_checkpoint_cache > 0
 
     if vae_file:
-        if cache_enabled and vae_file in checkpoints_loaded:
+        cached_vae = get_cached_vae(vae_file) if cache_enabled else None
+
+        if cached_vae is not None:
             # use vae checkpoint cache
             print(f"Loading VAE weights {vae_source}: cached {get_filename(vae_file)}")
             store_base_vae(model)
-            _load_vae_dict(model, checkpoints_loaded[vae_file])
+            _load_vae_dict(model, cached_vae)
         else:
             assert os.path.isfile(vae_file), f"VAE {vae_source} doesn't exist: {vae_file}"
             print(f"Loading VAE weights {vae_source}: {vae_file}")
@@ -143,13 +188,7 @@ def load_vae(model, vae_file=None, vae_source="from unknown source"):
             _load_vae_dict(model, vae_dict_1)
 
             if cache_enabled:
-                # cache newly loaded vae
-                checkpoints_loaded[vae_file] = vae_dict_1.copy()
-
-        # clean up cache if limit is reached
-        if cache_enabled:
-            while len(checkpoints_loaded) > shared.opts.sd_vae_checkpoint_cache + 1: # we need to count the current model
-                checkpoints_loaded.popitem(last=False)  # LRU
+                cache_vae(vae_file, vae_dict_1)
 
         # If vae used is not in dict, update it
         # It will be removed on refresh though
@@ -167,6 +206,7 @@ def load_vae(model, vae_file=None, vae_source="from unknown source"):
 def _load_vae_dict(model, vae_dict_1):
     model.first_stage_model.load_state_dict(vae_dict_1)
     model.first_stage_model.to(devices.dtype_vae)
+    sd_models_delta.forget(model, "first_stage_model.")
 
 
 def clear_loaded_vae():
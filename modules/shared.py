@@ -109,6 +109,7 @@ class State:
     textinfo = None
     time_start = None
     server_start = None
+    draining = False
     _server_command_signal = threading.Event()
     _server_command: Optional[str] = None
 
@@ -392,6 +393,27 @@ options_templates.update(options_section(('system', "System"), {
     "print_hypernet_extra": OptionInfo(False, "Print extra hypernetwork information to console."),
     "list_hidden_files": OptionInfo(True, "Load models/files in hidden directories").info("directory is hidden if its name starts with \".\""),
     "disable_mmap_load_safetensors": OptionInfo(False, "Disable memmapping for loading .safetensors files.").info("fixes very slow loading speed in some cases"),
+    "hashing_workers": OptionInfo(2, "Number of threads calculating hashes of model files", gr.Slider, {"minimum": 1, "maximum": 8, "step": 1}).info("requires restart to lower"),
+    "hash_models_in_background": OptionInfo(False, "Calculate hashes of all checkpoints in background").info("on startup and after refreshing the list of checkpoints; files that are about to be used are hashed first"),
+    "sd_checkpoint_convert_ckpt": OptionInfo(False, "Keep converted copies of .ckpt checkpoints").info("on first load, saves weights of a .ckpt checkpoint as .safetensors in the dtype used by the model, and loads that copy next time; copies are kept in cache/checkpoints; while a copy is being written, RAM use is higher by up to the size of the checkpoint"),
+    "sd_checkpoint_convert_ckpt_size": OptionInfo(20, "Maximum size of converted .ckpt copies", gr.Number).info("in GB; least recently used copies are removed first"),
+    "sd_checkpoint_streamed_load": OptionInfo(False, "Stream weights of .safetensors checkpoints into the model").info("reads the file a piece at a time while copying to the model, instead of reading it all into RAM first; lowers peak RAM use when switching checkpoints; not used with checkpoint cache in RAM or disabled memmapping"),
+}))
+
+options_templates.update(options_section(('queue', "Job queue"), {
+    "queue_priority_aging": OptionInfo(60, "Queue priority aging period", gr.Number).info("in seconds; a waiting job is promoted by one priority class for every period it spends in queue; 0 = disable"),
+    "api_default_priority": OptionInfo("normal", "Default priority of API jobs", gr.Radio, {"choices": ["interactive", "normal", "batch"]}).info("web UI jobs always run as interactive; API requests can override this with the priority field"),
+    "api_queue_persist": OptionInfo(True, "Save queued API tasks to disk").info("tasks submitted with /sdapi/v1/*/submit that did not finish before the server stopped are submitted again after it starts"),
+    "api_task_results_limit": OptionInfo(256, "Number of finished API task results to keep", gr.Number, {"precision": 0}).info("for tasks submitted with /sdapi/v1/*/submit; oldest results are discarded first"),
+    "result_store_limit": OptionInfo(16, "Number of finished web UI task results to keep", gr.Number, {"precision": 0}).info("used to restore results when the page is reloaded while a generation is running"),
+    "result_store_ttl": OptionInfo(3600, "Time to keep finished task results", gr.Number).info("in seconds; 0 = until pushed out by newer results"),
+    "result_store_spill_to_disk": OptionInfo(False, "Save discarded task results to disk").info("results pushed out of memory are kept in cache/results directory and can still be retrieved, also after a restart"),
+    "result_store_disk_limit": OptionInfo(1024, "Number of task results to keep on disk", gr.Number, {"precision": 0}),
+    "api_batching_enabled": OptionInfo(False, "Merge compatible txt2img API requests into batches").info("single-image requests that differ only in prompt and seed are generated together as one batch"),
+    "api_batching_window": OptionInfo(50, "Batching window for txt2img API requests", gr.Number, {"precision": 0}).info("in milliseconds; how long to wait for more compatible requests before queueing a batch"),
+    "api_batching_max_batch_size": OptionInfo(8, "Maximum batch size for merged txt2img API requests", gr.Slider, {"minimum": 1, "maximum": 64, "step": 1}),
+    "api_image_encoding_threads": OptionInfo(4, "Threads for encoding images in API responses", gr.Slider, {"minimum": 1, "maximum": 16, "step": 1}),
+    "api_png_compress_level": OptionInfo(6, "PNG compression level for images in API responses", gr.Slider, {"minimum": 0, "maximum": 9, "step": 1}).info("0 = no compression, fastest; 9 = smallest files, slowest; requests can override this with png_compress_level"),
 }))
 
 options_templates.update(options_section(('training', "Training"), {
@@ -412,7 +434,11 @@ options_templates.update(options_section(('training', "Training"), {
 options_templates.update(options_section(('sd', "Stable Diffusion"), {
     "sd_model_checkpoint": OptionInfo(None, "Stable Diffusion checkpoint", gr.Dropdown, lambda: {"choices": list_checkpoint_tiles()}, refresh=refresh_checkpoints),
     "sd_checkpoint_cache": OptionInfo(0, "Checkpoints to cache in RAM", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}),
-    "sd_vae_checkpoint_cache": OptionInfo(0, "VAE Checkpoints to cache in RAM", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}),
+    "sd_checkpoints_limit": OptionInfo(1, "Maximum number of checkpoints loaded at the same time", gr.Slider, {"minimum": 1, "maximum": 10, "step": 1}).info("switching to a loaded checkpoint only moves it to GPU instead of reading its weights again; least recently used checkpoint is replaced first"),
+    "sd_checkpoint_prefetch": OptionInfo(False, "Prefetch checkpoints needed by queued jobs").info("reads weights of the checkpoint that the next job or next X/Y/Z plot cell is going to use while the current job runs; needs enough RAM for an extra copy of a checkpoint"),
+    "sd_checkpoint_delta_switch": OptionInfo(False, "Only replace weights that differ when switching checkpoints").info("keeps a digest of every tensor of each checkpoint, computed on its first load; switching between fine-tunes or merges that share text encoder, VAE or parts of UNet then skips copying tensors that are the same"),
+    "sd_checkpoints_vram_limit": OptionInfo(1, "Maximum number of checkpoints kept in VRAM", gr.Slider, {"minimum": 1, "maximum": 10, "step": 1}).info("loaded checkpoints beyond this number are kept in RAM; does not apply to --lowvram and --medvram"),
+    "sd_vae_checkpoint_cache": OptionInfo(0, "VAE Checkpoints to cache in RAM", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}).info("kept separately from cached checkpoints, already converted to the dtype used for VAE"),
     "sd_vae": OptionInfo("Automatic", "SD VAE", gr.Dropdown, lambda: {"choices": shared_items.sd_vae_items()}, refresh=shared_items.refresh_vae_list).info("choose VAE model: Automatic = use one with same filename as checkpoint; None = use VAE from checkpoint"),
     "sd_vae_as_default": OptionInfo(True, "Ignore selected VAE for stable diffusion checkpoints that have their own .vae.pt next to them"),
     "sd_unet": OptionInfo("Automatic", "SD Unet", gr.Dropdown, lambda: {"choices": shared_items.sd_unet_items()}, refresh=shared_items.refresh_unet_list).info("choose Unet model: Automatic = use one with same filename as checkpoint; None = use Unet from checkpoint"),
@@ -446,6 +472,10 @@ options_templates.update(options_section(('optimizations', "Optimizations"), {
     "token_merging_ratio_hr": OptionInfo(0.0, "Token merging ratio for high-res pass", gr.Slider, {"minimum": 0.0, "maximum": 0.9, "step": 0.1}).info("only applies if non-zero and overrides above"),
     "pad_cond_uncond": OptionInfo(False, "Pad prompt/negative prompt to be same length").info("improves performance when prompt and negative prompt have different lengths; changes seeds"),
     "experimental_persistent_cond_cache": OptionInfo(False, "persistent cond cache").info("Experimental, keep cond caches across jobs, reduce overhead."),
+    "cond_cache_size": OptionInfo(256, "Prompt conditioning cache size", gr.Number, {"precision": 0}).info("in MB of VRAM; calculated conditionings for prompts are shared by all jobs, least recently used are discarded first; 0=disable"),
+    "cond_chunk_cache_size": OptionInfo(512, "Text encoder chunk cache size", gr.Number, {"precision": 0}).info("number of 75-token prompt chunks to remember text encoder outputs for, so that only changed parts of long prompts are encoded again; 0=disable"),
+    "output_cache_enabled": OptionInfo(False, "Cache generated images for repeated requests").info("a request with a fixed seed and exactly the same parameters, model and settings as an earlier one returns stored images without generating; cached results are not saved to disk again"),
+    "output_cache_size": OptionInfo(512, "Output cache size", gr.Number, {"precision": 0}).info("in MB of uncompressed image data; least recently used results are discarded first"),
 }))
 
 options_templates.update(options_section(('compatibility', "Compatibility"), {
@@ -13,7 +13,7 @@ import numpy as np
 from PIL import Image, PngImagePlugin
 from torch.utils.tensorboard import SummaryWriter
 
-from modules import shared, devices, sd_hijack, processing, sd_models, images, sd_samplers, sd_hijack_checkpoint, errors, hashes
+from modules import shared, devices, sd_hijack, processing, sd_models, images, sd_samplers, sd_hijack_checkpoint, errors, hashes, cond_cache
 import modules.textual_inversion.dataset
 from modules.textual_inversion.learn_schedule import LearnRateScheduler
 
@@ -88,6 +88,12 @@ class Embedding:
         self.hash = v
         self.shorthash = self.hash[0:12]
 
+    def read_hash(self):
+        """makes sure the hash is known, waiting for it to be calculated if needed"""
+
+        if not self.hash and self.filename is not None:
+            self.set_hash(hashes.sha256(self.filename, "textual_inversion/" + self.name) or '')
+
 
 class DirWithTextualInversionEmbeddings:
     def __init__(self, path):
@@ -205,7 +211,9 @@ class EmbeddingDatabase:
         embedding.vectors = vec.shape[0]
         embedding.shape = vec.shape[-1]
         embedding.filename = path
-        embedding.set_hash(hashes.sha256(embedding.filename, "textual_inversion/" + name) or '')
+        embedding.set_hash(hashes.sha256_from_cache(embedding.filename, "textual_inversion/" + name) or '')
+        if not embedding.hash:
+            hashes.request_in_background(embedding.filename, "textual_inversion/" + name, embedding.set_hash)
 
         if self.expected_shape == -1 or self.expected_shape == embedding.shape:
             self.register_embedding(embedding, shared.sd_model)
@@ -244,6 +252,7 @@ class EmbeddingDatabase:
         self.word_embeddings.clear()
         self.skipped_embeddings.clear()
         self.expected_shape = self.get_expected_shape()
+        cond_cache.clear()
 
         for embdir in self.embedding_dirs.values():
             self.load_from_dir(embdir)
@@ -592,6 +601,9 @@ def train_embedding(id_task, embedding_name, learn_rate, batch_size, gradient_st
 
                     preview_text = p.prompt
 
+                    # the embedding being trained has changed since conditionings for the prompt were cached
+                    cond_cache.clear()
+
                     with closing(p):
                         processed = processing.process_images(p)
                         image = processed.images[0] if len(processed.images) > 0 else None
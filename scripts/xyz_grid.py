@@ -86,6 +86,10 @@ def apply_checkpoint(p, x, xs):
         raise RuntimeError(f"Unknown checkpoint: {x}")
     p.override_settings['sd_model_checkpoint'] = info.name
 
+    index = xs.index(x) if x in xs else -1
+    if 0 <= index < len(xs) - 1:
+        modules.sd_models.prefetch_checkpoint(modules.sd_models.get_closet_checkpoint_match(xs[index + 1]))
+
 
 def confirm_checkpoints(p, xs):
     for x in xs:
@@ -0,0 +1,113 @@
+"""
+Compares peak RAM use and time of loading a .safetensors checkpoint the usual way (whole file into a dict, then
+load_state_dict, then half()) with streaming it into the model using modules.sd_models_stream.
+
+Each method runs in its own process, so that peak RSS of one does not hide the other. Run from the webui directory:
+
+    python -m test.benchmark_checkpoint_loading models/Stable-diffusion/model.safetensors [--device cuda] [--no-half]
+"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+from safetensors import safe_open
+
+
+def create_model(filename):
+    """creates a module with float32 parameters of the same names and shapes as tensors in the file"""
+
+    model = torch.nn.Module()
+
+    with safe_open(filename, framework="pt", device="cpu") as file:
+        for name in file.keys():
+            *path, param_name = name.split(".")
+
+            module = model
+            for part in path:
+                if not hasattr(module, part):
+                    module.add_module(part, torch.nn.Module())
+                module = getattr(module, part)
+
+            shape = file.get_slice(name).get_shape()
+            module.register_parameter(param_name, torch.nn.Parameter(torch.empty(shape, dtype=torch.float32), requires_grad=False))
+
+    return model
+
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def load_default(model, filename, device, half):
+    import safetensors.torch
+
+    state_dict = safetensors.torch.load_file(filename, device="cpu")
+    model.load_state_dict(state_dict, strict=False)
+    del state_dict
+
+    if half:
+        model.half()
+
+    model.to(device)
+
+
+def load_streamed(model, filename, device, half):
+    from modules import sd_models_stream
+
+    if half:
+        model.half()
+
+    model.to(device)
+
+    sd_models_stream.load_into_model(model, sd_models_stream.SafetensorsStateDict(filename))
+
+
+def run_one(method, filename, device, half):
+    model = create_model(filename)
+    rss_model = peak_rss_bytes()
+
+    start = time.perf_counter()
+    {"default": load_default, "streamed": load_streamed}[method](model, filename, device, half)
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+
+    print(json.dumps({"method": method, "seconds": elapsed, "peak_rss": peak_rss_bytes(), "peak_rss_before_load": rss_model}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filename")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--no-half", action="store_true")
+    parser.add_argument("--runs", type=int, default=1)
+    parser.add_argument("--method", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.method:
+        run_one(args.method, args.filename, args.device, not args.no_half)
+        return
+
+    print(f"{'method':<10} {'time, s':>8} {'peak RSS, MB':>13} {'during load, MB':>16}")
+
+    for _ in range(args.runs):
+        for method in ("default", "streamed"):
+            command = [sys.executable, "-m", "test.benchmark_checkpoint_loading", args.filename, "--device", args.device, "--method", method]
+            if args.no_half:
+                command.append("--no-half")
+
+            output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+            res = json.loads(output.strip().splitlines()[-1])
+
+            print(f"{method:<10} {res['seconds']:>8.2f} {res['peak_rss'] / 2**20:>13.0f} {(res['peak_rss'] - res['peak_rss_before_load']) / 2**20:>16.0f}")
+
+
+if __name__ == "__main__":
+    main()
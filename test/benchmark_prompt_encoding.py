@@ -0,0 +1,118 @@
+"""
+Compares the time of encoding a batch of distinct long prompts with prompt editing one prompt and one chunk at a time,
+as prompt_parser.get_learned_conditioning used to do, with encoding all chunks of all schedules of all prompts in
+a single batched transformers call. Chunk cache is disabled for both, so that only batching is measured.
+
+Uses SD1's CLIP text encoder. Run from the webui directory:
+
+    python -m test.benchmark_prompt_encoding [--device cuda] [--prompts 8] [--chunks 3] [--runs 5]
+"""
+
+import argparse
+import random
+import time
+
+import torch
+
+from ldm.modules.encoders.modules import FrozenCLIPEmbedder
+from modules import devices, prompt_parser, sd_hijack, sd_hijack_clip, shared
+
+
+class Model:
+    """the part of LatentDiffusion that prompt_parser.get_learned_conditioning uses"""
+
+    def __init__(self, cond_stage_model):
+        self.cond_stage_model = cond_stage_model
+
+    def get_learned_conditioning(self, texts):
+        return self.cond_stage_model(texts)
+
+
+def make_prompts(tokenizer, count, chunks, seed=0):
+    words = [x[:-4] for x in tokenizer.get_vocab() if x.endswith("</w>") and x[:-4].isalpha()]
+    rng = random.Random(seed)
+
+    prompts = []
+    for _ in range(count):
+        text = ", ".join(" ".join(rng.choices(words, k=3)) for _ in range(chunks * 18))
+        prompts.append(f"a photo of [{rng.choice(words)}:{rng.choice(words)}:0.3] [{rng.choice(words)}:{rng.choice(words)}:0.6], {text}")
+
+    return prompts
+
+
+def encode_one_at_a_time(encoder, prompts, steps):
+    """the old way: one get_learned_conditioning call per prompt, one transformers call per chunk index"""
+
+    res = []
+    for prompt_schedule in prompt_parser.get_learned_conditioning_prompt_schedules(prompts, steps):
+        batch_chunks, _ = encoder.process_texts([text for _, text in prompt_schedule])
+        chunk_count = max(len(x) for x in batch_chunks)
+
+        zs = []
+        for i in range(chunk_count):
+            batch_chunk = [chunks[i] if i < len(chunks) else encoder.empty_chunk() for chunks in batch_chunks]
+            z = encoder.encode_tokens([x.tokens for x in batch_chunk])
+            zs.append(encoder.apply_multipliers(z, [x.multipliers for x in batch_chunk]))
+
+        res.append(torch.hstack(zs))
+
+    return res
+
+
+def encode_batched(encoder, prompts, steps):
+    return prompt_parser.get_learned_conditioning(Model(encoder), prompts, steps)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--prompts", type=int, default=8)
+    parser.add_argument("--chunks", type=int, default=3)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    devices.device = torch.device(args.device)
+    shared.opts.data["cond_chunk_cache_size"] = 0
+
+    wrapped = FrozenCLIPEmbedder().to(devices.device)
+    if devices.device.type == "cuda":
+        wrapped.half()
+
+    encoder = sd_hijack_clip.FrozenCLIPEmbedderWithCustomWords(wrapped, sd_hijack.model_hijack)
+    prompts = make_prompts(encoder.tokenizer, args.prompts, args.chunks)
+
+    transformer_calls = 0
+    encode_with_transformers = encoder.encode_with_transformers
+
+    def counted_encode_with_transformers(tokens):
+        nonlocal transformer_calls
+        transformer_calls += 1
+        return encode_with_transformers(tokens)
+
+    encoder.encode_with_transformers = counted_encode_with_transformers
+
+    print(f"{args.prompts} prompts, about {args.chunks} chunks each, 3 schedules each")
+
+    results = {}
+    for name, func in (("one at a time", encode_one_at_a_time), ("batched", encode_batched)):
+        times = []
+        with torch.no_grad():
+            func(encoder, prompts, args.steps)  # warmup
+
+            for _ in range(args.runs):
+                transformer_calls = 0
+                start = time.perf_counter()
+                func(encoder, prompts, args.steps)
+                if devices.device.type == "cuda":
+                    torch.cuda.synchronize()
+                times.append(time.perf_counter() - start)
+
+        results[name] = min(times)
+        print(f"{name:<14} best {min(times) * 1000:.1f} ms, average {sum(times) / len(times) * 1000:.1f} ms, {transformer_calls} transformers calls")
+
+    print(f"speedup: {results['one at a time'] / results['batched']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Compares the time of loading a pickled checkpoint with the safety check done as a separate pass (check_pt, then
+torch.load) and with the check done by the unpickler of torch.load itself (modules.safe.restricted_pickle_module).
+
+Creates a synthetic checkpoint with many tensors in a temporary directory, and checks that both ways load the same
+values as torch.load without any checks. Run from the webui directory:
+
+    python -m test.benchmark_safe_load [--tensors 20000] [--size-mb 1024] [--runs 3]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import torch
+
+from modules import safe
+
+
+def create_checkpoint(filename, tensors, size_mb):
+    numel = max(1, size_mb * 1024 * 1024 // 4 // tensors)
+    state_dict = {f"model.layers.{i}.weight": torch.randn(numel) for i in range(tensors)}
+    torch.save({"state_dict": state_dict, "global_step": 1}, filename)
+
+
+def load_two_passes(filename):
+    safe.check_pt(filename, None)
+    return safe.unsafe_torch_load(filename, map_location="cpu")
+
+
+def load_single_pass(filename):
+    safe.check_zip_contents(filename)
+    return safe.unsafe_torch_load(filename, map_location="cpu", pickle_module=safe.restricted_pickle_module(None))
+
+
+def check_result(res, expected):
+    assert res["global_step"] == expected["global_step"]
+    assert list(res["state_dict"]) == list(expected["state_dict"]), "loaded tensors have different names"
+
+    for key, value in expected["state_dict"].items():
+        assert torch.equal(res["state_dict"][key], value), f"loaded tensor {key} has different values"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tensors", type=int, default=20000)
+    parser.add_argument("--size-mb", type=int, default=1024)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, "synthetic.ckpt")
+        create_checkpoint(filename, args.tensors, args.size_mb)
+        print(f"checkpoint: {args.tensors} tensors, {os.path.getsize(filename) / 2**20:.0f} MB")
+
+        expected = safe.unsafe_torch_load(filename, map_location="cpu")
+
+        for name, func in (("two passes", load_two_passes), ("single pass", load_single_pass)):
+            times = []
+            for _ in range(args.runs):
+                start = time.perf_counter()
+                res = func(filename)
+                times.append(time.perf_counter() - start)
+                check_result(res, expected)
+                del res
+
+            print(f"{name:<12} best {min(times):.2f}s, average {sum(times) / len(times):.2f}s")
+
+
+if __name__ == "__main__":
+    main()
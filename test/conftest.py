@@ -4,6 +4,9 @@ import pytest
 from PIL import Image
 from gradio.processing_utils import encode_pil_to_base64
 
+# unit tests import webui modules, which parse command line arguments on import; pytest's own arguments are not for them
+os.environ.setdefault("IGNORE_CMD_ARGS_ERRORS", "1")
+
 test_files_path = os.path.dirname(__file__) + "/test_files"
 
 
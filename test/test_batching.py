@@ -0,0 +1,93 @@
+from types import SimpleNamespace
+
+import pytest
+
+from modules.api import batching
+from modules.shared import opts
+
+
+def make_processed(prompts, seeds, extra_images=0):
+    images = [f"image {x}" for x in prompts] + [f"extra {i}" for i in range(extra_images)]
+
+    return SimpleNamespace(
+        images=images,
+        infotexts=[f"info {x}" for x in images],
+        index_of_first_image=0,
+        info="",
+        batch_size=len(prompts),
+        all_prompts=list(prompts),
+        all_negative_prompts=["" for _ in prompts],
+        all_seeds=list(seeds),
+        all_subseeds=list(seeds),
+    )
+
+
+class QueueLock:
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, func, **kwargs):
+        self.jobs.append((func, kwargs))
+
+
+def make_args(prompt, seed):
+    return {"prompt": prompt, "negative_prompt": "", "seed": seed, "subseed": -1, "batch_size": 1, "n_iter": 1, "steps": 20}
+
+
+@pytest.fixture
+def batcher(monkeypatch):
+    monkeypatch.setitem(opts.data, "api_batching_max_batch_size", 2)
+    monkeypatch.setitem(opts.data, "api_batching_window", 60000)
+
+    def process(args, script_args, _, use_output_cache=True):
+        return make_processed(args["prompt"], args["seed"])
+
+    queue_lock = QueueLock()
+    return batching.Txt2ImgBatcher(queue_lock, process), queue_lock
+
+
+def test_split_processed():
+    processed = make_processed(["a", "b"], [1, 2])
+
+    res = batching.split_processed(processed, 1, 2)
+
+    assert res.images == ["image b"]
+    assert res.prompt == "b"
+    assert res.seed == 2
+    assert processed.images == ["image a", "image b"]
+
+
+def test_split_processed_mismatch_does_not_leak_results():
+    processed = make_processed(["a", "b"], [1, 2], extra_images=1)
+
+    with pytest.raises(batching.BatchSplitError):
+        batching.split_processed(processed, 0, 2)
+
+
+def test_full_group_is_submitted_and_split(batcher):
+    batcher, queue_lock = batcher
+
+    first = batcher.add(make_args("a", 1), [], "client", 1, id_task="task(a)")
+    second = batcher.add(make_args("b", 2), [], "client", 1, id_task="task(b)")
+
+    assert len(queue_lock.jobs) == 1
+    queue_lock.jobs[0][0]()
+
+    assert first.result(timeout=1).images == ["image a"]
+    assert second.result(timeout=1).images == ["image b"]
+    assert not batcher.running
+
+
+def test_cancel_member_of_full_queued_group(batcher):
+    batcher, queue_lock = batcher
+
+    first = batcher.add(make_args("a", 1), [], "client", 1, id_task="task(a)")
+    second = batcher.add(make_args("b", 2), [], "client", 1, id_task="task(b)")
+
+    assert batcher.cancel("task(a)")
+    assert first.cancelled()
+
+    queue_lock.jobs[0][0]()
+
+    assert second.result(timeout=1).images == ["image b"]
+    assert not batcher.cancel("task(b)")
@@ -0,0 +1,72 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from modules import cond_cache
+from modules.shared import opts
+
+
+@pytest.fixture(autouse=True)
+def cache(monkeypatch):
+    monkeypatch.setitem(opts.data, "cond_cache_size", 1)
+
+    cond_cache.clear()
+    yield
+    cond_cache.clear()
+
+
+def make_entry(elements):
+    return cond_cache.Entry([torch.zeros(elements, dtype=torch.float32)], {}, [])
+
+
+def test_data_size():
+    tensor = torch.zeros(4, 8, dtype=torch.float16)
+
+    assert cond_cache.data_size(tensor) == 64
+    assert cond_cache.data_size([tensor, {"a": tensor}, SimpleNamespace(cond=tensor, end_at_step=10)]) == 192
+
+
+def test_get_and_put():
+    entry = make_entry(16)
+    cond_cache.put("key", entry)
+
+    assert cond_cache.get("key") is entry
+    assert cond_cache.get("other") is None
+
+
+def test_eviction():
+    # 1 MB fits 262144 float32 elements, so two entries of 2/3 of that don't fit together
+    cond_cache.put("first", make_entry(174762))
+    cond_cache.put("second", make_entry(174762))
+    cond_cache.put("too large", make_entry(262145))
+
+    assert cond_cache.get("first") is None
+    assert cond_cache.get("second") is not None
+    assert cond_cache.get("too large") is None
+    assert cond_cache.total_bytes == 174762 * 4
+
+
+def test_disabled(monkeypatch):
+    cond_cache.put("key", make_entry(16))
+    monkeypatch.setitem(opts.data, "cond_cache_size", 0)
+
+    assert cond_cache.get("key") is None
+
+
+def test_infotext_replay():
+    hijack = SimpleNamespace(extra_generation_params={"Existing": "1"}, comments=["old comment"])
+    state = cond_cache.infotext_state(hijack)
+
+    hijack.extra_generation_params["TI hashes"] = "emb: 123"
+    hijack.comments.append("new comment")
+    entry = cond_cache.make_entry("cond", hijack, state)
+
+    assert entry.generation_params == {"TI hashes": "emb: 123"}
+    assert entry.comments == ["new comment"]
+
+    fresh = SimpleNamespace(extra_generation_params={}, comments=[])
+    entry.apply_infotext(fresh)
+
+    assert fresh.extra_generation_params == {"TI hashes": "emb: 123"}
+    assert fresh.comments == ["new comment"]
@@ -0,0 +1,52 @@
+import os
+
+from modules import hashes
+
+
+def test_fingerprint(tmp_path):
+    filename = tmp_path / "model.safetensors"
+    filename.write_bytes(b"weights")
+    stat = os.stat(filename)
+
+    assert hashes.file_fingerprint(filename) == {"mtime": stat.st_mtime, "size": 7, "inode": stat.st_ino, "device": stat.st_dev}
+
+
+def test_is_unchanged():
+    fingerprint = {"mtime": 10.0, "size": 7, "inode": 5, "device": 2}
+
+    assert hashes.is_unchanged({**fingerprint, "sha256": "abc"}, fingerprint)
+    assert not hashes.is_unchanged({**fingerprint, "device": 3}, fingerprint)
+    assert not hashes.is_unchanged({**fingerprint, "size": 8}, fingerprint)
+
+    # written before device was recorded
+    assert hashes.is_unchanged({"mtime": 10.0, "size": 7, "inode": 5}, fingerprint)
+    assert not hashes.is_unchanged({"mtime": 10.0, "size": 7, "inode": 6}, fingerprint)
+
+    # written before size and inode were recorded
+    assert hashes.is_unchanged({"mtime": 11.0}, fingerprint)
+    assert not hashes.is_unchanged({"mtime": 9.0}, fingerprint)
+
+
+def test_has_more_urgent_job(monkeypatch, tmp_path):
+    filename = tmp_path / "model.safetensors"
+    filename.write_bytes(b"weights")
+
+    current = hashes.HashJob(filename, "current", False, 10)
+    finished = hashes.HashJob(filename, "finished", False, 0)
+    finished.future.set_result("abc")
+    taken = hashes.HashJob(filename, "taken", False, 0)
+    taken.running = True
+    waiting = hashes.HashJob(filename, "waiting", False, 0)
+
+    job_queue = [(0, 0, finished), (0, 1, taken), (0, 2, waiting)]
+    monkeypatch.setattr(hashes, "idle_workers", 0)
+    monkeypatch.setattr(hashes, "job_queue", job_queue)
+    monkeypatch.setattr(hashes, "jobs", {(x.title, False): x for x in [current, taken, waiting]})
+
+    assert hashes.has_more_urgent_job(current)
+
+    # the only urgent entry left is for a job that was replaced by another one with the same title
+    job_queue.pop()
+    hashes.jobs[("waiting", False)] = hashes.HashJob(filename, "waiting", False, 20)
+    job_queue.append((0, 2, waiting))
+    assert not hashes.has_more_urgent_job(current)
@@ -0,0 +1,110 @@
+import threading
+
+import pytest
+
+from modules import job_scheduler
+from modules.shared import opts
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    monkeypatch.setitem(opts.data, "queue_priority_aging", 0)
+
+    res = job_scheduler.JobScheduler()
+    res.enqueue("running", client="a")
+    return res
+
+
+def grant_order(scheduler):
+    order = []
+    while scheduler.current is not None:
+        order.append(scheduler.current.id_job)
+        scheduler.finish(scheduler.current)
+
+    return order
+
+
+def test_priority(scheduler):
+    scheduler.enqueue("batch", client="a", priority=job_scheduler.PRIORITY_BATCH)
+    scheduler.enqueue("normal", client="a", priority=job_scheduler.PRIORITY_NORMAL)
+    scheduler.enqueue("interactive", client="a", priority=job_scheduler.PRIORITY_INTERACTIVE)
+
+    assert grant_order(scheduler) == ["running", "interactive", "normal", "batch"]
+
+
+def test_aging(scheduler, monkeypatch):
+    monkeypatch.setitem(opts.data, "queue_priority_aging", 10)
+
+    old = scheduler.enqueue("old batch", client="a", priority=job_scheduler.PRIORITY_BATCH)
+    old.time_queued -= 25
+    scheduler.enqueue("normal", client="a", priority=job_scheduler.PRIORITY_NORMAL)
+
+    assert grant_order(scheduler) == ["running", "old batch", "normal"]
+
+
+def test_fairness(scheduler):
+    for i in range(3):
+        scheduler.enqueue(f"a{i}", client="a")
+    for i in range(2):
+        scheduler.enqueue(f"b{i}", client="b")
+
+    assert scheduler.position("b0") == 0
+    assert grant_order(scheduler) == ["running", "b0", "a0", "b1", "a1", "a2"]
+
+
+def test_cancel(scheduler):
+    cancelled = []
+    scheduler.enqueue("first", client="a")
+    job = scheduler.enqueue("second", client="a", on_cancel=lambda: cancelled.append(True))
+
+    assert scheduler.cancel("second")
+    assert not scheduler.cancel("second")
+    assert not scheduler.cancel("running")
+    assert cancelled == [True]
+    assert not scheduler.wait(job, timeout=0)
+    assert grant_order(scheduler) == ["running", "first"]
+
+
+def test_wait(scheduler):
+    job = scheduler.enqueue("waiting", client="b")
+    assert not scheduler.wait(job, timeout=0.01)
+    assert scheduler.position("waiting") is None
+
+    job = scheduler.enqueue("waiting", client="b")
+    threading.Timer(0.05, scheduler.finish, args=(scheduler.current,)).start()
+    assert scheduler.wait(job, timeout=5)
+    assert scheduler.current is job
+
+
+def test_wait_timing_out_after_job_left_queue(scheduler):
+    job = scheduler.enqueue("waiting", client="b")
+
+    # what wait() sees if it times out just as cancel() takes the job off the queue
+    with scheduler._mutex:
+        scheduler._waiting.remove(job)
+
+    assert not scheduler.wait(job, timeout=0)
+
+
+def test_client_served_is_bounded(scheduler, monkeypatch):
+    monkeypatch.setattr(job_scheduler, "max_tracked_clients", 3)
+
+    scheduler.finish(scheduler.current)
+    scheduler.enqueue("w served", client="w")
+    scheduler.enqueue("w waiting", client="w", priority=job_scheduler.PRIORITY_BATCH)
+    for i in range(5):
+        scheduler.enqueue(f"c{i}", client=f"c{i}", priority=job_scheduler.PRIORITY_INTERACTIVE)
+        scheduler.finish(scheduler.current)
+
+    assert scheduler.current.id_job == "c4"
+    assert len(scheduler._client_served) == 3
+    assert "w" in scheduler._client_served
+
+
+def test_submit_runs_jobs_in_order(scheduler):
+    ran = []
+    scheduler.submit(lambda: ran.append("submitted"), id_job="submitted", client="b")
+    scheduler.finish(scheduler.current)
+
+    assert scheduler.wait_until_idle(timeout=5)
+    assert ran == ["submitted"]
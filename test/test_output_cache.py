@@ -0,0 +1,104 @@
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image
+
+from modules import output_cache, scripts, extra_networks
+from modules.shared import opts
+
+
+class PostprocessImageScript(scripts.Script):
+    def postprocess_image(self, p, pp, *args):
+        pass
+
+
+class ProcessScript(scripts.Script):
+    def process(self, p, *args):
+        pass
+
+
+class FileNetwork(extra_networks.ExtraNetwork):
+    def __init__(self, directory):
+        super().__init__("test")
+        self.directory = directory
+
+    def files(self, params_list):
+        return [str(self.directory / x.items[0]) for x in params_list]
+
+
+@pytest.fixture(autouse=True)
+def cache(monkeypatch):
+    monkeypatch.setitem(opts.data, "output_cache_enabled", True)
+    monkeypatch.setitem(opts.data, "output_cache_size", 1)
+    monkeypatch.setattr(output_cache, "loaded_embeddings", lambda: {})
+
+    output_cache.clear()
+    yield
+    output_cache.clear()
+
+
+def make_p(seed=1, prompt="a cat", alwayson_scripts=(), use_output_cache=True):
+    sd_model = SimpleNamespace(sd_model_hash="abcdef", sd_checkpoint_info=SimpleNamespace(filename="model.safetensors"))
+    return SimpleNamespace(
+        prompt=prompt, all_prompts=[prompt], all_negative_prompts=[""], seed=seed, subseed=-1, subseed_strength=0,
+        sd_model=sd_model, scripts=SimpleNamespace(alwayson_scripts=list(alwayson_scripts)), use_output_cache=use_output_cache,
+    )
+
+
+def make_processed(size):
+    return SimpleNamespace(images=[Image.new("RGB", (size, size))], infotexts=["info"])
+
+
+def test_key():
+    assert output_cache.make_key(make_p()) == output_cache.make_key(make_p())
+    assert output_cache.make_key(make_p()) != output_cache.make_key(make_p(prompt="a dog"))
+    assert output_cache.make_key(make_p(seed=-1)) is None
+    assert output_cache.make_key(make_p(use_output_cache=False)) is None
+
+
+def test_key_with_changed_network(monkeypatch, tmp_path):
+    monkeypatch.setitem(extra_networks.extra_network_registry, "test", FileNetwork(tmp_path))
+    (tmp_path / "net").write_bytes(b"old")
+
+    key = output_cache.make_key(make_p(prompt="a cat <test:net:1>"))
+    assert key == output_cache.make_key(make_p(prompt="a cat <test:net:1>"))
+
+    (tmp_path / "net").write_bytes(b"newer")
+    assert key != output_cache.make_key(make_p(prompt="a cat <test:net:1>"))
+
+
+def test_key_with_changed_embedding(monkeypatch):
+    embedding = SimpleNamespace(filename=None, checksum=lambda: "1234")
+    monkeypatch.setattr(output_cache, "loaded_embeddings", lambda: {"style": embedding})
+
+    key = output_cache.make_key(make_p(prompt="a cat, style"))
+    assert key == output_cache.make_key(make_p(prompt="a cat, style"))
+
+    embedding.checksum = lambda: "5678"
+    assert key != output_cache.make_key(make_p(prompt="a cat, style"))
+    assert output_cache.make_key(make_p()) == output_cache.make_key(make_p())
+
+
+def test_key_with_script_hooks():
+    assert output_cache.make_key(make_p(alwayson_scripts=[ProcessScript()])) is not None
+    assert output_cache.make_key(make_p(alwayson_scripts=[PostprocessImageScript()])) is None
+
+
+def test_get_returns_copy():
+    output_cache.put("key", make_processed(8))
+
+    res = output_cache.get("key")
+    res.images.append("extra")
+
+    assert len(output_cache.get("key").images) == 1
+    assert output_cache.get("other") is None
+
+
+def test_eviction():
+    # each image is 512 * 512 * 3 bytes, so only one fits into 1 MB
+    output_cache.put("first", make_processed(512))
+    output_cache.put("second", make_processed(512))
+
+    assert output_cache.get("first") is None
+    assert output_cache.get("second") is not None
+    assert output_cache.total_bytes == 512 * 512 * 3
@@ -0,0 +1,48 @@
+import pytest
+
+from modules import result_store
+from modules.shared import opts
+
+
+@pytest.fixture
+def store(monkeypatch, tmp_path):
+    monkeypatch.setattr(result_store, "results_dir", str(tmp_path))
+    monkeypatch.setitem(opts.data, "api_task_results_limit", 2)
+    monkeypatch.setitem(opts.data, "result_store_ttl", 0)
+    monkeypatch.setitem(opts.data, "result_store_spill_to_disk", False)
+    monkeypatch.setitem(opts.data, "result_store_disk_limit", 1)
+
+    return result_store.ResultStore("test", "api_task_results_limit")
+
+
+def test_limit(store):
+    for i in range(3):
+        store.put(f"task {i}", i)
+
+    assert "task 0" not in store
+    assert store.get("task 1") == 1
+    assert store.get("task 2") == 2
+
+
+def test_ttl(store, monkeypatch):
+    monkeypatch.setitem(opts.data, "result_store_ttl", 10)
+    store.put("task", "result")
+
+    assert store.get("task") == "result"
+
+    monkeypatch.setattr(result_store.time, "time", lambda: store.results["task"][0] + 11)
+    assert store.get("task", "expired") == "expired"
+
+
+def test_spill(store, monkeypatch):
+    monkeypatch.setitem(opts.data, "result_store_spill_to_disk", True)
+
+    for i in range(4):
+        store.put(f"task {i}", i)
+
+    # two newest in memory, the one evicted last on disk, and the oldest removed from disk to fit the disk limit
+    assert [store.get(f"task {i}") for i in range(4)] == [None, 1, 2, 3]
+    assert "task 1" not in store.results
+
+    reloaded = result_store.ResultStore("test", "api_task_results_limit")
+    assert reloaded.get("task 1") == 1
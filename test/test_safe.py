@@ -0,0 +1,55 @@
+import collections
+
+import pytest
+import torch
+
+from modules import safe
+
+
+class Forbidden:
+    pass
+
+
+def make_state_dict():
+    generator = torch.Generator().manual_seed(0)
+
+    return collections.OrderedDict([
+        ("model.weight", torch.randn(4, 8, generator=generator)),
+        ("model.bias", torch.randn(8, generator=generator).half()),
+        ("model.steps", torch.arange(5)),
+    ])
+
+
+@pytest.mark.parametrize("zipfile", [True, False])
+def test_load_with_extra(tmp_path, zipfile):
+    filename = str(tmp_path / "model.ckpt")
+    state_dict = make_state_dict()
+    torch.save({"state_dict": state_dict, "global_step": 10}, filename, _use_new_zipfile_serialization=zipfile)
+
+    loaded = safe.load_with_extra(filename, map_location="cpu")
+
+    assert loaded["global_step"] == 10
+    assert list(loaded["state_dict"]) == list(state_dict)
+    for key, value in state_dict.items():
+        assert loaded["state_dict"][key].dtype == value.dtype
+        assert torch.equal(loaded["state_dict"][key], value)
+
+
+def test_load_with_extra_forbidden(tmp_path):
+    filename = str(tmp_path / "model.ckpt")
+    torch.save({"state_dict": make_state_dict(), "extra": Forbidden()}, filename)
+
+    assert safe.load_with_extra(filename, map_location="cpu") is None
+
+
+def test_load_with_extra_handler(tmp_path):
+    filename = str(tmp_path / "model.ckpt")
+    torch.save({"weight": torch.ones(3), "extra": Forbidden()}, filename)
+
+    def extra_handler(module, name):
+        return Forbidden if name == "Forbidden" else None
+
+    loaded = safe.load_with_extra(filename, extra_handler=extra_handler, map_location="cpu")
+
+    assert isinstance(loaded["extra"], Forbidden)
+    assert torch.equal(loaded["weight"], torch.ones(3))
@@ -0,0 +1,52 @@
+import torch
+
+from modules import sd_models_delta
+
+
+def make_model():
+    return torch.nn.Sequential(torch.nn.Linear(4, 4), torch.nn.Linear(4, 4))
+
+
+def apply_lora_like_network(layer):
+    """does to the layer what Lora with lora_functional off does: keeps a backup and merges changes into the weight"""
+
+    layer.network_weights_backup = layer.weight.detach().clone()
+    layer.network_current_names = (("lora", 1.0, 1.0, None),)
+
+    with torch.no_grad():
+        layer.weight += 1.0
+
+
+def test_unchanged_keys_all_same():
+    model = make_model()
+    fingerprints = sd_models_delta.state_dict_fingerprints(model.state_dict())
+    model.tensor_fingerprints = dict(fingerprints)
+
+    assert sd_models_delta.unchanged_keys(model, fingerprints) == set(fingerprints)
+
+
+def test_checkpoint_switch_after_lora_generation():
+    model = make_model()
+    checkpoint = {k: v.clone() for k, v in model.state_dict().items()}
+    fingerprints = sd_models_delta.state_dict_fingerprints(checkpoint)
+    model.tensor_fingerprints = dict(fingerprints)
+
+    apply_lora_like_network(model[0])
+
+    unchanged = sd_models_delta.unchanged_keys(model, fingerprints)
+    assert "0.weight" not in unchanged
+    assert {"1.weight", "1.bias"} <= unchanged
+
+    model.load_state_dict({k: v for k, v in checkpoint.items() if k not in unchanged}, strict=False)
+
+    for key, value in model.state_dict().items():
+        assert torch.equal(value, checkpoint[key]), key
+
+
+def test_forget_prefix():
+    model = make_model()
+    model.tensor_fingerprints = sd_models_delta.state_dict_fingerprints(model.state_dict())
+
+    sd_models_delta.forget(model, "0.")
+
+    assert set(model.tensor_fingerprints) == {"1.weight", "1.bias"}
@@ -1,3 +1,4 @@
+import time
 
 import pytest
 import requests
@@ -88,3 +89,50 @@ def test_txt2img_multiple_batches_performed(url_txt2img, simple_txt2img_request)
 def test_txt2img_batch_performed(url_txt2img, simple_txt2img_request):
     simple_txt2img_request["batch_size"] = 2
     assert requests.post(url_txt2img, json=simple_txt2img_request).status_code == 200
+
+
+def test_txt2img_multipart_response_performed(url_txt2img, simple_txt2img_request):
+    simple_txt2img_request["response_format"] = "multipart"
+    simple_txt2img_request["image_format"] = "webp"
+    response = requests.post(url_txt2img, json=simple_txt2img_request)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("multipart/mixed")
+
+
+def test_txt2img_submit_performed(base_url, simple_txt2img_request):
+    response = requests.post(f"{base_url}/sdapi/v1/txt2img/submit", json=simple_txt2img_request)
+    assert response.status_code == 200
+
+    id_task = response.json()["id_task"]
+    for _ in range(600):
+        status = requests.get(f"{base_url}/sdapi/v1/tasks/{id_task}").json()["status"]
+        if status not in ("queued", "running"):
+            break
+        time.sleep(0.1)
+
+    assert status == "done"
+    assert requests.get(f"{base_url}/sdapi/v1/tasks/{id_task}/result").status_code == 200
+
+
+def test_txt2img_submit_result_wait(base_url, simple_txt2img_request):
+    response = requests.post(f"{base_url}/sdapi/v1/txt2img/submit", json=simple_txt2img_request)
+    assert response.status_code == 200
+
+    id_task = response.json()["id_task"]
+    assert requests.get(f"{base_url}/sdapi/v1/tasks/{id_task}/result", params={"timeout": 60}).status_code == 200
+
+
+def test_txt2img_output_cache_performed(base_url, url_txt2img, simple_txt2img_request):
+    url_options = f"{base_url}/sdapi/v1/options"
+    pre_value = requests.get(url_options).json()["output_cache_enabled"]
+    assert requests.post(url_options, json={"output_cache_enabled": True}).status_code == 200
+
+    try:
+        simple_txt2img_request["seed"] = 1234
+        first = requests.post(url_txt2img, json=simple_txt2img_request)
+        second = requests.post(url_txt2img, json=simple_txt2img_request)
+        assert first.status_code == 200
+        assert second.status_code == 200
+        assert first.json()["images"] == second.json()["images"]
+    finally:
+        requests.post(url_options, json={"output_cache_enabled": pre_value})